@@ -2,6 +2,7 @@ import decimal
 import rtyaml
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.timezone import now
 
 from contrib.de import DemocracyEngineAPIClient, HumanReadableValidationError, DummyDemocracyEngineAPIClient
@@ -14,6 +15,12 @@ if settings.DE_API:
 		settings.DE_API['username'],
 		settings.DE_API['password'],
 		settings.DE_API['fees-recipient-id'],
+		pool_size=settings.DE_API.get('pool-size', 10),
+		timeout=settings.DE_API.get('timeout', 60),
+		live_timeout=settings.DE_API.get('live-timeout', 20),
+		connect_timeout=settings.DE_API.get('connect-timeout'),
+		meta_info_cache=cache,
+		meta_info_ttl=settings.DE_API.get('meta-info-ttl', 60*60*24),
 		)
 else:
 	# Testing only, obviously!
@@ -22,6 +29,23 @@ else:
 		print("Using DummyDemocracyEngineAPI!!")
 	DemocracyEngineAPI = DummyDemocracyEngineAPIClient()
 
+def warm_up_democracy_engine():
+	# Load the DE API's subscriber meta info in a background thread so that
+	# it isn't fetched while the first user who needs it waits, and so that
+	# starting a web worker doesn't block if DE is slow or down. This is only
+	# an optimization, so a failure is ignored --- the meta info will be
+	# fetched on first use instead.
+	import threading
+	def warm_up():
+		try:
+			DemocracyEngineAPI.warm_up()
+		except Exception:
+			pass
+	thread = threading.Thread(target=warm_up)
+	thread.daemon = True
+	thread.start()
+	return thread
+
 def create_de_donation_basic_dict(pledge):
 	# Creates basic info for a Democracy Engine API call for creating
 	# a transaction (both authtest and auth+capture calls) based on a
@@ -105,16 +129,66 @@ def run_authorization_test(pledge, ccnum, cccvc, aux_data):
 	pledge.profile.extra['billing']['authorization'] = de_txn
 	pledge.profile.extra['billing']['de_cc_token'] = de_txn['token']
 
+def get_trigger_cache_key(name, trigger):
+	# Returns a key for caching data about the Trigger that is computed from
+	# the Actions of its execution, or of its subtriggers' executions if it
+	# is a super-trigger. The key includes the updated timestamps of those
+	# TriggerExecutions, which are bumped when anything that affects the
+	# Actions changes (see TriggerExecution.invalidate_recipient_matrices),
+	# and the status and updated timestamp of the Trigger and of all of its
+	# subtriggers, so a changed key is how the cache gets invalidated. Stale
+	# entries just expire.
+	#
+	# Subtriggers may be super-triggers themselves, so expand them a level at
+	# a time (as in Trigger.compute_max_split).
+	import hashlib
+	from contrib.models import Trigger, TriggerExecution
+	versions = [trigger.status.name, trigger.updated.isoformat()]
+	trigger_ids = set()
+	seen = { trigger.id }
+	level = [trigger]
+	while level:
+		next_level = set()
+		for t in level:
+			if t.extra and "subtriggers" in t.extra:
+				next_level |= set(rec["trigger"] for rec in t.extra["subtriggers"]) - seen
+			else:
+				trigger_ids.add(t.id)
+		seen |= next_level
+		level = list(Trigger.objects.filter(id__in=next_level).only('id', 'status', 'updated', 'extra')) if next_level else []
+		versions += sorted("t%d:%s:%s" % (t.id, t.status.name, t.updated.isoformat()) for t in level)
+	executions = sorted(TriggerExecution.objects.filter(trigger_id__in=trigger_ids).values_list('trigger_id', 'updated'))
+	versions += ["%d:%s" % (id, updated.isoformat()) for id, updated in executions]
+	return "%s:%d:%s" % (name, trigger.id, hashlib.sha1(",".join(versions).encode("ascii")).hexdigest())
+
 def get_pledge_recipient_breakdown(trigger):
 	# Compute how many recipients there are in each category for a hypothetical
-	# pledge.
-
+	# pledge. This is shown on every view of an executed Trigger's contribute
+	# page but only changes when the Actions change, so it is cached.
+	cache_key = get_trigger_cache_key("pledge_recipient_breakdown", trigger)
+	breakdown = cache.get(cache_key)
+	if breakdown is None:
+		breakdown = compute_pledge_recipient_breakdown(trigger)
+		cache.set(cache_key, breakdown, 60*60*24*7)
+	return breakdown
+
+def compute_pledge_recipient_breakdown(trigger):
 	if trigger.extra and "subtriggers" in trigger.extra:
 		# This is a super-trigger. Add together the recipients for the subtriggers.
-		from contrib.models import Trigger
+		# Load all of the subtriggers and their Actions at once.
+		from contrib.models import Trigger, Action
+		subtrigger_ids = [rec["trigger"] for rec in trigger.extra["subtriggers"]]
+		subtriggers = Trigger.objects.in_bulk(subtrigger_ids)
+		subtrigger_actions = { id: [] for id in subtrigger_ids }
+		for action in Action.objects.filter(execution__trigger_id__in=subtrigger_ids)\
+			.select_related('actor', 'actor__challenger', 'execution'):
+			subtrigger_actions[action.execution.trigger_id].append(action)
+
 		counts = [{ } for outcome in trigger.outcomes]
 		for rec in trigger.extra["subtriggers"]:
-			inner_counts = get_pledge_recipient_breakdown_simple(Trigger.objects.get(id=rec["trigger"]))
+			if rec["trigger"] not in subtriggers:
+				raise Trigger.DoesNotExist("Subtrigger %d does not exist." % rec["trigger"])
+			inner_counts = get_pledge_recipient_breakdown_simple(subtriggers[rec["trigger"]], subtrigger_actions[rec["trigger"]])
 			for (super_outcome_index, sub_outcome_index) in enumerate(rec["outcome-map"]):
 				for key, count in inner_counts[sub_outcome_index].items():
 					counts[super_outcome_index][key] = counts[super_outcome_index].get(key, 0) + count
@@ -128,12 +202,15 @@ def get_pledge_recipient_breakdown(trigger):
 	           in outcome_counts.items() ]
 	         for outcome_counts in counts ]
 
-def get_pledge_recipient_breakdown_simple(trigger):
+def get_pledge_recipient_breakdown_simple(trigger, actions=None):
 	counts = [{ } for outcome in trigger.outcomes]
 
 	if len(trigger.outcomes) != 2: raise ValueError("counting assumes two outcomes")
 
-	for action in trigger.execution.actions.all().select_related('actor'):
+	if actions is None:
+		actions = trigger.execution.actions.all().select_related('actor', 'actor__challenger')
+
+	for action in actions:
 		# Actor did not take a counted action.
 		if action.outcome is None: continue
 
@@ -156,131 +233,313 @@ def get_pledge_recipient_breakdown_simple(trigger):
 
 	return counts
 
-def get_pledge_recipients(pledge):
-	# For pledge execution, figure out how to split the contribution
-	# across actual recipients.
-	#
-	# This function returns a list of tuples of recipient information.
-	# The pledge amount is going to be evenly split across the list elements.
-	#
-	# Note that some Pledges yield Actions from multiple Triggers. In that
-	# case we may return a list with repeated (non-unique) recipients, but
-	# each entry across a single recipient will have a different Action.
-	#
-	# We also use this during Pledge creation
-	# validation, when the trigger is already executed, so we can
-	# stop the user from making a Pledge that will have no recipients.
-	# In that case, pledge may be an unsaved Pledge instance.
-
-	from contrib.models import Trigger, ActorParty, Actor, Action, Recipient, ContributionRecipientType
-
-	# What trigger(s) does this Pledge execute actions from?
+def get_pledge_desired_outcomes(pledge):
+	# Returns a dict mapping the IDs of the Trigger(s) whose Actions the
+	# Pledge executes on to the desired outcome for each Trigger.
 	if not pledge.extra or not pledge.extra.get("triggers"):
 		# The usual case is that the Pledge uses the Actions of its Trigger.
 		# There is only one desired outcome, but we make a simple mapping to it.
-		triggers = [pledge.trigger]
-		desired_outcome = { pledge.trigger.id: pledge.desired_outcome }
-		error_descr = lambda action : str(pledge)
+		return { pledge.trigger_id: pledge.desired_outcome }
 
 	else:
 		# If the extra.triggers key is specified, then it is a list of
-		# pairs of trigger IDs and desired outcomes.
-		desired_outcome = dict(pledge.extra["triggers"])
-
-		# And this Pledge uses the Actions listed for the executions of those triggers
-		# rather than its own trigger.
-		triggers = Trigger.objects.in_bulk(desired_outcome.keys())
+		# pairs of trigger IDs and desired outcomes. This Pledge uses the
+		# Actions listed for the executions of those triggers rather than
+		# its own trigger.
+		return dict(pledge.extra["triggers"])
+
+class PledgeRecipientIndex(object):
+	# An in-memory index of the Actions of executed Triggers, along with
+	# their Actors, the Actors' challenger Recipients, and the Actors' own
+	# (incumbent) Recipients. The data for each Trigger is loaded once, with
+	# a constant number of queries, the first time a Pledge needs it, so that
+	# the recipients of many Pledges on the same Trigger(s) can be computed
+	# by filtering in memory.
+	#
+	# The index holds on to model instances that Pledge execution modifies
+	# (e.g. Action totals), so an index should not be shared across threads.
+
+	def __init__(self):
+		# Map Trigger IDs to lists of (Action, incumbent Recipient, challenger Recipient)
+		# tuples. The Recipients may be None if they don't exist.
+		self.triggers = { }
+
+		# Map Trigger IDs to the recipient matrices of their TriggerExecutions
+		# (see build_recipient_matrix), or None if a matrix isn't available.
+		self.recipient_matrices = { }
+
+	def load(self, trigger_ids):
+		# Load the Actions for any Triggers not already in the index.
+		from contrib.models import Action, Recipient
+
+		trigger_ids = set(trigger_ids) - set(self.triggers)
+		if len(trigger_ids) == 0:
+			return
+
+		# What Actions occurred as a part of all of these triggers?
+		actions = list(Action.objects
+			.filter(execution__trigger_id__in=trigger_ids)
+			.select_related('actor', 'actor__challenger', 'execution')
+			.order_by('id'))
+
+		# Get the incumbent Recipient objects for all of the Actors at once.
+		incumbents = {
+			r.actor_id: r
+			for r in Recipient.objects.filter(actor_id__in=set(action.actor_id for action in actions))
+		}
+
+		for trigger_id in trigger_ids:
+			self.triggers[trigger_id] = []
+		for action in actions:
+			self.triggers[action.execution.trigger_id].append(
+				(action, incumbents.get(action.actor_id), action.actor.challenger))
+
+	def get_recipient_matrices(self, trigger_ids):
+		# Return a dict from the Trigger IDs to the recipient matrices of their
+		# TriggerExecutions, or to None for a Trigger that isn't executed or
+		# doesn't have a matrix. Each TriggerExecution is loaded (and its matrix
+		# decoded) only the first time it is needed.
+		from contrib.models import TriggerExecution
+
+		missing = set(trigger_ids) - set(self.recipient_matrices)
+		if len(missing) > 0:
+			for trigger_id in missing:
+				self.recipient_matrices[trigger_id] = None
+			for te in TriggerExecution.objects.filter(trigger_id__in=missing).select_related('trigger'):
+				self.recipient_matrices[te.trigger_id] = te.get_recipient_matrix()
+
+		return { trigger_id: self.recipient_matrices[trigger_id] for trigger_id in trigger_ids }
+
+	def get_recipients(self, pledge):
+		# For pledge execution, figure out how to split the contribution
+		# across actual recipients.
+		#
+		# This function returns a list of tuples of recipient information.
+		# The pledge amount is going to be evenly split across the list elements.
+		#
+		# Note that some Pledges yield Actions from multiple Triggers. In that
+		# case we may return a list with repeated (non-unique) recipients, but
+		# each entry across a single recipient will have a different Action.
+		#
+		# We also use this during Pledge creation
+		# validation, when the trigger is already executed, so we can
+		# stop the user from making a Pledge that will have no recipients.
+		# In that case, pledge may be an unsaved Pledge instance.
+
+		from contrib.models import Recipient, ContributionRecipientType
+
+		# What trigger(s) does this Pledge execute actions from?
+		desired_outcome = get_pledge_desired_outcomes(pledge)
 
 		# For error messages...
-		error_descr = lambda action : str(action) + " for " + str(pledge)
+		if not pledge.extra or not pledge.extra.get("triggers"):
+			error_descr = lambda action : str(pledge)
+		else:
+			error_descr = lambda action : str(action) + " for " + str(pledge)
 
-	# What Actions occurred as a part of all of these triggers?
-	actions = Action.objects\
-		.filter(execution__trigger__in=triggers)\
-		.prefetch_related('actor', 'actor__challenger', 'execution')
+		# Load the Actions that occurred as a part of all of these triggers.
+		self.load(desired_outcome.keys())
 
-	# Build the recipient list.
+		# Build the recipient list.
 
-	recipients = []
+		recipients = []
 
-	for action in actions:
-		# Skip actions with null outcomes, meaning the Actor didn't really
-		# take an action and so no contribution for or against is made.
+		actions = sorted(
+			(entry for trigger_id in desired_outcome for entry in self.triggers[trigger_id]),
+			key = lambda entry : entry[0].id)
 
-		if action.outcome is None:
-			continue
+		for action, incumbent, challenger in actions:
+			# Skip actions with null outcomes, meaning the Actor didn't really
+			# take an action and so no contribution for or against is made.
 
-		# Skip Actions where the Actor is no longer able to receive contributions.
-		# Although we normally null-out the outcome field in corresponding Actions
-		# (and so we would skip per the statement above), when a pledge is made on
-		# a trigger that was executed a long time ago, circumstances may have changed.
-		# If the incumbent can't take contributions, we don't give to an opponent
-		# either.
-		if action.actor.inactive_reason:
-			continue
+			if action.outcome is None:
+				continue
 
-		# Get recipient_type and the Recipient object.
+			# Skip Actions where the Actor is no longer able to receive contributions.
+			# Although we normally null-out the outcome field in corresponding Actions
+			# (and so we would skip per the statement above), when a pledge is made on
+			# a trigger that was executed a long time ago, circumstances may have changed.
+			# If the incumbent can't take contributions, we don't give to an opponent
+			# either.
+			if action.actor.inactive_reason:
+				continue
 
-		if action.outcome == desired_outcome[action.execution.trigger_id]:
-			# The incumbent did what the user wanted, so the incumbent is the recipient.
+			# Get recipient_type and the Recipient object.
 
-			# Get what sort of recipient this is.
-			recipient_type = ContributionRecipientType.Incumbent
+			if action.outcome == desired_outcome[action.execution.trigger_id]:
+				# The incumbent did what the user wanted, so the incumbent is the recipient.
 
-			# Get the Recipient object.
-			try:
-				r = Recipient.objects.get(actor=action.actor)
-			except Recipient.DoesNotExist:
-				if settings.DEBUG:
-					continue
-				raise Recipient.DoesNotExist("There is no recipient for " + str(action.actor) + " while executing " + error_descr(action) + ".")
+				# Get what sort of recipient this is.
+				recipient_type = ContributionRecipientType.Incumbent
 
-		else:
-			# The incumbent did something other than what the user wanted, so the
-			# challenger of the opposite party is the recipient.
-			#
-			# Use the Actor's current challenger at the time this function is called.
-			# That might be different from the challenger at the time the Trigger was
-			# executed.
-
-			# Get what sort of recipient this is.
-			recipient_type = ContributionRecipientType.GeneralChallenger
-
-			# Get the Recipient object.
-			r = action.actor.challenger
-			if not r:
-				# We don't have a challenger Recipient associated. There should always
-				# be a challenger Recipient assigned.
-				if settings.DEBUG:
-					continue
-				raise Recipient.DoesNotExist(str(action.actor) + " has no challenger recipient assigned, while executing " + error_descr(action) + ".")
-
-		# The Recipient may not be currently taking contributions.
-		# This condition should be filtered out earlier in the creation
-		# of Action objects --- it should have a null outcome with
-		# explanation.
-		
-		if not r.active:
-			raise ValueError("Recipient is inactive: %s => %s" % (action, r))
-
-		# Filter if the pledge is for incumbents or for challengers only.
-
-		if recipient_type == ContributionRecipientType.Incumbent \
-			 and pledge.incumb_challgr == -1:
-			continue
-		if recipient_type == ContributionRecipientType.GeneralChallenger \
-			 and pledge.incumb_challgr == 1:
-			continue
-
-		# Filter by party.
-
-		if pledge.filter_party is not None and r.party != pledge.filter_party:
-			continue
-
-		# If we got here, then r is an acceptable recipient.
-		recipients.append( (action, recipient_type, r) )
-
-	return recipients
+				# Get the Recipient object.
+				r = incumbent
+				if not r:
+					if settings.DEBUG:
+						continue
+					raise Recipient.DoesNotExist("There is no recipient for " + str(action.actor) + " while executing " + error_descr(action) + ".")
+
+			else:
+				# The incumbent did something other than what the user wanted, so the
+				# challenger of the opposite party is the recipient.
+				#
+				# Use the Actor's current challenger at the time the index was loaded.
+				# That might be different from the challenger at the time the Trigger was
+				# executed.
+
+				# Get what sort of recipient this is.
+				recipient_type = ContributionRecipientType.GeneralChallenger
+
+				# Get the Recipient object.
+				r = challenger
+				if not r:
+					# We don't have a challenger Recipient associated. There should always
+					# be a challenger Recipient assigned.
+					if settings.DEBUG:
+						continue
+					raise Recipient.DoesNotExist(str(action.actor) + " has no challenger recipient assigned, while executing " + error_descr(action) + ".")
+
+			# The Recipient may not be currently taking contributions.
+			# This condition should be filtered out earlier in the creation
+			# of Action objects --- it should have a null outcome with
+			# explanation.
+
+			if not r.active:
+				raise ValueError("Recipient is inactive: %s => %s" % (action, r))
+
+			# Filter if the pledge is for incumbents or for challengers only.
+
+			if recipient_type == ContributionRecipientType.Incumbent \
+				 and pledge.incumb_challgr == -1:
+				continue
+			if recipient_type == ContributionRecipientType.GeneralChallenger \
+				 and pledge.incumb_challgr == 1:
+				continue
+
+			# Filter by party.
+
+			if pledge.filter_party is not None and r.party != pledge.filter_party:
+				continue
+
+			# If we got here, then r is an acceptable recipient.
+			recipients.append( (action, recipient_type, r) )
+
+		return recipients
+
+def get_pledge_recipients(pledge, recipient_index=None):
+	# Returns the list of (Action, ContributionRecipientType, Recipient) tuples
+	# that the pledge would be split across. When computing the recipients
+	# of many Pledges, pass the same PledgeRecipientIndex each time so that
+	# the Triggers' Actions are only loaded from the database once.
+	if recipient_index is None:
+		# For a single Pledge, look the recipients up in the TriggerExecution's
+		# stored recipient matrix and then load just those objects.
+		recipient_ids = get_pledge_recipient_ids(pledge)
+		if recipient_ids is not None:
+			from contrib.models import Action, Recipient
+			actions = Action.objects.select_related('actor', 'execution')\
+				.in_bulk(set(action_id for action_id, recipient_type, recipient_id in recipient_ids))
+			recipients = Recipient.objects\
+				.in_bulk(set(recipient_id for action_id, recipient_type, recipient_id in recipient_ids))
+			return [
+				(actions[action_id], recipient_type, recipients[recipient_id])
+				for action_id, recipient_type, recipient_id in recipient_ids
+			]
+
+		recipient_index = PledgeRecipientIndex()
+	return recipient_index.get_recipients(pledge)
+
+def get_recipient_matrix_key(desired_outcome, incumb_challgr, filter_party):
+	# The key into TriggerExecution.recipient_matrix for the recipients of
+	# pledges with the given options.
+	return "%d:%d:%s" % (desired_outcome, incumb_challgr, filter_party.name if filter_party else "")
+
+def build_recipient_matrix(trigger_execution):
+	# Every Pledge on a regular (not super-) Trigger has one of the Trigger's
+	# outcomes as its desired outcome, one of three incumbent/challenger
+	# choices, and one of three party filters (none, Democratic, Republican).
+	# For each combination, compute the Pledge recipients once and return them
+	# as a dict from get_recipient_matrix_key keys to lists of
+	# [action id, ContributionRecipientType value, recipient id].
+	#
+	# Returns None if the recipients can't be computed (e.g. a Recipient is
+	# missing or inactive), in which case pledges should not use a matrix
+	# and instead get the error from get_pledge_recipients.
+
+	from contrib.models import ActorParty, Pledge, Recipient
+
+	trigger = trigger_execution.trigger
+	index = PledgeRecipientIndex()
+	matrix = { }
+	try:
+		for desired_outcome in range(len(trigger.outcomes)):
+			for incumb_challgr in (-1, 0, 1):
+				for filter_party in (None, ActorParty.Democratic, ActorParty.Republican):
+					pledge = Pledge(trigger=trigger, desired_outcome=desired_outcome,
+						incumb_challgr=incumb_challgr, filter_party=filter_party)
+					matrix[get_recipient_matrix_key(desired_outcome, incumb_challgr, filter_party)] = [
+						[action.id, recipient_type.value, recipient.id]
+						for action, recipient_type, recipient
+						in index.get_recipients(pledge)
+					]
+	except (Recipient.DoesNotExist, ValueError):
+		return None
+	return matrix
+
+def get_pledge_recipient_ids(pledge, recipient_index=None):
+	# Returns the same recipients that get_pledge_recipients would, but
+	# as a list of (action id, ContributionRecipientType, recipient id)
+	# tuples and looked up from the stored recipient matrices of the
+	# TriggerExecutions. Returns None if a matrix isn't available, in
+	# which case use get_pledge_recipients. When looking up many Pledges,
+	# pass the same PledgeRecipientIndex each time so that each matrix is
+	# only loaded once.
+
+	from contrib.models import ContributionRecipientType
+
+	if pledge.incumb_challgr not in (-1, 0, 1):
+		return None
+
+	if recipient_index is None:
+		recipient_index = PledgeRecipientIndex()
+
+	desired_outcome = get_pledge_desired_outcomes(pledge)
+	recipients = []
+	for trigger_id, matrix in recipient_index.get_recipient_matrices(desired_outcome.keys()).items():
+		if matrix is None:
+			return None
+		key = get_recipient_matrix_key(desired_outcome[trigger_id], pledge.incumb_challgr, pledge.filter_party)
+		if key not in matrix:
+			return None
+		recipients.extend(matrix[key])
+
+	# Put in the same order as get_pledge_recipients.
+	recipients.sort(key = lambda entry : entry[0])
+
+	return [
+		(action_id, ContributionRecipientType(recipient_type), recipient_id)
+		for action_id, recipient_type, recipient_id in recipients
+	]
+
+def count_pledge_recipients(pledge, recipient_index=None):
+	# Returns the number of recipients the pledge would be split across
+	# if it were executed now, using the stored recipient matrices when
+	# possible so that no Actions need to be loaded.
+	recipients = get_pledge_recipient_ids(pledge, recipient_index=recipient_index)
+	if recipients is None:
+		recipients = get_pledge_recipients(pledge, recipient_index=recipient_index)
+	return len(recipients)
+
+def preview_charge(pledge, recipient_index=None):
+	# Returns a tuple of the number of recipients, the fees, and the total
+	# charge for the pledge if it were executed now. Returns (0, 0, 0) if
+	# the pledge's filters eliminate all recipients, since no charge would
+	# be made.
+	num_recipients = count_pledge_recipients(pledge, recipient_index=recipient_index)
+	if num_recipients == 0:
+		return (0, 0, 0)
+	recip_contrib, contrib_total, fees, total_charge = compute_charge_amounts(pledge, num_recipients)
+	return (num_recipients, fees, total_charge)
 
 def compute_charge(pledge, recipients):
 	# Return a tuple of:
@@ -288,40 +547,55 @@ def compute_charge(pledge, recipients):
 	#  * the fees line-item amount
 	#  * the total charge
 
+	recip_contrib, contrib_total, fees, total_charge = compute_charge_amounts(pledge, len(recipients))
+
+	# Make a list of line items.
+	recip_contribs = [(action, recipient_type, recipient, recip_contrib) for (action, recipient_type, recipient) in recipients]
+
+	# Return!
+	return (recip_contribs, fees, total_charge)
+
+def compute_charge_amounts(pledge, num_recipients):
+	# Return a tuple of:
+	#  * the amount of each recipient's line item
+	#  * the total of the recipient line items
+	#  * the fees line-item amount
+	#  * the total charge
+	# The amounts depend only on the pledge amount and the number
+	# of recipients, not on who the recipients are.
+
 	from contrib.models import Pledge
 
 	# What's the total amount of contributions after fess? The inputs
 	# here are all decimal.Decimal instances, so we are doing exact
 	# decimal math up to the default precision.
-	fees_fixed = Pledge.current_algorithm()['fees_fixed']
-	fees_percent = Pledge.current_algorithm()['fees_percent']
-	max_contrib = (pledge.amount - fees_fixed) / (1 + fees_percent)
+	alg = Pledge.current_algorithm()
+	fees_fixed = alg['fees_fixed']
+	fees_multiplier = alg['fees_multiplier']
+	max_contrib = (pledge.amount - fees_fixed) / fees_multiplier
 	if max_contrib < decimal.Decimal('0.01'):
 		raise HumanReadableValidationError("The amount is less than the minimum fees.")
 
 	# If we divide that evenly among the recipients, what is the ideal contribution?
 	# Round it down to the nearest cent because we can only make whole-cent contributions
 	# and contributions must be equal and the total must not exceed the original amount.
-	recip_contrib = max_contrib / len(recipients)
+	recip_contrib = max_contrib / num_recipients
 	recip_contrib = recip_contrib.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_DOWN)
 	if recip_contrib < decimal.Decimal('0.01'):
 		# The pledge amount was so small that we can't divide it.
 		# This should never happen because our minimum pledge is
 		# more than one cent for each potential recipient for a
 		# Trigger.
-		raise HumanReadableValidationError("The amount is not enough to divide evenly across %d recipients." % len(recipients))
-
-	# Make a list of line items.
-	recip_contribs = [(action, recipient_type, recipient, recip_contrib) for (action, recipient_type, recipient) in recipients]
+		raise HumanReadableValidationError("The amount is not enough to divide evenly across %d recipients." % num_recipients)
 
 	# Multiply out to create the total before fees.
-	contrib_total = len(recipients) * recip_contrib
+	contrib_total = num_recipients * recip_contrib
 
 	# Compute the total with fees. Rather than computing the fees first
 	# and hoping the total is under the original pledge amount (the
 	# maximum), compute the total, round, clip at the ceiling, and then
 	# work backwards to the fees.
-	total_charge = contrib_total * (1 + fees_percent) + fees_fixed
+	total_charge = contrib_total * fees_multiplier + fees_fixed
 
 	# Round to the nearest cent, then ensure we haven't exeeded maximum.
 	total_charge = total_charge.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_HALF_EVEN)
@@ -331,8 +605,69 @@ def compute_charge(pledge, recipients):
 	# Fees are the difference between the total and the contributions.
 	fees = total_charge - contrib_total
 
-	# Return!
-	return (recip_contribs, fees, total_charge)
+	return (recip_contrib, contrib_total, fees, total_charge)
+
+def compute_charges(pledges, recipient_counts):
+	# A vectorized compute_charge_amounts for many pledges at once, for
+	# previews. Given a list of pledges and a list of how many recipients
+	# each would be split across, returns a list of the same tuples that
+	# compute_charge_amounts returns for each pledge, or None where
+	# compute_charge_amounts would raise an exception (or there are no
+	# recipients).
+	#
+	# The computation is done in integer cents with exactly the same
+	# rounding as compute_charge_amounts's exact decimal math. Writing
+	# A for the pledge amount and F for the fixed fee, in cents, n for the
+	# number of recipients, and num/den for the fee multiplier (1 + fees_percent)
+	# as a reduced fraction:
+	#   * the pledge is too small to cover the fees if (A - F) * den < num
+	#   * the per-recipient amount is floor((A - F) * den / (num * n)), i.e. ROUND_DOWN
+	#   * with T the contributions total, the total charge is T * num / den rounded
+	#     to the nearest cent with ties to even (ROUND_HALF_EVEN), plus F, and
+	#     then clipped at A.
+
+	import fractions
+	import numpy
+	from contrib.models import Pledge
+
+	alg = Pledge.current_algorithm()
+	fees_multiplier = fractions.Fraction(alg['fees_multiplier'])
+	num, den = fees_multiplier.numerator, fees_multiplier.denominator
+	fees_fixed = fractions.Fraction(alg['fees_fixed']) * 100
+	if fees_fixed.denominator != 1: raise ValueError("fees_fixed is not a whole number of cents")
+	fees_fixed = int(fees_fixed)
+
+	def to_cents(value):
+		cents = fractions.Fraction(value) * 100
+		if cents.denominator != 1: raise ValueError("Pledge amount %s is not a whole number of cents." % value)
+		return int(cents)
+
+	amounts = numpy.array([to_cents(p.amount) for p in pledges], dtype=numpy.int64)
+	counts = numpy.array(recipient_counts, dtype=numpy.int64)
+
+	# Per-recipient amounts, rounded down.
+	available = (amounts - fees_fixed) * den
+	recip_contrib = numpy.floor_divide(available, num * numpy.maximum(counts, 1))
+	valid = (counts > 0) & (available >= num) & (recip_contrib >= 1)
+
+	# Total before fees.
+	contrib_total = recip_contrib * counts
+
+	# Total with fees, rounded half-even, then clipped.
+	q, r = numpy.divmod(contrib_total * num, den)
+	q += (2*r > den) | ((2*r == den) & (q % 2 == 1))
+	total_charge = numpy.minimum(q + fees_fixed, amounts)
+
+	# Fees are the difference between the total and the contributions.
+	fees = total_charge - contrib_total
+
+	# Convert back to Decimals in dollars.
+	def to_dollars(cents):
+		return decimal.Decimal(int(cents)).scaleb(-2)
+	return [
+		tuple(to_dollars(v) for v in values) if is_valid else None
+		for is_valid, values in zip(valid, zip(recip_contrib, contrib_total, fees, total_charge))
+	]
 
 def create_pledge_donation(pledge, recipients):
 	# Pledge execution --- make a credit card charge and return
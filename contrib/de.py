@@ -1,6 +1,9 @@
 import decimal
 import json
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 class HumanReadableValidationError(Exception):
@@ -8,8 +11,11 @@ class HumanReadableValidationError(Exception):
 
 class DemocracyEngineAPIClient(object):
 	de_meta_info = None
+	de_meta_info_fetched = None
 
-	def __init__(self, api_baseurl, account_number, username, password, fees_recipient_id):
+	def __init__(self, api_baseurl, account_number, username, password, fees_recipient_id,
+		pool_size=10, timeout=60, live_timeout=20, connect_timeout=None,
+		meta_info_cache=None, meta_info_ttl=60*60*24):
 		self.api_baseurl = api_baseurl
 		self.account_number = account_number
 		self.username = username
@@ -17,39 +23,134 @@ class DemocracyEngineAPIClient(object):
 		self.fees_recipient_id = fees_recipient_id
 		self.debug = False
 
-	def __call__(self, method, post_data=None, argument=None, live_request=False, http_method=None):
-
-		# Cache meta info. If method is None, don't infinite recurse.
-		if (self.de_meta_info == None) and (method is not None):
-			self.de_meta_info = self(None, None, live_request=live_request)
+		# Timeouts in seconds. timeout is for background requests and live_timeout
+		# is for requests made while a user is waiting. If connect_timeout is None,
+		# the same timeout is used for connecting as for reading the response.
+		self.timeout = timeout
+		self.live_timeout = live_timeout
+		self.connect_timeout = connect_timeout
+
+		# Keep open connections to Democracy Engine in a pool so that each call
+		# doesn't pay for a new TLS connection. The adapter's connection pool is
+		# thread-safe and shared by all threads, but a requests.Session isn't
+		# guaranteed to be, so each thread gets its own Session that uses the
+		# shared adapter (see get_session). pool_size is the most connections
+		# kept open at once.
+		self.http_adapter = HTTPAdapter(pool_maxsize=pool_size)
+		self.thread_local = threading.local()
+
+		# The subscriber meta info, which gives the URLs of the other API methods,
+		# is kept in meta_info_cache (a Django cache, or anything with get and set
+		# methods) so that it is shared across processes. After meta_info_ttl
+		# seconds, it is refreshed in a background thread while the old copy
+		# continues to be used.
+		self.meta_info_cache = meta_info_cache
+		self.meta_info_cache_key = "de_meta_info:%s:%s" % (api_baseurl, account_number)
+		self.meta_info_ttl = meta_info_ttl
+		self.meta_info_lock = threading.Lock()
+		self.meta_info_refreshing = False
+
+	def get_session(self):
+		# Return this thread's requests.Session, which sends requests through
+		# the shared connection pool.
+		session = getattr(self.thread_local, "session", None)
+		if session is None:
+			session = requests.Session()
+			session.auth = HTTPBasicAuth(self.username, self.password)
+			session.mount("https://", self.http_adapter)
+			session.mount("http://", self.http_adapter)
+			self.thread_local.session = session
+		return session
+
+	def get_meta_info(self, live_request=False):
+		# Return the subscriber meta info. Use the copy on this instance,
+		# or else the copy in the cache, or else fetch it.
+		if self.de_meta_info is None:
+			self.load_cached_meta_info()
+		if self.de_meta_info is None:
+			self.refresh_meta_info(live_request=live_request)
+		elif time.time() - self.de_meta_info_fetched > self.meta_info_ttl:
+			self.refresh_meta_info_in_background()
+		return self.de_meta_info
+
+	def load_cached_meta_info(self):
+		# Load the meta info from the cache, if it's there.
+		if self.meta_info_cache is None:
+			return
+		cached = self.meta_info_cache.get(self.meta_info_cache_key)
+		if cached is not None:
+			self.de_meta_info, self.de_meta_info_fetched = cached
+
+	def refresh_meta_info(self, live_request=False):
+		# Fetch the meta info and store it here and in the cache. The cache
+		# entry doesn't expire so that a stale copy is always available.
+		meta_info = self(None, None, live_request=live_request)
+		self.de_meta_info, self.de_meta_info_fetched = meta_info, time.time()
+		if self.meta_info_cache is not None:
+			self.meta_info_cache.set(self.meta_info_cache_key, (self.de_meta_info, self.de_meta_info_fetched), None)
+
+	def refresh_meta_info_in_background(self):
+		# Start a thread to refresh the meta info, unless one is already running.
+		with self.meta_info_lock:
+			if self.meta_info_refreshing:
+				return
+			self.meta_info_refreshing = True
+
+		def refresh():
+			try:
+				# Another process may have refreshed it already.
+				self.load_cached_meta_info()
+				if time.time() - self.de_meta_info_fetched > self.meta_info_ttl:
+					self.refresh_meta_info()
+			except Exception:
+				pass # keep using the stale copy, and try again on the next call
+			finally:
+				self.meta_info_refreshing = False
+
+		thread = threading.Thread(target=refresh)
+		thread.daemon = True
+		thread.start()
+
+	def warm_up(self):
+		# Load the meta info now so that it's not fetched on the latency
+		# path of the first real call.
+		self.get_meta_info()
+
+	def __call__(self, method, post_data=None, argument=None, live_request=False, http_method=None, params=None):
 
 		if method is None:
 			# This is an internal call to get the meta subscriber info.
 			url = self.api_baseurl + ('/subscribers/%s.json' % self.account_number)
 		elif method == "META":
 			# This is a real call to get the meta info, which is always cached.
-			return self.de_meta_info
+			return self.get_meta_info(live_request=live_request)
 		else:
 			# Get the correct URL from the meta info, and do argument substitution
 			# if necessary.
-			url = self.de_meta_info[method + "_uri"]
+			url = self.get_meta_info(live_request=live_request)[method + "_uri"]
 			if argument:
 				import urllib.parse
 				url = url.replace(":"+argument[0], urllib.parse.quote(argument[1]))
 
 		# GET or POST?
+		session = self.get_session()
 		if post_data == None:
 			payload = None
 			headers = None
-			urlopen = requests.get
+			urlopen = session.get
 		else:
 			payload = json.dumps(post_data)
 			headers = {'content-type': 'application/json'}
-			urlopen = requests.post
+			urlopen = session.post
 
 		# Override HTTP method.
 		if http_method:
-			urlopen = getattr(requests, http_method)
+			urlopen = getattr(session, http_method)
+
+		# Timeout.
+		timeout = self.timeout if not live_request else self.live_timeout
+		if self.connect_timeout is not None:
+			timeout = (self.connect_timeout, timeout)
 
 		# Log requests. Definitely don't do this in production since we'll
 		# have sensitive data here!
@@ -62,10 +163,10 @@ class DemocracyEngineAPIClient(object):
 		# issue request
 		r = urlopen(
 			url,
-			auth=HTTPBasicAuth(self.username, self.password),
+			params=params, # query string
 			data=payload,
 			headers=headers,
-			timeout=60 if not live_request else 20,
+			timeout=timeout,
 			verify=True, # check SSL cert (is default, actually)
 			)
 
@@ -123,6 +224,37 @@ class DemocracyEngineAPIClient(object):
 	def donations(self, live_request=False):
 		return self(method="donations", live_request=live_request)
 
+	def get_donations_page(self, page, page_size, live_request=False):
+		return self(method="donations", params={ "page": page, "per_page": page_size }, live_request=live_request)
+
+	def iter_donation_pages(self, page_size=100, max_pages=None, live_request=False):
+		# Generate lists of donations, one page of results at a time,
+		# so that the whole history isn't held in memory at once. Stop
+		# after max_pages pages, if given, and if DE returns the same
+		# page twice in a row (i.e. it ignored the page parameter),
+		# since otherwise we would loop forever.
+		page = 1
+		prev_ids = None
+		while True:
+			donations = self.get_donations_page(page, page_size, live_request=live_request)
+			if len(donations) == 0:
+				return
+			ids = [don["donation_id"] for don in donations]
+			if ids == prev_ids:
+				return
+			yield donations
+			if len(donations) < page_size:
+				return # last page
+			if max_pages is not None and page >= max_pages:
+				return
+			prev_ids = ids
+			page += 1
+
+	def iter_donations(self, page_size=100, live_request=False):
+		# Generate donations, fetching them a page at a time.
+		for donations in self.iter_donation_pages(page_size=page_size, live_request=live_request):
+			yield from donations
+
 	def get_donation(self, id, live_request=False):
 		return self(method="donation", argument=('donation_id', id), live_request=live_request)
 
@@ -155,6 +287,94 @@ class DemocracyEngineAPIClient(object):
 		return "$%s.%s" % (''.join(digits[:-2]), ''.join(digits[-2:]))
 
 
+class RateLimiter(object):
+	"""A token bucket that lets calls start at most per_second times a second, in bursts of at most burst calls."""
+
+	def __init__(self, per_second, burst=1):
+		self.per_second = per_second
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def wait(self):
+		# Block until a call may start. The bucket refills continuously.
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_second)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				delay = (1 - self.tokens) / self.per_second
+			time.sleep(delay)
+
+
+class ConcurrentDemocracyEngineAPIClient(object):
+	"""Makes calls through a DemocracyEngineAPIClient from a pool of threads, so that a batch job can keep many calls in flight at once."""
+
+	# At most max_concurrency calls are in flight at once, and if
+	# max_per_second is set, calls start no more often than that. The
+	# methods return a concurrent.futures.Future for the result of the
+	# call on the wrapped client. (asyncio code can await one after
+	# wrapping it with asyncio.wrap_future.) The wrapped client shares its
+	# connection pool across threads, so its pool_size should be at least
+	# max_concurrency.
+
+	def __init__(self, client, max_concurrency=10, max_per_second=None):
+		from concurrent.futures import ThreadPoolExecutor
+		self.client = client
+		self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+		self.rate_limiter = RateLimiter(max_per_second) if max_per_second else None
+
+	def call(self, method, *args, **kwargs):
+		# Queue a call to a method of the wrapped client.
+		return self.executor.submit(self.run_call, method, args, kwargs)
+
+	def run_call(self, method, args, kwargs):
+		# Runs in a pool thread. Waiting for the rate limit here, rather
+		# than before queueing, keeps call from blocking.
+		if self.rate_limiter:
+			self.rate_limiter.wait()
+		return getattr(self.client, method)(*args, **kwargs)
+
+	def create_donation(self, info):
+		return self.call("create_donation", info)
+
+	def get_donation(self, id, live_request=False):
+		return self.call("get_donation", id, live_request=live_request)
+
+	def donations(self, live_request=False):
+		return self.call("donations", live_request=live_request)
+
+	def get_transaction(self, id, live_request=False):
+		return self.call("get_transaction", id, live_request=live_request)
+
+	def void_transaction(self, id):
+		return self.call("void_transaction", id)
+
+	def credit_transaction(self, id):
+		return self.call("credit_transaction", id)
+
+	def run_all(self, calls):
+		# Make a list of (method name, args) calls concurrently, subject to
+		# the limits, and return the results in the same order. Exceptions
+		# are returned in place of results rather than raised.
+		futures = [self.call(method, *args) for method, args in calls]
+		results = []
+		for future in futures:
+			try:
+				results.append(future.result())
+			except Exception as e:
+				results.append(e)
+		return results
+
+	def close(self):
+		# Wait for queued calls to finish and stop the threads.
+		self.executor.shutdown()
+
+
 class DummyDemocracyEngineAPIClient(object):
 	"""A stand-in for the DE API for unit tests."""
 
@@ -162,7 +382,38 @@ class DummyDemocracyEngineAPIClient(object):
 
 	issued_tokens = set()
 
+	def __init__(self, http=False, **client_options):
+		# With http=True, start a local HTTP server that answers like this
+		# class would and send calls to it through a real DemocracyEngineAPIClient
+		# (with client_options passed to its constructor). That exercises the
+		# HTTP side of the client, e.g. connection pooling, without reaching
+		# Democracy Engine, so it can be benchmarked offline.
+		self.server = None
+		self.client = None
+		self.donation_records = [] # what donations() returns, newest first
+		if http:
+			self.server = DummyDemocracyEngineServer(self)
+			self.client = DemocracyEngineAPIClient(
+				self.server.url, DummyDemocracyEngineServer.ACCOUNT_NUMBER, "dummy", "dummy",
+				self.fees_recipient_id, **client_options)
+
+	def warm_up(self):
+		if self.client:
+			self.client.warm_up()
+
+	def close(self):
+		# Stop the local HTTP server, if running.
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
 	def create_donation(self, info):
+		if self.client:
+			return self.client.create_donation(info)
+		return self.process_donation(info)
+
+	def process_donation(self, info):
 		if info.get('token_request'):
 			import random, hashlib
 			token = hashlib.md5(str(random.random()).encode('ascii')).hexdigest()
@@ -178,8 +429,95 @@ class DummyDemocracyEngineAPIClient(object):
 				"dummy_response": True,
 			}
 
+	def donations(self, live_request=False):
+		if self.client:
+			return self.client.donations(live_request=live_request)
+		return list(self.donation_records)
+
+	def get_donations_page(self, page, page_size, live_request=False):
+		if self.client:
+			return self.client.get_donations_page(page, page_size, live_request=live_request)
+		return self.donation_records[(page-1)*page_size:page*page_size]
+
+	iter_donation_pages = DemocracyEngineAPIClient.iter_donation_pages
+
 	@staticmethod
 	def format_decimal(value):
 		return DemocracyEngineAPIClient.format_decimal(value)
-		
 
+
+import http.server, socketserver
+
+class DummyDemocracyEngineServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	"""A local HTTP server that stands in for the DE API, answering for a DummyDemocracyEngineAPIClient."""
+
+	ACCOUNT_NUMBER = "DUMMY_ACCOUNT"
+
+	daemon_threads = True
+
+	def __init__(self, dummy):
+		self.dummy = dummy
+		super(DummyDemocracyEngineServer, self).__init__(("127.0.0.1", 0), DummyDemocracyEngineRequestHandler)
+		self.url = "http://127.0.0.1:%d" % self.server_address[1]
+
+		# Serve in a background thread.
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def get_meta_info(self):
+		# The URI templates that DemocracyEngineAPIClient looks up by method name.
+		return {
+			"recipients_uri": self.url + "/recipients.json",
+			"recipient_uri": self.url + "/recipients/:recipient_id.json",
+			"transactions_uri": self.url + "/transactions.json",
+			"transaction_uri": self.url + "/transactions/:transaction_id.json",
+			"transaction_void_uri": self.url + "/transactions/:transaction_id/void.json",
+			"transaction_credit_uri": self.url + "/transactions/:transaction_id/credit.json",
+			"donations_uri": self.url + "/donations.json",
+			"donation_uri": self.url + "/donations/:donation_id.json",
+			"donation_process_uri": self.url + "/donations/process.json",
+		}
+
+class DummyDemocracyEngineRequestHandler(http.server.BaseHTTPRequestHandler):
+	# HTTP/1.1 so that the client can keep its connections open.
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass # don't clutter the console
+
+	def send_json(self, status, data):
+		body = json.dumps(data).encode("utf8") if data is not None else b""
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		path = self.path.split("?")[0]
+		if path == "/subscribers/%s.json" % DummyDemocracyEngineServer.ACCOUNT_NUMBER:
+			self.send_json(200, self.server.get_meta_info())
+		elif path == "/donations.json":
+			from urllib.parse import urlparse, parse_qs
+			qs = parse_qs(urlparse(self.path).query)
+			donations = self.server.dummy.donation_records
+			if "page" in qs:
+				page, page_size = int(qs["page"][0]), int(qs["per_page"][0])
+				donations = donations[(page-1)*page_size:page*page_size]
+			self.send_json(200, donations)
+		elif path in ("/recipients.json", "/transactions.json"):
+			self.send_json(200, [])
+		else:
+			self.send_json(200, { "dummy_response": True })
+
+	def do_POST(self):
+		info = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf8"))
+		try:
+			self.send_json(200, self.server.dummy.process_donation(info["donation"]))
+		except Exception as e:
+			self.send_json(422, { "base": [str(e)] })
+
+	def do_PUT(self):
+		self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		self.send_json(200, None)
@@ -0,0 +1,46 @@
+# Benchmarks the Democracy Engine API client offline
+# --------------------------------------------------
+
+from django.core.management.base import BaseCommand, CommandError
+
+import time
+
+from contrib.de import DummyDemocracyEngineAPIClient, ConcurrentDemocracyEngineAPIClient
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Benchmarks the Democracy Engine API client against a local stand-in server.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--requests', type=int, default=500, help='The number of API calls to make.')
+		parser.add_argument('--threads', type=int, default=8, help='The number of threads making calls concurrently.')
+		parser.add_argument('--pool-size', type=int, default=10, help='The number of connections the client keeps open.')
+		parser.add_argument('--max-per-second', type=float, help='The most calls to start each second.')
+
+	def handle(self, *args, **options):
+		if options['threads'] < 1 or options['pool_size'] < 1:
+			raise CommandError("--threads and --pool-size must be at least 1.")
+
+		api = DummyDemocracyEngineAPIClient(http=True, pool_size=options['pool_size'])
+		try:
+			# Make an initial call so that the subscriber meta info is loaded
+			# before timing.
+			api.create_donation({ "token_request": True })
+
+			concurrent_api = ConcurrentDemocracyEngineAPIClient(api.client,
+				max_concurrency=options['threads'], max_per_second=options['max_per_second'])
+			start = time.time()
+			try:
+				results = concurrent_api.run_all([("create_donation", ({ "token_request": True },))] * options['requests'])
+			finally:
+				concurrent_api.close()
+			elapsed = time.time() - start
+			errors = [r for r in results if isinstance(r, Exception)]
+			if errors:
+				raise CommandError("%d calls failed, e.g.: %s" % (len(errors), errors[0]))
+		finally:
+			api.close()
+
+		print("%d calls with %d threads and a pool of %d connections in %0.2f seconds (%0.1f calls/sec)" % (
+			options['requests'], options['threads'], options['pool_size'], elapsed,
+			(options['requests']/elapsed) if elapsed else 0))
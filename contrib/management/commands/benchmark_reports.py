@@ -0,0 +1,150 @@
+# Benchmarks the contribution totals reports
+# ------------------------------------------
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+import time
+import random
+import decimal
+import itertools
+
+from contrib.models import TriggerType, Trigger, TriggerStatus, TriggerExecution, TextFormat, \
+	Actor, ActorParty, Action, Recipient, ContributorInfo, Pledge, PledgeExecution, \
+	Contribution, ContributionRecipientType
+from contrib.reporting import fetch_report_data, fetch_report_data_by_queries
+
+class Rollback(Exception):
+	pass
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Compares the single-pass totals report to the query-per-rollup report on a synthetic dataset, which is rolled back afterwards.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--contributions', type=int, default=1000000, help='The number of synthetic contributions to create.')
+		parser.add_argument('--contributions-per-pledge', type=int, default=20, help='The number of contributions made by each synthetic pledge.')
+		parser.add_argument('--actors', type=int, default=535, help='The number of synthetic actors.')
+
+	def handle(self, *args, **options):
+		if options['contributions_per_pledge'] < 1 or options['actors'] < options['contributions_per_pledge']:
+			raise CommandError("--contributions-per-pledge must be at least 1 and at most --actors.")
+
+		# Everything happens in a transaction that is rolled back at
+		# the end so that the synthetic data is never committed.
+		try:
+			with transaction.atomic():
+				start = time.time()
+				trigger = self.create_dataset(options)
+				print("Created %d contributions in %0.1f seconds." % (
+					trigger.execution.num_contributions, time.time() - start))
+
+				for slice_name, slice_trigger in (("all contributions", None), ("one trigger", trigger)):
+					reports = []
+					for method_name, method in (("query per rollup", fetch_report_data_by_queries), ("single pass", fetch_report_data)):
+						start = time.time()
+						reports.append(method(slice_trigger, None))
+						print("%s, %s: %0.2f seconds" % (slice_name, method_name, time.time() - start))
+					self.compare_reports(*reports)
+
+				raise Rollback()
+		except Rollback:
+			pass
+
+	def compare_reports(self, expected, report):
+		# Groups with equal totals may come back in either order, so sort them
+		# the same way before comparing.
+		for (key, group) in (("by_recipient_type", "recipient_type"), ("by_party", "party")):
+			expected[key].sort(key = lambda item : str(item[group]))
+			report[key].sort(key = lambda item : str(item[group]))
+		if report != expected:
+			for key in sorted(set(expected) | set(report)):
+				if expected.get(key) != report.get(key):
+					print("The reports do not match on %s:" % key, expected.get(key), report.get(key))
+
+	def create_dataset(self, options):
+		num_pledges = options['contributions'] // options['contributions_per_pledge']
+		now = timezone.now()
+
+		# A trigger and its execution.
+		trigger = Trigger.objects.create(
+			key="benchmark-reports",
+			title="Benchmark Trigger",
+			trigger_type=TriggerType.objects.create(key="benchmark-reports", title="Benchmark", extra={}),
+			description="This is a synthetic trigger.",
+			description_format=TextFormat.Markdown,
+			status=TriggerStatus.Executed,
+			outcomes=[{ "label": "Yes" }, { "label": "No" }],
+			extra={},
+			pledge_count=num_pledges,
+			)
+		te = TriggerExecution.objects.create(
+			trigger=trigger,
+			action_time=now,
+			cycle=now.year + (now.year % 2),
+			description="Contributions are being distributed to synthetic recipients.",
+			description_format=TextFormat.Markdown,
+			pledge_count=num_pledges,
+			pledge_count_with_contribs=num_pledges,
+			num_contributions=num_pledges * options['contributions_per_pledge'],
+			extra={},
+			)
+
+		# Actors, their challengers, and their actions. The IDs are offset
+		# so they do not collide with real records.
+		parties = (ActorParty.Democratic, ActorParty.Republican)
+		Recipient.objects.bulk_create(
+			Recipient(de_id="benchmark-c%d" % i, office_sought="BM-%d" % i, party=parties[i % 2].opposite())
+			for i in range(options['actors']))
+		challengers = list(Recipient.objects.filter(de_id__startswith="benchmark-c").order_by('id'))
+		Actor.objects.bulk_create(
+			Actor(govtrack_id=900000000+i, name_long="Actor %d" % i, name_short="Actor %d" % i, name_sort="Actor %d" % i,
+				party=parties[i % 2], title="Synthetic Actor", extra={}, challenger=challengers[i])
+			for i in range(options['actors']))
+		actors = list(Actor.objects.filter(govtrack_id__gte=900000000).order_by('govtrack_id'))
+		Recipient.objects.bulk_create(
+			Recipient(de_id="benchmark-p%d" % i, actor=actor)
+			for i, actor in enumerate(actors))
+		incumbents = list(Recipient.objects.filter(de_id__startswith="benchmark-p").order_by('id'))
+		Action.objects.bulk_create(
+			Action(execution=te, action_time=now, actor=actor, outcome=i % 2,
+				name_long=actor.name_long, name_short=actor.name_short, name_sort=actor.name_sort,
+				party=actor.party, title=actor.title, extra={}, challenger=actor.challenger)
+			for i, actor in enumerate(actors))
+		actions = list(Action.objects.filter(execution=te).order_by('id'))
+
+		# Pledges and their executions, sharing one profile.
+		profile = ContributorInfo.objects.create(extra={})
+		Pledge.objects.bulk_create((
+			Pledge(trigger=trigger, profile=profile, desired_outcome=random.randint(0, 1),
+				amount=decimal.Decimal(random.randint(500, 50000)) / 100, incumb_challgr=0, extra={})
+			for i in range(num_pledges)), batch_size=5000)
+		pledges = list(Pledge.objects.filter(trigger=trigger).order_by('id').values_list('id', flat=True))
+		PledgeExecution.objects.bulk_create((
+			PledgeExecution(pledge_id=pledge_id, trigger_execution=te, charged=0, fees=0, extra={})
+			for pledge_id in pledges), batch_size=5000)
+		executions = PledgeExecution.objects.filter(trigger_execution=te).order_by('id').values_list('id', 'pledge__desired_outcome')
+
+		# Contributions, each to a random selection of the actions.
+		def make_contributions():
+			for (execution_id, desired_outcome) in executions.iterator():
+				for i in random.sample(range(len(actions)), options['contributions_per_pledge']):
+					incumbent = (actions[i].outcome == desired_outcome)
+					yield Contribution(
+						pledge_execution_id=execution_id,
+						action=actions[i],
+						recipient_type=ContributionRecipientType.Incumbent if incumbent else ContributionRecipientType.GeneralChallenger,
+						recipient=incumbents[i] if incumbent else challengers[i],
+						amount=decimal.Decimal(random.randint(1, 500)) / 100,
+						de_id="benchmark",
+						extra={})
+		# (bulk_create would hold them all in memory at once, so insert them
+		# in chunks.)
+		contributions = make_contributions()
+		while True:
+			batch = list(itertools.islice(contributions, 5000))
+			if len(batch) == 0: break
+			Contribution.objects.bulk_create(batch)
+
+		return trigger
@@ -3,105 +3,273 @@
 
 from decimal import Decimal
 from collections import defaultdict
+import hashlib, json
 
 from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
 
 import rtyaml
 
-from contrib.models import Pledge, PledgeStatus, PledgeExecutionProblem
+from contrib.models import Pledge, PledgeStatus, PledgeExecutionProblem, ReconciliationCursor, ReconciliationVerdict
 from contrib.bizlogic import DemocracyEngineAPI
 
 class Command(BaseCommand):
 	args = ''
 	help = 'Reports reconciliation issues between our records and Democracy Engine.'
 
+	def add_arguments(self, parser):
+		parser.add_argument('--stream', action='store_true', default=False,
+			help='Fetch the donations a page at a time rather than in one big response, keeping only the fields that are checked. (Runs after the first are incremental and always fetch a page at a time, unless --full is given.)')
+		parser.add_argument('--page-size', type=int, default=100,
+			help='The number of donations per page when fetching a page at a time.')
+		parser.add_argument('--max-pages', type=int,
+			help='Stop after this many pages when fetching a page at a time.')
+		parser.add_argument('--full', action='store_true', default=False,
+			help='Re-check everything, not just the donations and pledges that changed since the last run.')
+
 	def handle(self, *args, **options):
-		# Get recent donations from DE.
-		donations = DemocracyEngineAPI.donations()
+		# Load where the last run left off. Pledges whose donation records and
+		# state are unchanged since they last reconciled are skipped. Unless
+		# --full is given, in which case we re-check everything.
+		self.cursor, _ = ReconciliationCursor.objects.get_or_create(name="de_reconcile")
+		self.full = options['full']
+		self.checked = 0
+		self.skipped = 0
+		self.newest_donation = None
 
-		# Process each.
-		pledge_donations = defaultdict(lambda : [])
-		for don in donations:
-			self.process_donation(don, pledge_donations)
+		# Get recent donations from DE, either as one big list or a page at a time.
+		# An incremental run fetches a page at a time so that it can stop at the
+		# donations that were reconciled in the last run, rather than fetching
+		# DE's entire history.
+		incremental = not self.full and self.cursor.last_donation_created_at is not None
+		if options['stream'] or incremental:
+			pages = DemocracyEngineAPI.iter_donation_pages(page_size=options['page_size'], max_pages=options['max_pages'])
+		else:
+			pages = [DemocracyEngineAPI.donations()]
+
+		# Collect the donations by the pledge they are for. A pledge's donations
+		# may be split across pages, so each pledge is checked once, after all
+		# of the pages are fetched, against all of its donations. Only the
+		# fields that the checks look at are kept (see compact_donation), so
+		# this takes much less memory than DE's full donation records.
+		self.pledge_donations = defaultdict(lambda : [])
+		self.unsettled_pledges = set()
+		for donations in pages:
+			page_pledges = self.add_page(donations)
+			if incremental and self.is_reconciled_page(donations, page_pledges):
+				break
+
+		# Check the pledges, in batches.
+		self.reconciled_pledges = set()
+		pledge_ids = sorted(self.pledge_donations)
+		for i in range(0, len(pledge_ids), 500):
+			self.check_pledges(pledge_ids[i:i+500])
+
+		# Save the checkpoint.
+		if self.newest_donation and (self.cursor.last_donation_created_at is None or self.newest_donation[0] > self.cursor.last_donation_created_at):
+			self.cursor.last_donation_created_at, self.cursor.last_donation_id = self.newest_donation
+		self.cursor.save()
+		print(self.checked, "pledge(s) checked,", self.skipped, "skipped (unchanged since they last reconciled).")
+
+		if len(self.reconciled_pledges) == 0:
+			print("No donations.")
+			return
 
 		# Any executed pledges missing from the apparent range of donations DE is returning?
-		first_pledge = min(pledge_donations, key = lambda p : p.id)
-		last_pledge = max(pledge_donations, key = lambda p : p.id)
+		first_pledge, last_pledge = (
+			Pledge.objects.get(id=min(self.reconciled_pledges)),
+			Pledge.objects.get(id=max(self.reconciled_pledges)))
 		print("Reconciliation between pledge", first_pledge.id, first_pledge.created, "and", last_pledge.id, last_pledge.created, ".")
-		for i in range(first_pledge.id+1, last_pledge.id):
-			# Get a pledge for each ID in the range of pledges DE is reporting for us.
-			# Only get executed pledges, and exclude executed pledges with client-side problems
-			# (i.e. skip ones that never went to DE).
-			# A pledge may not exist for every id, since a pledge may be canceled (=>deleted).
-			p = Pledge.objects\
-				.filter(id=i, status=PledgeStatus.Executed)\
-				.exclude(execution__problem__in=(PledgeExecutionProblem.EmailUnconfirmed, PledgeExecutionProblem.FiltersExcludedAll))\
-				.first()
-			if p:
-				# This pledge exists. Do we have a donation record for it?
-				if not p in pledge_donations:
-					print("No transaction for", p.id, p)
 
+		# Get the executed pledges in the range of pledges DE is reporting for us,
+		# excluding executed pledges with client-side problems (i.e. skip ones
+		# that never went to DE). Those that we haven't seen a donation for are
+		# missing.
+		executed_pledges = Pledge.objects\
+			.filter(id__gt=first_pledge.id, id__lt=last_pledge.id, status=PledgeStatus.Executed)\
+			.exclude(execution__problem__in=(PledgeExecutionProblem.EmailUnconfirmed, PledgeExecutionProblem.FiltersExcludedAll))\
+			.values_list('id', flat=True)
+		missing = set(executed_pledges) - self.reconciled_pledges
+		for p in sorted(Pledge.objects.in_bulk(missing).values(), key = lambda p : p.id):
+			print("No transaction for", p.id, p)
+
+	@staticmethod
+	def get_created_at(don):
+		return parse_datetime(don["created_at"])
+
+	@staticmethod
+	def compact_donation(don):
+		# Keep just the fields of a donation that the checks look at.
+		line_item = don["line_items"][0]
+		return {
+			"donation_id": don["donation_id"],
+			"created_at": don["created_at"],
+			"line_items": [{
+				k: line_item[k]
+				for k in ("status", "transaction_amount", "transaction_error", "transaction_guid") }],
+		}
+
+	def add_page(self, donations):
+		# Add a page of donations and return the IDs of the pledges they are for.
+		page_pledges = set()
+		for don in donations:
+			# Track the newest donation for the checkpoint.
+			created_at = self.get_created_at(don)
+			if created_at is not None and (self.newest_donation is None or created_at > self.newest_donation[0]):
+				self.newest_donation = (created_at, str(don["donation_id"]))
+
+			pledge_id = self.process_donation(don)
+			if pledge_id is not None:
+				self.pledge_donations[pledge_id].append(self.compact_donation(don))
+				page_pledges.add(pledge_id)
+		return page_pledges
+
+	def is_reconciled_page(self, donations, page_pledges):
+		# Democracy Engine lists donations newest first. In incremental mode, stop
+		# fetching pages once we reach a page whose donations all precede the
+		# newest donation reconciled in the last run (or that has only
+		# authorization tests), and the donations of every pledge we've seen that
+		# reconciled before are unchanged since then. A pledge whose donations
+		# seen so far don't match the last time it reconciled may have more
+		# donations on later pages, so we keep going. (Changes to older
+		# donations that aren't on the pages we fetch, like a void, need a
+		# --full run to see.)
+		pledges = Pledge.objects.select_related('execution').in_bulk(page_pledges)
+		verdicts = dict(ReconciliationVerdict.objects.filter(pledge_id__in=pledges.keys()).values_list('pledge_id', 'fingerprint'))
+		for pledge_id, p in pledges.items():
+			if pledge_id in verdicts and verdicts[pledge_id] != self.get_fingerprint(p, self.pledge_donations[pledge_id]):
+				self.unsettled_pledges.add(pledge_id)
+			else:
+				self.unsettled_pledges.discard(pledge_id)
+		return len(self.unsettled_pledges) == 0 \
+			and all(self.get_created_at(don) is not None and self.get_created_at(don) <= self.cursor.last_donation_created_at
+			        for don in donations)
+
+	def check_pledges(self, pledge_ids):
+		# Load the pledges, and their verdicts from past runs, at once.
+		pledges = Pledge.objects.select_related('execution').in_bulk(pledge_ids)
+		verdicts = dict(ReconciliationVerdict.objects.filter(pledge_id__in=pledges.keys()).values_list('pledge_id', 'fingerprint'))
+		new_verdicts = { }
+
+		# Check each.
+		for pledge_id in pledge_ids:
+			dons = self.pledge_donations[pledge_id]
+			if pledge_id not in pledges:
+				print("Pledge", pledge_id, "does not exist but donations exist for it:", ", ".join(str(don["donation_id"]) for don in dons))
+				continue
+			self.reconciled_pledges.add(pledge_id)
+
+			# Skip pledges that reconciled before and haven't changed.
+			p = pledges[pledge_id]
+			fingerprint = self.get_fingerprint(p, dons)
+			if not self.full and verdicts.get(pledge_id) == fingerprint:
+				self.skipped += 1
+				continue
+
+			# Check it. Remember the fingerprint if no problems were reported,
+			# and otherwise forget it so that the problems are reported again
+			# next time.
+			self.checked += 1
+			self.problems = 0
+			self.check_pledge(p, dons)
+			if self.problems == 0:
+				if verdicts.get(pledge_id) != fingerprint:
+					new_verdicts[pledge_id] = fingerprint
+			elif pledge_id in verdicts:
+				new_verdicts[pledge_id] = None
+
+		# Save the verdicts that changed. A None fingerprint means the pledge
+		# had problems, so its verdict is deleted.
+		ReconciliationVerdict.objects.filter(pledge_id__in=new_verdicts.keys()).delete()
+		ReconciliationVerdict.objects.bulk_create(
+			ReconciliationVerdict(pledge_id=pledge_id, fingerprint=fingerprint)
+			for pledge_id, fingerprint in new_verdicts.items()
+			if fingerprint is not None)
+
+	def get_fingerprint(self, p, dons):
+		# A hash of everything that check_pledge looks at, so we can tell
+		# if anything has changed since the pledge last reconciled.
+		state = [
+			p.status.value,
+			p.execution.problem.value if p.status == PledgeStatus.Executed else None,
+			str(p.execution.charged) if p.status == PledgeStatus.Executed else None,
+			sorted(
+				[str(don["donation_id"]), don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"],
+				 bool(don["line_items"][0]["transaction_error"])]
+				for don in dons),
+		]
+		return hashlib.sha1(json.dumps(state).encode("utf8")).hexdigest()
+
+	def report(self, *args):
+		# Print a reconciliation problem.
+		self.problems += 1
+		print(*args)
+
+	def check_pledge(self, p, dons):
 		# Dangling transactions.
-		for p, dons in sorted(pledge_donations.items(), key = lambda kv : kv[0].id):
-			# If a pledge is not executed, it should have no non-void/credit donation records.
-			# When there's a weird problem, we might manually void/credit.
-			active_donations = [don for don in dons if don["line_items"][0]["status"] not in ("voided", "credited")]
-			if p.status != PledgeStatus.Executed:
-				if len(active_donations) > 0:
-					print(p.id, p, "is not executed but donations exist for it!")
-					for don in active_donations:
-						print("\t", don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], "=>", "void_transaction", don["line_items"][0]["transaction_guid"])
-					print()
-
-			# Check that the transaction details look OK - first for failed transactions.
-			elif p.execution.problem == PledgeExecutionProblem.TransactionFailed:
-				# Ensure this pledge is associated only with failed transactions. If there is more
-				# than one such domation, well that's odd, but it ultimately doesn't matter.
-				for don in dons:
-					if not don["line_items"][0]["transaction_error"] or don["line_items"][0]["transaction_amount"] != "$0.00":
-						print(p.id, p, don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], "=>", "transaction", don["line_items"][0]["transaction_guid"], "had a transaction error but transaction doesn't show an error.")
-
-			# ... and transactions that we voided or credited.
-			elif p.execution.problem == PledgeExecutionProblem.Voided:
-				# Ensure this pledge is associated only with voided/credited transactions. If there is more
-				# than one such donation, well, it doesn't really matter since the money was returned.
-				for don in dons:
-					if don["line_items"][0]["status"] not in ("voided", "credited"):
-						print(p.id, p, don["donation_id"], "was voided but DE shows status", don["line_items"][0]["status"])
-
-			# Now check successfully executed pledges.
-
-			# There should be exactly one non-voided/credited donation record.
-			elif len(active_donations) > 1:
-				print(p.id, p, "has more than one donation:")
-				for don in dons:
+
+		# If a pledge is not executed, it should have no non-void/credit donation records.
+		# When there's a weird problem, we might manually void/credit.
+		active_donations = [don for don in dons if don["line_items"][0]["status"] not in ("voided", "credited")]
+
+		if p.status != PledgeStatus.Executed:
+			if len(active_donations) > 0:
+				self.report(p.id, p, "is not executed but donations exist for it!")
+				for don in active_donations:
 					print("\t", don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], "=>", "void_transaction", don["line_items"][0]["transaction_guid"])
 				print()
-			elif len(active_donations) == 0:
-				print(p.id, p, "has only voided/credited donations:")
-				for don in dons:
-					print("\t", don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], don["line_items"][0]["status"])
-				print()
 
-			# And that record should match our execution's record.
-			else:
-				don = active_donations[0]
+		# Check that the transaction details look OK - first for failed transactions.
+		elif p.execution.problem == PledgeExecutionProblem.TransactionFailed:
+			# Ensure this pledge is associated only with failed transactions. If there is more
+			# than one such domation, well that's odd, but it ultimately doesn't matter.
+			for don in dons:
+				if not don["line_items"][0]["transaction_error"] or don["line_items"][0]["transaction_amount"] != "$0.00":
+					self.report(p.id, p, don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], "=>", "transaction", don["line_items"][0]["transaction_guid"], "had a transaction error but transaction doesn't show an error.")
+
+		# ... and transactions that we voided or credited.
+		elif p.execution.problem == PledgeExecutionProblem.Voided:
+			# Ensure this pledge is associated only with voided/credited transactions. If there is more
+			# than one such donation, well, it doesn't really matter since the money was returned.
+			for don in dons:
+				if don["line_items"][0]["status"] not in ("voided", "credited"):
+					self.report(p.id, p, don["donation_id"], "was voided but DE shows status", don["line_items"][0]["status"])
+
+		# Now check successfully executed pledges.
+
+		# There should be exactly one non-voided/credited donation record.
+		elif len(active_donations) > 1:
+			self.report(p.id, p, "has more than one donation:")
+			for don in dons:
+				print("\t", don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], "=>", "void_transaction", don["line_items"][0]["transaction_guid"])
+			print()
+		elif len(active_donations) == 0:
+			self.report(p.id, p, "has only voided/credited donations:")
+			for don in dons:
+				print("\t", don["donation_id"], don["created_at"], don["line_items"][0]["status"], don["line_items"][0]["transaction_amount"], don["line_items"][0]["status"])
+			print()
 
-				if don["line_items"][0]["transaction_error"]:
-					print(p.id, p, don["donation_id"], "had a transaction error but we think it went ok.")
+		# And that record should match our execution's record.
+		else:
+			don = active_donations[0]
 
-				amt = Decimal(don["line_items"][0]["transaction_amount"].replace("$", ""))
-				if amt != p.execution.charged:
-					print(p.id, p, don["donation_id"], "disagreement on the transaction amount.")
+			if don["line_items"][0]["transaction_error"]:
+				self.report(p.id, p, don["donation_id"], "had a transaction error but we think it went ok.")
 
+			amt = Decimal(don["line_items"][0]["transaction_amount"].replace("$", ""))
+			if amt != p.execution.charged:
+				self.report(p.id, p, don["donation_id"], "disagreement on the transaction amount.")
+
+
+	def process_donation(self, don):
+		# Returns the ID of the pledge that the donation is for, or None
+		# if the donation doesn't need to be reconciled.
 
-	def process_donation(self, don, pledge_donations):
 		if don["authtest_request"]:
 			# This was an authorization test. There's no need to
 			# reconcile these. The pledge may have been cancelled,
 			# whatever.
-			return
+			return None
 
 		# This is an actual transaction.
 
@@ -109,23 +277,19 @@ class Command(BaseCommand):
 
 		if not don["authcapture_request"]:
 			print(don["donation_id"], "has authtest_request, authcapture_request both False")
-			return
+			return None
 
 		if len(don["line_items"]) == 0:
 			print(don["donation_id"], "has no line items")
-			return
+			return None
 
 		txns = set()
 		for line_item in don["line_items"]:
 			txns.add(line_item["transaction_guid"])
 		if len(txns) != 1:
 			print(don["donation_id"], "has more than one transaction (should be one)")
-			return
-		
-		# What pledge does this correspond to?
+			return None
 
-		pledge = Pledge.objects.get(id=rtyaml.load(don["aux_data"])["pledge"])
-
-		# Map the pledge to the donation(s) we see for it.
+		# What pledge does this correspond to?
 
-		pledge_donations[pledge].append(don)
+		return rtyaml.load(don["aux_data"])["pledge"]
@@ -6,47 +6,116 @@ from django.utils import timezone
 from django.conf import settings
 from datetime import timedelta
 
-from contrib.models import TriggerStatus, Pledge, PledgeStatus, Tip
+from contrib.models import Pledge, Tip, AggregateUpdater
+from contrib.bizlogic import PledgeRecipientIndex
 
-import sys, os, tqdm
+import sys, os, time, tqdm
 from taskutils import exclusive_process
 
 class Command(BaseCommand):
 	args = ''
 	help = 'Executes any open pledges on executed triggers.'
 
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=1,
+			help='Split the pledges into this many disjoint shards and execute the shards concurrently.')
+		parser.add_argument('--flush-every', type=int, default=100,
+			help='Write the cached aggregate totals after executing this many pledges.')
+
 	def handle(self, *args, **options):
+		if options['workers'] < 1:
+			raise CommandError("--workers must be at least 1.")
+
 		# Ensure this process does not run concurrently.
 		exclusive_process('itf-execute-pledges')
-		self.do_execute_pledges()
-
-	def do_execute_pledges(self):
-		# Get the set of pledges to execute. Do some database filtering
-		# but the real test for whether it can be executed is in the method call.
-		pledges_to_execute = Pledge.objects.filter(status=PledgeStatus.Open, trigger__status=TriggerStatus.Executed)\
-			.select_related('trigger')
-		pledges_to_execute = [p for p in pledges_to_execute if p.can_execute()]
-
-		# Loop through them.
-		if sys.stdout.isatty(): pledges_to_execute = tqdm.tqdm(pledges_to_execute)
-		for p in pledges_to_execute:
-			# Execute the pledge.
+		self.flush_every = max(options['flush_every'], 1)
+		self.do_execute_pledges(options['workers'])
+
+	def get_pledges_to_execute(self, shard=0, num_shards=1):
+		# Get the set of pledges to execute. The database applies the same
+		# rules as Pledge.can_execute, which Pledge.execute checks again
+		# once the pledge is locked. With more than one shard, get just the
+		# pledges whose ID falls into the shard.
+		pledges = Pledge.get_executable_pledges()
+		if num_shards > 1:
+			from django.db.models import F
+			pledges = pledges.annotate(shard=F('id') % num_shards).filter(shard=shard)
+		return pledges
+
+	flush_every = 100
+
+	def do_execute_pledges(self, workers=1):
+		if workers == 1:
+			# Execute all of the pledges in this thread.
+			shard_stats = [self.execute_shard(0, 1)]
+
+		else:
+			# Split the pledges into disjoint shards by pledge ID and execute each
+			# shard in its own thread. Pledge execution is mostly waiting on the
+			# Democracy Engine API, so threads are enough to get concurrency. Each
+			# Pledge is still locked (select_for_update) while it is executed.
+			from concurrent.futures import ThreadPoolExecutor
+			with ThreadPoolExecutor(max_workers=workers) as pool:
+				shard_stats = list(pool.map(lambda shard : self.execute_shard(shard, workers), range(workers)))
+
+			for shard, (count, elapsed) in enumerate(shard_stats):
+				print("shard %d: %d pledges in %0.1f seconds (%0.2f pledges/sec)" % (
+					shard, count, elapsed, (count/elapsed) if elapsed else 0))
+
+		# Report throughput so that the number of workers can be tuned.
+		total_count = sum(count for count, elapsed in shard_stats)
+		total_elapsed = max(elapsed for count, elapsed in shard_stats)
+		print("total: %d pledges in %0.1f seconds (%0.2f pledges/sec)" % (
+			total_count, total_elapsed, (total_count/total_elapsed) if total_elapsed else 0))
+
+	def execute_shard(self, shard, num_shards):
+		# Execute the pledges whose ID falls into this shard. Returns
+		# a tuple of the number of pledges executed and the elapsed time.
+		from django.db import connection
+		recipient_index = PledgeRecipientIndex() # not thread-safe, so one per shard
+		updater = AggregateUpdater()
+		try:
+			start = time.time()
+			count = 0
+			pledges = self.get_pledges_to_execute(shard, num_shards)
+			if num_shards == 1 and sys.stdout.isatty():
+				pledges = tqdm.tqdm(pledges.iterator(), total=pledges.count())
+			else:
+				pledges = pledges.iterator()
+			for p in pledges:
+				self.execute_pledge(p, recipient_index, updater)
+				count += 1
+				if count % self.flush_every == 0:
+					updater.flush()
+			return (count, time.time() - start)
+		finally:
+			# With more than one shard, each runs in its own thread, which
+			# gets its own database connection that Django won't close for us.
 			try:
-				p.execute()
+				updater.flush()
+			finally:
+				if num_shards > 1:
+					connection.close()
+
+	def execute_pledge(self, p, recipient_index=None, updater=None):
+		# Execute the pledge. The increments to the cached aggregate totals
+		# are held in updater until it is flushed.
+		try:
+			p.execute(recipient_index=recipient_index, updater=updater)
 
-			# ValueError indicates a known condition that makes the pledge
-			# non-executable. We should skip it. Sometimes it just means
-			# we have to wait.
+		# ValueError indicates a known condition that makes the pledge
+		# non-executable. We should skip it. Sometimes it just means
+		# we have to wait.
+		except ValueError as e:
+			print(p)
+			print(e)
+			print()
+
+		# If the pledge was executed, execute any tip to the campaign owner.
+		if p.execution and p.tip_to_campaign_owner > 0:
+			try:
+				Tip.execute_from_pledge(p)
 			except ValueError as e:
 				print(p)
 				print(e)
 				print()
-
-			# If the pledge was executed, execute any tip to the campaign owner.
-			if p.execution and p.tip_to_campaign_owner > 0:
-				try:
-					Tip.execute_from_pledge(p)
-				except ValueError as e:
-					print(p)
-					print(e)
-					print()
@@ -5,14 +5,19 @@ from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 from contrib.models import ContributorInfo
+from taskutils import iter_in_batches
 
 class Command(BaseCommand):
 	args = ''
 	help = 'Geocodes ContributorInfos.'
 
 	def handle(self, *args, **options):
+		# Stream the profiles in batches. Each geocode is committed as soon as
+		# it is saved (no transaction), so that no transaction is held open
+		# across the geocoder's network calls and a failure doesn't lose the
+		# profiles already geocoded.
 		profiles = ContributorInfo.objects.filter(is_geocoded=False)
-		for profile in profiles:
+		for profile in iter_in_batches(profiles, batch_size=100):
 			try:
 				profile.geocode()
 			except OSError as e:
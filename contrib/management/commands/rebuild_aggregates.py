@@ -0,0 +1,100 @@
+# Recomputes the cached aggregate totals from Contribution records
+# ----------------------------------------------------------------
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum, F
+
+from contrib.models import Action, TriggerExecution, PledgeExecution, PledgeExecutionProblem, \
+	Contribution, ContributionRecipientType
+
+from taskutils import exclusive_process
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Recomputes the cached contribution totals on Actions and TriggerExecutions from the Contribution records.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--dry-run', action='store_true', default=False,
+			help='Only report the totals that are wrong, without fixing them.')
+
+	def handle(self, *args, **options):
+		if not options['dry_run']:
+			# Don't rebuild while pledges are being executed, since the
+			# executor may be holding increments it hasn't written yet.
+			exclusive_process('itf-execute-pledges')
+
+		with transaction.atomic():
+			mismatches = self.rebuild(Action, self.get_action_totals())
+			mismatches += self.rebuild(TriggerExecution, self.get_triggerexecution_totals())
+			if options['dry_run']:
+				transaction.set_rollback(True)
+
+		print(mismatches, "incorrect total(s)", "found." if options['dry_run'] else "fixed.")
+
+	def get_action_totals(self):
+		# Returns a dict mapping Action IDs to dicts of the correct values
+		# of the aggregate fields.
+		totals = { }
+		for recipient_type, field in (
+			(ContributionRecipientType.Incumbent, 'total_contributions_for'),
+			(ContributionRecipientType.GeneralChallenger, 'total_contributions_against')):
+			for rec in Contribution.objects.filter(recipient_type=recipient_type)\
+				.values('action').annotate(total=Sum('amount')):
+				totals.setdefault(rec['action'], { })[field] = rec['total']
+		return totals
+
+	def get_triggerexecution_totals(self):
+		# Returns a dict mapping TriggerExecution IDs to dicts of the correct
+		# values of the aggregate fields.
+		totals = { }
+		def add(te, field, value):
+			f = totals.setdefault(te, { })
+			f[field] = f.get(field, 0) + value
+
+		# Contributions count toward the TriggerExecution of the Pledge's Trigger
+		# and, for Pledges that use the Actions of other Triggers, also toward
+		# the TriggerExecution of the Action (see Contribution.update_aggregates).
+		for rec in Contribution.objects\
+			.values('pledge_execution__trigger_execution')\
+			.annotate(count=Count('id'), total=Sum('amount')):
+			add(rec['pledge_execution__trigger_execution'], 'num_contributions', rec['count'])
+			add(rec['pledge_execution__trigger_execution'], 'total_contributions', rec['total'])
+		for rec in Contribution.objects\
+			.exclude(action__execution=F('pledge_execution__trigger_execution'))\
+			.values('action__execution')\
+			.annotate(count=Count('id'), total=Sum('amount')):
+			add(rec['action__execution'], 'num_contributions', rec['count'])
+			add(rec['action__execution'], 'total_contributions', rec['total'])
+
+		# Every PledgeExecution counts toward pledge_count, but only ones that made
+		# contributions (and weren't voided) count toward pledge_count_with_contribs.
+		for rec in PledgeExecution.objects.values('trigger_execution').annotate(count=Count('id')):
+			add(rec['trigger_execution'], 'pledge_count', rec['count'])
+		for rec in PledgeExecution.objects.filter(problem=PledgeExecutionProblem.NoProblem)\
+			.values('trigger_execution').annotate(count=Count('id')):
+			add(rec['trigger_execution'], 'pledge_count_with_contribs', rec['count'])
+
+		return totals
+
+	def rebuild(self, model, totals):
+		# Compare the stored aggregate fields of every instance of model to
+		# the correct values in totals (missing values are zero) and fix the
+		# ones that are wrong. Returns the number of wrong fields.
+		fields = {
+			Action: ('total_contributions_for', 'total_contributions_against'),
+			TriggerExecution: ('pledge_count', 'pledge_count_with_contribs', 'num_contributions', 'total_contributions'),
+		}[model]
+
+		mismatches = 0
+		for rec in model.objects.select_for_update().order_by('id').values('id', *fields):
+			correct = totals.get(rec['id'], { })
+			updates = { }
+			for field in fields:
+				if rec[field] != correct.get(field, 0):
+					print("%s %d %s: %s => %s" % (model.__name__, rec['id'], field, rec[field], correct.get(field, 0)))
+					updates[field] = correct.get(field, 0)
+			if updates:
+				mismatches += len(updates)
+				model.objects.filter(id=rec['id']).update(**updates)
+		return mismatches
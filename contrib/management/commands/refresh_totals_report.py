@@ -0,0 +1,17 @@
+# Recomputes the site-wide totals report
+# --------------------------------------
+
+from django.core.management.base import BaseCommand
+
+import time
+
+from contrib.reporting import refresh_report_snapshot
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Computes the site-wide totals report shown at /totals and stores the snapshot in the cache.'
+
+	def handle(self, *args, **options):
+		start = time.time()
+		snapshot = refresh_report_snapshot()
+		print("Totals report as of %s computed in %0.1f seconds." % (snapshot["as_of"], time.time() - start))
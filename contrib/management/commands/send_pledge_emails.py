@@ -8,16 +8,19 @@ from django.utils import timezone
 from datetime import timedelta
 
 from contrib.models import Pledge, TriggerStatus, PledgeStatus, IncompletePledge
-from contrib.bizlogic import get_pledge_recipients, compute_charge
+from contrib.bizlogic import PledgeRecipientIndex, count_pledge_recipients, compute_charges
 from itfsite.middleware import get_branding
+from itfsite.utils import BatchMailer
 
 from htmlemailer import send_mail
+from taskutils import iter_batches, iter_in_batches
 
 class Command(BaseCommand):
 	args = ''
 	help = 'Sends pre- and post- pledge execution emails and incomplete pledge emails.'
 
 	def handle(self, *args, **options):
+		self.branding = { }
 		self.send_pledge_emails('pre')
 		self.send_pledge_emails('post')
 		self.send_incomplete_pledge_emails()
@@ -52,27 +55,55 @@ class Command(BaseCommand):
 		else:
 			raise ValueError()
 
-		# Send email for each.
-		pledges = pledges.select_related("user")
-		for pledge in pledges:
-			# Apply a post-db-query filter.
-			if not pledge_filter(pledge):
-				continue
+		# Share the recipient lookups across all of the pledges, since most
+		# are on the same few triggers.
+		recipient_index = PledgeRecipientIndex()
 
-			# Send email.
-			self.send_pledge_email(pre_or_post, pledge)
+		# Send the emails over shared mail connections, recording which
+		# pledges were sent their email with one UPDATE per batch.
+		field_name = "%s_execution_email_sent_at" % pre_or_post
+		def record_sent(pledge_ids):
+			Pledge.objects.filter(id__in=pledge_ids).update(**{ field_name: timezone.now() })
+		with BatchMailer(batch_size=self.mail_batch_size, on_sent=record_sent) as mailer:
+			self.send_pledge_email_batches(pre_or_post, pledges, pledge_filter, recipient_index, mailer)
 
-	def send_pledge_email(self, pre_or_post, pledge):
-		# What will happen when the pledge is executed?
-		recipients = get_pledge_recipients(pledge)
-		if len(recipients) == 0:
-			# This pledge will result in nothing happening. There is
-			# no need to email.
-			return
-		recip_contribs, fees, total_charge = compute_charge(pledge, recipients)
+	mail_batch_size = 100
+
+	def send_pledge_email_batches(self, pre_or_post, pledges, pledge_filter, recipient_index, mailer):
+		# Process the pledges in batches so that memory use stays flat
+		# as the number of pledges grows.
+		for pledges in iter_batches(pledges, select_related=("user", "profile", "via_campaign", "trigger__execution")):
+			# Apply a post-db-query filter.
+			pledges = [pledge for pledge in pledges if pledge_filter(pledge)]
+
+			# What will happen when the pledges are executed? Count the recipients
+			# of each and compute all of the charges at once.
+			recipient_counts = [count_pledge_recipients(pledge, recipient_index) for pledge in pledges]
+			charges = compute_charges(pledges, recipient_counts)
+
+			# Send email for each.
+			for pledge, num_recipients, charge in zip(pledges, recipient_counts, charges):
+				if num_recipients == 0:
+					# This pledge will result in nothing happening. There is
+					# no need to email.
+					continue
+				if charge is None:
+					# The pledge amount can't be split across the recipients. It
+					# will fail when it is executed, too.
+					print("Pledge", pledge.id, "amount", pledge.amount, "can't be divided across", num_recipients, "recipients.")
+					continue
+
+				# Send email.
+				recip_contrib, contrib_total, fees, total_charge = charge
+				self.send_pledge_email(mailer, pre_or_post, pledge, total_charge)
+
+	def send_pledge_email(self, mailer, pre_or_post, pledge, total_charge):
+		# The branding context only depends on the brand, so compute it once per brand.
+		if pledge.via_campaign.brand not in self.branding:
+			self.branding[pledge.via_campaign.brand] = get_branding(pledge.via_campaign.brand)
 
 		context = { }
-		context.update(get_branding(pledge.via_campaign.brand))
+		context.update(self.branding[pledge.via_campaign.brand])
 		context.update({
 			"profile": pledge.profile, # used in salutation in email_template
 			"pledge": pledge,
@@ -80,24 +111,21 @@ class Command(BaseCommand):
 			"total_charge": total_charge,
 		})
 
-		# Send email.
-		send_mail(
+		# Send email. The mailer records that it was sent.
+		mailer.send(
 			"contrib/mail/%s_execution" % pre_or_post,
 			context["MAIL_FROM_EMAIL"],
 			[pledge.user.email],
-			context)
-
-		# Record that it was sent.
-		field_name = "%s_execution_email_sent_at" % pre_or_post
-		setattr(pledge, field_name, timezone.now())
-		pledge.save(update_fields=[field_name])
+			context,
+			key=pledge.id)
 
 	def send_incomplete_pledge_emails(self):
 		# For every IncompletePledge instance that has not yet been
 		# sent a reminder email, send one. Wait at least some hours
 		# after the user left the page.
 		before = timezone.now() - timedelta(hours=3)
-		for ip in IncompletePledge.objects.filter(created__lt=before, sent_followup_at=None):
+		for ip in iter_in_batches(IncompletePledge.objects.filter(created__lt=before, sent_followup_at=None),
+			select_related=("via_campaign", "trigger")):
 			context = { }
 			context.update(get_branding(ip.via_campaign.brand))
 			context.update({
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import itfsite.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0002_auto_20160727_0725'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='triggerexecution',
+            name='recipient_matrix',
+            field=itfsite.utils.JSONField(blank=True, help_text="A cached mapping from pledge options to the pledge's recipients.", null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import itfsite.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0003_triggerexecution_recipient_matrix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Identifies the reconciliation process that this cursor is for.', max_length=32, unique=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('last_donation_created_at', models.DateTimeField(blank=True, help_text='The creation time of the newest donation that has been reconciled.', null=True)),
+                ('last_donation_id', models.CharField(blank=True, help_text='The Democracy Engine ID of the newest donation that has been reconciled.', max_length=64, null=True)),
+                ('verdicts', itfsite.utils.JSONField(blank=True, help_text='A mapping from Pledge IDs to a fingerprint of the Pledge and its donation records at the last time they were found to reconcile.')),
+            ],
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import contrib.models
+from django.db import migrations, models
+import django.db.models.deletion
+import enumfields.fields
+
+
+def backfill_contribution_facts(apps, schema_editor):
+    # Add a fact for each existing Contribution, in batches.
+    Contribution = apps.get_model('contrib', 'Contribution')
+    ContributionFact = apps.get_model('contrib', 'ContributionFact')
+    Incumbent = contrib.models.ContributionRecipientType.Incumbent.value
+    value = lambda v : getattr(v, "value", v) # enum members to integers
+
+    rows = Contribution.objects.order_by('id').values_list(
+        'id', 'pledge_execution__pledge__trigger', 'pledge_execution__pledge__desired_outcome',
+        'action__actor', 'action__party', 'recipient', 'recipient__party', 'recipient_type', 'amount',
+        'pledge_execution__pledge__via_campaign', 'pledge_execution__pledge__via_campaign__brand',
+        'pledge_execution__created')
+    facts = []
+    for (contribution_id, trigger, desired_outcome, actor, action_party, recipient, recipient_party, recipient_type, amount,
+         campaign, brand, created) in rows.iterator():
+        facts.append(ContributionFact(
+            contribution_id=contribution_id,
+            count=1,
+            trigger_id=trigger,
+            desired_outcome=desired_outcome,
+            actor_id=actor,
+            recipient_id=recipient,
+            party=value(action_party) if value(recipient_type) == Incumbent else value(recipient_party),
+            recipient_type=value(recipient_type),
+            amount_cents=int(amount*100),
+            campaign_id=campaign,
+            brand=brand,
+            date=created.date(),
+        ))
+        if len(facts) == 1000:
+            ContributionFact.objects.bulk_create(facts)
+            facts = []
+    ContributionFact.objects.bulk_create(facts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itfsite', '0001_initial'),
+        ('contrib', '0004_reconciliationcursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContributionFact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contribution_id', models.IntegerField(db_index=True, help_text='The id of the Contribution. (Not a foreign key so that the fact outlives a deleted Contribution.)')),
+                ('count', models.SmallIntegerField(default=1, help_text='1 for a Contribution, or -1 for the reversal of a deleted Contribution.')),
+                ('desired_outcome', models.IntegerField(help_text='The outcome index that the Pledge desired.')),
+                ('party', enumfields.fields.EnumIntegerField(blank=True, enum=contrib.models.ActorParty, help_text='The party of the candidate the contribution was sent to.', null=True)),
+                ('recipient_type', enumfields.fields.EnumIntegerField(enum=contrib.models.ContributionRecipientType, help_text='Whether the contribution was to the incumbent or the challenger.')),
+                ('amount_cents', models.IntegerField(help_text='The amount of the contribution in cents, negated for a reversal.')),
+                ('brand', models.IntegerField(blank=True, help_text='The brand of the Campaign that the Pledge was made via.', null=True)),
+                ('date', models.DateField(db_index=True, help_text='The date the Pledge was executed.')),
+                ('actor', models.ForeignKey(help_text='The Actor whose Action the contribution was made in reaction to.', on_delete=django.db.models.deletion.PROTECT, related_name='contribution_facts', to='contrib.Actor')),
+                ('campaign', models.ForeignKey(blank=True, help_text='The Campaign that the Pledge was made via.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='contribution_facts', to='itfsite.Campaign')),
+                ('recipient', models.ForeignKey(help_text='The Recipient the contribution was sent to.', on_delete=django.db.models.deletion.PROTECT, related_name='contribution_facts', to='contrib.Recipient')),
+                ('trigger', models.ForeignKey(help_text='The Trigger of the Pledge. For multi-trigger Pledges, this is the Trigger that the Pledge is mainly tied to, not the sub-trigger of the Action.', on_delete=django.db.models.deletion.PROTECT, related_name='contribution_facts', to='contrib.Trigger')),
+            ],
+        ),
+        migrations.RunPython(backfill_contribution_facts, migrations.RunPython.noop),
+    ]
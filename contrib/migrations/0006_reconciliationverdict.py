@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0005_contributionfact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationVerdict',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(help_text="A hash of the Pledge's state and its donation records.", max_length=40)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('pledge', models.OneToOneField(help_text='The Pledge that reconciled.', on_delete=django.db.models.deletion.CASCADE, related_name='reconciliation_verdict', to='contrib.Pledge')),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='reconciliationcursor',
+            name='verdicts',
+        ),
+    ]
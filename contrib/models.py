@@ -1,4 +1,5 @@
-import enum, decimal, copy, json
+import enum, decimal, copy, json, functools
+from types import MappingProxyType
 
 from django.db import models, transaction, IntegrityError
 from django.conf import settings
@@ -36,6 +37,53 @@ class ActorParty(enum.Enum):
 		if self == ActorParty.Republican: return ActorParty.Democratic
 		raise ValueError("%s does not have an opposite party." % str(self))
 
+# Our fee structure and other terms of pledges, which we call the
+# "algorithm", keyed by a sequence number so that we can track changes
+# to it over time. Pledges record the algorithm they were made under.
+# The registry and each algorithm are read-only so that they can be
+# shared rather than rebuilt on each use.
+def make_pledge_algorithm(alg):
+	# Add the values derived from the terms, so they can't disagree.
+	alg = dict(alg)
+	alg["fees_multiplier"] = 1 + alg["fees_percent"]
+	return MappingProxyType(alg)
+PLEDGE_ALGORITHMS = MappingProxyType({
+	1: make_pledge_algorithm({
+		"id": 1,
+		"min_contrib": 1, # dollars
+		"max_contrib": 500, # dollars
+		"fees_fixed": decimal.Decimal("0.20"), # 20 cents, convert from string so it is exact
+		"fees_percent": decimal.Decimal("0.09"), # 0.09 means 9%, convert from string so it is exact
+		"pre_execution_warn_time": (timedelta(days=1), "this time tomorrow"),
+	}),
+})
+CURRENT_PLEDGE_ALGORITHM = 1
+
+@functools.lru_cache()
+def get_minimum_pledge_amount(max_split, algorithm_id=CURRENT_PLEDGE_ALGORITHM):
+	# The minimum pledge is at least the algorithm's min_contrib and at
+	# least one cent to all possible recipients, plus fees.
+	alg = PLEDGE_ALGORITHMS[algorithm_id]
+	m1 = alg['min_contrib']
+	m2 = decimal.Decimal('0.01') * max_split * alg['fees_multiplier'] + alg['fees_fixed']
+	m2 = m2.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_UP)
+	return max(m1, m2)
+
+@functools.lru_cache()
+def get_suggested_pledge_amount(max_split, algorithm_id=CURRENT_PLEDGE_ALGORITHM):
+	# What's a nice round number to suggest the user pledge?
+	# It's the smallest of these pre-set numbers that's greater
+	# than the minimum.
+	# NOTE: Don't offer anything larger than the algorithm's max_contrib!
+	m = get_minimum_pledge_amount(max_split, algorithm_id)
+	for amt_str in ('2.50', '4', '5', '10', '15'):
+		amt = decimal.Decimal(amt_str)
+		if amt >= m:
+			return amt
+	# None of our nice rounded amounts are greater, so just offer
+	# the minimum. This should never really happen.
+	return m
+
 
 #####################################################################
 #
@@ -123,50 +171,80 @@ class Trigger(models.Model):
 		# What's the minimum pledge size for this trigger?
 		# It's at least Pledge.current_algorithm.min_contrib
 		# and at least the amount we need to do one cent per
-		# possible recipient, plus fees.
-		alg = Pledge.current_algorithm()
-		m1 = alg['min_contrib']
-		m2 = 0
-		max_split = self.max_split()
-		if True:
-			# The minimum pledge is one cent to all possible recipients, plus fees.
-			m2 = decimal.Decimal('0.01') * max_split * (1 + alg['fees_percent']) + alg['fees_fixed']
-			m2 = m2.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_UP)
-		return max(m1, m2)
+		# possible recipient, plus fees. The amounts only depend
+		# on max_split, so they are computed once per value.
+		return get_minimum_pledge_amount(self.max_split())
 
 	def get_suggested_pledge(self):
 		# What's a nice round number to suggest the user pledge?
-		# It's the smallest of these pre-set numbers that's greater
-		# than the minimum.
-		# NOTE: Don't offer anything larger than Pledge.current_algorithm.max_contrib!
-		m = self.get_minimum_pledge()
-		for amt_str in ('2.50', '4', '5', '10', '15'):
-			amt = decimal.Decimal(amt_str)
-			if amt >= m:
-				return amt
-		# None of our nice rounded amounts are greater, so just offer
-		# the minimum. This should never really happen.
-		return m
+		return get_suggested_pledge_amount(self.max_split())
 
 	def max_split(self):
 		if self.status != TriggerStatus.Executed:
 			# If the Trigger isn't executed yet, we don't know how
 			# many recipients there will be.
 			return self.trigger_type.extra['max_split']
-		else:
-			# The Trigger is executed and so we know exactly how many
-			# recipients there could be if the user does not apply
-			# any filters.
-			if self.extra and "subtriggers" in self.extra:
-				# This is a super-trigger. Add together the max_splits
-				# of the subtriggers.
-				return sum(
-					Trigger.objects.get(id=rec["trigger"]).max_split()
-					for rec in self.extra["subtriggers"])
 
-			else:
-				# This is a regular Trigger. Just look at its executed Actions.
-				return self.execution.actions.exclude(outcome=None).count()
+		# The Trigger is executed and so we know exactly how many
+		# recipients there could be if the user does not apply
+		# any filters. This is needed on every contribute page and
+		# to validate every Pledge, so it is cached on the instance
+		# and in the cache under a key that changes when the Actions
+		# change.
+		if getattr(self, '_max_split', None) is None:
+			from django.core.cache import cache
+			from contrib.bizlogic import get_trigger_cache_key
+			cache_key = get_trigger_cache_key("max_split", self)
+			self._max_split = cache.get(cache_key)
+			if self._max_split is None:
+				self._max_split = self.compute_max_split()
+				cache.set(cache_key, self._max_split, 60*60*24*7)
+		return self._max_split
+
+	def compute_max_split(self):
+		# For a regular Trigger, count its executed Actions. For a super-trigger,
+		# add together the max_splits of the subtriggers. Rather than recursing,
+		# expand the subtriggers (which may be super-triggers themselves) a level
+		# at a time and then count the Actions of all of the regular Triggers
+		# in one query.
+		max_split = 0
+		regular_triggers = { } # Trigger ID => number of times it is included
+		level = { self.id: 1 }
+		triggers = { self.id: self }
+		while level:
+			next_level = { }
+			for trigger_id, multiplicity in level.items():
+				trigger = triggers[trigger_id]
+				if trigger.status != TriggerStatus.Executed:
+					max_split += multiplicity * trigger.trigger_type.extra['max_split']
+				elif trigger.extra and "subtriggers" in trigger.extra:
+					for rec in trigger.extra["subtriggers"]:
+						next_level[rec["trigger"]] = next_level.get(rec["trigger"], 0) + multiplicity
+				else:
+					regular_triggers[trigger_id] = regular_triggers.get(trigger_id, 0) + multiplicity
+			if next_level:
+				triggers = Trigger.objects.select_related('trigger_type').in_bulk(next_level.keys())
+				if len(triggers) != len(next_level):
+					raise Trigger.DoesNotExist("A subtrigger does not exist.")
+			level = next_level
+
+		if regular_triggers:
+			for rec in Action.objects.filter(execution__trigger_id__in=regular_triggers).exclude(outcome=None)\
+				.values('execution__trigger_id').annotate(count=models.Count('id')):
+				max_split += regular_triggers[rec['execution__trigger_id']] * rec['count']
+		return max_split
+
+	@staticmethod
+	def lock_for_share(id):
+		# Returns the Trigger with the given id while holding a shared row lock
+		# on it until the end of the current transaction. Any number of shared
+		# locks may be held at once (e.g. by concurrent pledge executions) but
+		# changes to the Trigger row wait until they are released. Only PostgreSQL
+		# has FOR SHARE, so elsewhere fall back to an exclusive lock.
+		from django.db import connection
+		if connection.vendor == "postgresql":
+			return list(Trigger.objects.raw("SELECT * FROM %s WHERE id=%%s FOR SHARE" % Trigger._meta.db_table, [id]))[0]
+		return Trigger.objects.select_for_update().filter(id=id).first()
 
 	# Execute.
 	@transaction.atomic
@@ -194,6 +272,10 @@ class Trigger(models.Model):
 		# or None if the Actor didn't properly participate or a string
 		# meaning the Actor didn't participate and the string gives
 		# the reason_for_no_outcome value.
+		#
+		# The Actions are built in memory and then inserted all at once
+		# to keep the time we hold the lock on the Trigger short.
+		actions = []
 		for actor_outcome in actor_outcomes:
 			# If an Actor has an inactive_reason set, then we ignore
 			# any outcome supplied to us and replace it with that.
@@ -201,12 +283,21 @@ class Trigger(models.Model):
 			if actor_outcome["actor"].inactive_reason:
 				actor_outcome["outcome"] = actor_outcome["actor"].inactive_reason
 
-			ac = Action.create(te, actor_outcome["actor"], actor_outcome["outcome"], actor_outcome.get("action_time"))
+			actions.append(Action.build(te, actor_outcome["actor"], actor_outcome["outcome"], actor_outcome.get("action_time")))
+		Action.objects.bulk_create(actions)
+
+		# Pre-compute the recipients of every possible Pledge on this Trigger
+		# so that Pledges don't each have to re-examine all of the Actions.
+		te.update_recipient_matrix()
 
 		# Mark as executed.
 		trigger.status = TriggerStatus.Executed
 		trigger.save()
 
+		# Campaigns show the totals of executed triggers.
+		from itfsite.models import CampaignTotals
+		CampaignTotals.invalidate(trigger_ids=[trigger.id])
+
 	# Vacate, meaning we do not expect the action to ever occur.
 	@transaction.atomic
 	def vacate(self):
@@ -310,6 +401,20 @@ class TriggerCustomization(models.Model):
 	def __str__(self):
 		return "%s / %s" % (self.owner, self.trigger)
 
+	def save(self, *args, **kwargs):
+		super(TriggerCustomization, self).save(*args, **kwargs)
+		self.invalidate_campaign_totals()
+
+	def delete(self, *args, **kwargs):
+		super(TriggerCustomization, self).delete(*args, **kwargs)
+		self.invalidate_campaign_totals()
+
+	def invalidate_campaign_totals(self):
+		# A fixed outcome changes which totals the owner's campaigns for
+		# this trigger show.
+		from itfsite.models import Campaign, CampaignTotals
+		CampaignTotals.invalidate(campaign_ids=Campaign.objects.filter(owner_id=self.owner_id, contrib_triggers=self.trigger_id).values_list('id', flat=True))
+
 	def has_fixed_outcome(self):
 		return self.outcome is not None
 
@@ -359,9 +464,44 @@ class TriggerExecution(models.Model):
 
 	extra = JSONField(blank=True, help_text="Additional information stored with this object.")
 
+	# The recipients of every possible (regular, single-Trigger) Pledge on this
+	# execution, computed by contrib.bizlogic.build_recipient_matrix. It is cleared
+	# when a change to an Actor or Recipient could change the recipients, and
+	# is rebuilt the next time it is needed.
+	recipient_matrix = JSONField(blank=True, null=True, help_text="A cached mapping from pledge options to the pledge's recipients.")
+
 	def __str__(self):
 		return "%s [exec %s]" % (self.trigger, self.created.strftime("%x"))
 
+	def update_recipient_matrix(self):
+		# Build and store the recipient matrix. If it can't be built, store
+		# nothing so that pledges fall back to computing their recipients
+		# (and get the error) directly.
+		from contrib.bizlogic import build_recipient_matrix
+		self.recipient_matrix = build_recipient_matrix(self)
+		if self.recipient_matrix is None:
+			return
+		# Don't overwrite an invalidation that happened while we were building.
+		# Invalidation bumps the updated field.
+		TriggerExecution.objects.filter(id=self.id, updated=self.updated)\
+			.update(recipient_matrix=self.recipient_matrix)
+
+	def get_recipient_matrix(self):
+		# Return the recipient matrix, rebuilding it if it was invalidated.
+		if self.recipient_matrix is None:
+			self.update_recipient_matrix()
+		return self.recipient_matrix
+
+	@staticmethod
+	def invalidate_recipient_matrices(executions):
+		# Clear the recipient matrix of the given TriggerExecutions (a QuerySet).
+		# Bumping the updated field also invalidates anything else cached under
+		# a key that includes it (see contrib.bizlogic.get_trigger_cache_key),
+		# so do it even if the recipient matrix is already cleared.
+		TriggerExecution.objects\
+			.filter(id__in=list(executions.values_list('id', flat=True).distinct()))\
+			.update(recipient_matrix=None, updated=timezone.now())
+
 	def delete(self, *args, **kwargs):
 		# After deleting a TriggerExecution, reset the status of the trigger
 		# to Paused. Leaving it as Executed would leave it in an inconsistent
@@ -420,6 +560,11 @@ class Actor(models.Model):
 	def __str__(self):
 		return self.name_sort
 
+	def save(self, *args, **kwargs):
+		saved_fields = get_saved_recipient_matrix_fields(self)
+		super(Actor, self).save(*args, **kwargs)
+		invalidate_recipient_matrices_if_changed(self, saved_fields)
+
 class Action(models.Model):
 	"""The outcome of an actor taking an act described by a trigger."""
 
@@ -452,6 +597,11 @@ class Action(models.Model):
 			self.outcome_label(),
 			self.execution)
 
+	def save(self, *args, **kwargs):
+		saved_fields = get_saved_recipient_matrix_fields(self)
+		super(Action, self).save(*args, **kwargs)
+		invalidate_recipient_matrices_if_changed(self, saved_fields)
+
 	def has_outcome(self):
 		return self.outcome is not None
 
@@ -464,6 +614,15 @@ class Action(models.Model):
 
 	@staticmethod
 	def create(execution, actor, outcome, action_time):
+		# Create and save a new Action.
+		a = Action.build(execution, actor, outcome, action_time)
+		a.save()
+		return a
+
+	@staticmethod
+	def build(execution, actor, outcome, action_time):
+		# Return a new, unsaved Action instance.
+		#
 		# outcome can be an integer giving the Trigger's outcome index
 		# that the Actor did . . .
 		if isinstance(outcome, int):
@@ -485,12 +644,11 @@ class Action(models.Model):
 		a.reason_for_no_outcome = reason_for_no_outcome
 
 		# Copy fields that may change on the Actor but that we want to know what they were
-		# at the time this Action ocurred.
-		for f in ('name_long', 'name_short', 'name_sort', 'party', 'title', 'office', 'extra', 'challenger'):
+		# at the time this Action ocurred. Copy the challenger by ID so that we don't
+		# have to load the Recipient.
+		for f in ('name_long', 'name_short', 'name_sort', 'party', 'title', 'office', 'extra', 'challenger_id'):
 			setattr(a, f, getattr(actor, f))
 
-		# Save.
-		a.save()
 		return a
 
 
@@ -684,6 +842,14 @@ class Pledge(models.Model):
 			self.trigger.total_pledged = models.F('total_pledged') + self.amount
 			self.trigger.save(update_fields=['pledge_count', 'total_pledged'])
 
+		if is_new:
+			self.invalidate_campaign_totals()
+
+	def invalidate_campaign_totals(self):
+		# Clear the materialized totals of the Campaigns that show this Pledge.
+		from itfsite.models import CampaignTotals
+		CampaignTotals.invalidate(trigger_ids=[self.trigger_id], campaign_ids=[self.via_campaign_id])
+
 	@transaction.atomic
 	def delete(self):
 		if self.status != PledgeStatus.Open:
@@ -699,6 +865,8 @@ class Pledge(models.Model):
 		# Archive as a cancelled pledge.
 		cp = CancelledPledge.from_pledge(self)
 
+		self.invalidate_campaign_totals()
+
 		# Remove record. Will raise an exception and abort the transaction if
 		# the pledge has been executed and a PledgeExecution object refers to this.
 		super(Pledge, self).delete()	
@@ -708,14 +876,8 @@ class Pledge(models.Model):
 
 	@staticmethod
 	def current_algorithm():
-		return {
-			"id": 1, # a sequence number so we can track changes to our fee structure, etc.
-			"min_contrib": 1, # dollars
-			"max_contrib": 500, # dollars
-			"fees_fixed": decimal.Decimal("0.20"), # 20 cents, convert from string so it is exact
-			"fees_percent": decimal.Decimal("0.09"), # 0.09 means 9%, convert from string so it is exact
-			"pre_execution_warn_time": (timedelta(days=1), "this time tomorrow"),
-		}
+		# Returns the (read-only) current algorithm. See PLEDGE_ALGORITHMS.
+		return PLEDGE_ALGORITHMS[CURRENT_PLEDGE_ALGORITHM]
 
 	def __str__(self):
 		return self.get_email() + " => " + str(self.trigger)
@@ -806,6 +968,7 @@ class Pledge(models.Model):
 		self.anon_user = None
 		self.email_confirmed_at = timezone.now()
 		self.save(update_fields=['user', 'anon_user', 'email_confirmed_at'])
+		self.invalidate_campaign_totals() # only confirmed pledges are counted
 
 		# Let the user know what happened.
 		messages.add_message(request, messages.SUCCESS, 'Your contribution regarding %s has been confirmed.'
@@ -831,7 +994,8 @@ class Pledge(models.Model):
 		return True
 
 	def can_execute(self):
-		# Returns whether a Pledge can be executed.
+		# Returns whether a Pledge can be executed. (The same rules are
+		# in get_executable_pledges.)
 
 		# Check Pledge and Trigger state.
 		if self.status != PledgeStatus.Open:
@@ -856,11 +1020,45 @@ class Pledge(models.Model):
 
 		return True
 
+	@staticmethod
+	def get_executable_pledges():
+		# Returns a QuerySet of the Pledges for which can_execute would return
+		# True, ordered by ID, with the Trigger and TriggerExecution loaded.
+		# The rules are the same as in can_execute and needs_pre_execution_email
+		# but evaluated by the database so that Pledges that can't be executed
+		# yet are never loaded. Keep them in sync!
+
+		# A pre-execution email isn't needed if the user confirmed their email
+		# address after the trigger was executed or the pledge was made after
+		# the trigger was executed.
+		no_email_needed = models.Q(email_confirmed_at__gte=models.F('trigger__execution__created')) \
+			| models.Q(made_after_trigger_execution=True)
+
+		# Otherwise the pre-execution email must have been sent and (usually)
+		# the user must have been given time to cancel their pledge.
+		email_sent = models.Q(pre_execution_email_sent_at__isnull=False)
+		if not settings.DEBUG and Pledge.ENFORCE_EXECUTION_EMAIL_DELAY:
+			email_sent &= models.Q(pre_execution_email_sent_at__lte=
+				timezone.now() - Pledge.current_algorithm()['pre_execution_warn_time'][0])
+
+		return Pledge.objects.filter(
+				status=PledgeStatus.Open,
+				trigger__status=TriggerStatus.Executed,
+				algorithm=Pledge.current_algorithm()['id'],
+			)\
+			.filter((models.Q(pre_execution_email_sent_at__isnull=True) & no_email_needed) | email_sent)\
+			.select_related('trigger', 'trigger__execution')\
+			.order_by('id')
+
 	@transaction.atomic # needed b/c of select_for_update
-	def execute(self):
-		# Lock the Pledge and the Trigger to prevent race conditions.
+	def execute(self, recipient_index=None, updater=None):
+		# Lock the Pledge and the Trigger to prevent race conditions. The Pledge
+		# lock is exclusive so that a Pledge can't be executed twice. The Trigger
+		# lock is shared so that Pledges on the same Trigger can be executed
+		# concurrently (see execute_pledges --workers), but the Trigger still
+		# can't change while we're executing.
 		pledge = Pledge.objects.select_for_update().filter(id=self.id).first()
-		pledge.trigger = Trigger.objects.select_for_update().filter(id=pledge.trigger.id).first()
+		pledge.trigger = Trigger.lock_for_share(pledge.trigger_id)
 		trigger_execution = pledge.trigger.execution
 
 		# Validate state.
@@ -877,8 +1075,10 @@ class Pledge(models.Model):
 
 		# Get the intended recipients of the pledge, as a list of tuples of
 		# (Recipient, Action). The pledge filters may result in there being
-		# no actual recipients.
-		recipients = get_pledge_recipients(pledge)
+		# no actual recipients. When executing many pledges, the caller can
+		# pass a PledgeRecipientIndex so that the Trigger's Actions are only
+		# loaded once.
+		recipients = get_pledge_recipients(pledge, recipient_index=recipient_index)
 
 		if len(recipients) == 0:
 			# If there are no matching recipients, we don't make a credit card chage.
@@ -914,7 +1114,13 @@ class Pledge(models.Model):
 			}
 			pe.save()
 
-			# Create Contribution objects.
+			# Collect the increments to the cached aggregate fields. If the caller
+			# passed an AggregateUpdater, they are added to it to be written later
+			# in a batch with other Pledges. Otherwise they are written at the end.
+			pledge_updater = AggregateUpdater()
+
+			# Create Contribution objects. They are all inserted at once.
+			contributions = []
 			for action, recipient_type, recipient, amount in recip_contribs:
 				c = Contribution()
 				c.pledge_execution = pe
@@ -923,10 +1129,22 @@ class Pledge(models.Model):
 				c.recipient = recipient
 				c.amount = amount
 				c.de_id = recipient.de_id
-				c.save()
-
-				# Increment the TriggerExecution and Action's total_contributions.
-				c.update_aggregates()
+				contributions.append(c)
+			Contribution.objects.bulk_create(contributions)
+
+			# Append them to the reporting table too. (Only some database
+			# backends set the ids of bulk-created objects.)
+			if any(c.id is None for c in contributions):
+				ids = dict(Contribution.objects.filter(pledge_execution=pe).values_list('action_id', 'id'))
+				for c in contributions:
+					c.id = ids[c.action_id]
+			ContributionFact.record(contributions)
+
+			# Increment the TriggerExecution and Action's total_contributions. The
+			# increments are summed in pledge_updater and written with one UPDATE
+			# per model.
+			for c in contributions:
+				c.update_aggregates(updater=pledge_updater)
 
 			# Mark pledge as executed.
 			pledge.status = PledgeStatus.Executed
@@ -934,10 +1152,16 @@ class Pledge(models.Model):
 
 			# Increment TriggerExecution's pledge_count so that we know how many pledges
 			# have been or have not yet been executed.
-			trigger_execution.pledge_count = models.F('pledge_count') + 1
+			pledge_updater.add(TriggerExecution, trigger_execution.id, 'pledge_count', 1)
 			if len(recip_contribs) > 0:
-				trigger_execution.pledge_count_with_contribs = models.F('pledge_count_with_contribs') + 1
-			trigger_execution.save(update_fields=['pledge_count', 'pledge_count_with_contribs'])
+				pledge_updater.add(TriggerExecution, trigger_execution.id, 'pledge_count_with_contribs', 1)
+
+			# Write or defer the increments. Merge only now that everything else
+			# succeeded so that a failed execution doesn't leave increments behind.
+			if updater is None:
+				pledge_updater.flush()
+			else:
+				updater.merge(pledge_updater)
 
 		except Exception as e:
 			# If a DE transaction was made, include its info in any exception that was raised.
@@ -1276,15 +1500,129 @@ class Recipient(models.Model):
 				# is not a current challenger of someone, so just use office/party designation
 				return self.office_sought + ":" + str(self.party)
 
+	def save(self, *args, **kwargs):
+		saved_fields = get_saved_recipient_matrix_fields(self)
+		super(Recipient, self).save(*args, **kwargs)
+		invalidate_recipient_matrices_if_changed(self, saved_fields)
+
 	@property
 	def is_challenger(self):
 		return self.actor is None
 
+
+# When an Action's outcome, an Actor's challenger or inactive_reason, or a
+# Recipient's active flag changes, a TriggerExecution's recipient matrix
+# (and the other data cached for it) may become out of date. The models'
+# save() methods compare these fields with the saved row, which costs a
+# query per save rather than tracking every instance that is loaded.
+
+RECIPIENT_MATRIX_FIELDS = {
+	"Action": ('actor_id', 'outcome', 'party'),
+	"Actor": ('challenger_id', 'inactive_reason'),
+	"Recipient": ('active', 'actor_id', 'party'),
+}
+
+def get_saved_recipient_matrix_fields(instance):
+	# Returns the saved values of the fields that the recipient matrix
+	# depends on, or None if the instance hasn't been saved yet.
+	if instance.pk is None:
+		return None
+	fields = RECIPIENT_MATRIX_FIELDS[type(instance).__name__]
+	return type(instance).objects.filter(pk=instance.pk).values_list(*fields).first()
+
+def invalidate_recipient_matrices_if_changed(instance, saved_fields):
+	# Called after an instance is saved with what get_saved_recipient_matrix_fields
+	# returned before the save. Deferred fields weren't saved and so didn't change.
+	fields = RECIPIENT_MATRIX_FIELDS[type(instance).__name__]
+	created = (saved_fields is None)
+	changed = not created and any(
+		f in instance.__dict__ and instance.__dict__[f] != value
+		for f, value in zip(fields, saved_fields))
+
+	if isinstance(instance, Action):
+		# An Action that was added or changed after the Trigger was executed.
+		if not (created or changed): return
+		executions = TriggerExecution.objects.filter(id=instance.execution_id)
+	elif isinstance(instance, Actor):
+		# A new Actor can't have any Actions yet.
+		if created or not changed: return
+		executions = TriggerExecution.objects.filter(actions__actor=instance)
+	else:
+		# A new incumbent Recipient may fill in a missing recipient.
+		if not (changed or (created and instance.actor_id)): return
+		q = models.Q(actions__actor__challenger=instance)
+		if instance.actor_id:
+			q |= models.Q(actions__actor_id=instance.actor_id)
+		executions = TriggerExecution.objects.filter(q)
+	TriggerExecution.invalidate_recipient_matrices(executions)
+
+@receiver(models.signals.post_delete, sender=Action)
+def _invalidate_recipient_matrices_on_action_delete(sender, instance, **kwargs):
+	# (A signal rather than Action.delete so that QuerySet deletes are caught too.)
+	TriggerExecution.invalidate_recipient_matrices(TriggerExecution.objects.filter(id=instance.execution_id))
+
 class ContributionRecipientType(enum.Enum):
 	Null = 0
 	Incumbent = 1 # the Actor that took the Action, i.e. the incumbent
 	GeneralChallenger = 2 # the Actor's general election challenger
 
+class AggregateUpdater(object):
+	# Accumulates increments to the cached aggregate fields (e.g. Action.total_contributions_for,
+	# TriggerExecution.pledge_count) so that they can be written with one grouped UPDATE per
+	# model, rather than an UPDATE per contribution. When Pledges are executed concurrently,
+	# this keeps the executors from contending for the lock on the same TriggerExecution
+	# row for every contribution.
+	#
+	# Increments that have been added but not flushed are lost if the process dies. The
+	# rebuild_aggregates management command recomputes the fields from the Contribution
+	# records.
+
+	def __init__(self):
+		# Map models to dicts mapping field names to dicts mapping
+		# object IDs to increments.
+		self.deltas = { }
+
+	def add(self, model, id, field, delta):
+		field_deltas = self.deltas.setdefault(model, { }).setdefault(field, { })
+		field_deltas[id] = field_deltas.get(id, 0) + delta
+
+	def merge(self, other):
+		# Add the increments held by another AggregateUpdater.
+		for model, fields in other.deltas.items():
+			for field, field_deltas in fields.items():
+				for id, delta in field_deltas.items():
+					self.add(model, id, field, delta)
+
+	@transaction.atomic
+	def flush(self):
+		# Write the increments to the database with one UPDATE per model,
+		# e.g. UPDATE ... SET f = f + CASE WHEN id=1 THEN 5 WHEN id=2 THEN 3 ELSE 0 END
+		# WHERE id IN (1, 2).
+		for model, fields in sorted(self.deltas.items(), key = lambda item : item[0]._meta.label):
+			ids = sorted(set(id for field_deltas in fields.values() for id in field_deltas))
+			if len(ids) == 0:
+				continue
+
+			# Lock the rows in a consistent order so that concurrent flushes
+			# wait on each other rather than deadlock.
+			list(model.objects.select_for_update().filter(id__in=ids).order_by('id').values_list('id', flat=True))
+
+			model.objects.filter(id__in=ids).update(**{
+				field: models.F(field) + models.Case(
+					*[models.When(id=id, then=models.Value(delta)) for id, delta in field_deltas.items()],
+					default=models.Value(0),
+					output_field=model._meta.get_field(field))
+				for field, field_deltas in fields.items()
+			})
+
+		# The totals shown on Campaign pages may have changed too.
+		trigger_execution_ids = set(id for field_deltas in self.deltas.get(TriggerExecution, { }).values() for id in field_deltas)
+		if trigger_execution_ids:
+			from itfsite.models import CampaignTotals
+			CampaignTotals.invalidate(trigger_ids=TriggerExecution.objects.filter(id__in=trigger_execution_ids).values_list('trigger_id', flat=True))
+
+		self.deltas.clear()
+
 class Contribution(models.Model):
 	"""A fully executed campaign contribution."""
 
@@ -1329,10 +1667,20 @@ class Contribution(models.Model):
 		# Decrement the TriggerExecution and Action's total_pledged fields.
 		self.update_aggregates(factor=-1)
 
+		# Reverse the contribution in the reporting table.
+		ContributionFact.record([self], count=-1)
+
 		# Remove record.
 		super(Contribution, self).delete()	
 
 	def update_aggregates(self, factor=1, updater=None):
+		# If an AggregateUpdater is given, the changes are recorded in it
+		# and are written to the database when it is flushed. Otherwise
+		# they are written immediately.
+		flush = (updater is None)
+		if flush:
+			updater = AggregateUpdater()
+
 		# Increment the totals on the Action instance. This excludes fees because
 		# this is based on transaction line items.
 		if self.recipient_type == ContributionRecipientType.Incumbent:
@@ -1341,24 +1689,35 @@ class Contribution(models.Model):
 		else:
 			# Contribution was to the Actor's opponent.
 			field = 'total_contributions_against'
-		setattr(self.action, field, models.F(field) + self.amount*factor)
-		self.action.save(update_fields=[field])
+		updater.add(Action, self.action_id, field, self.amount*factor)
 
 		# Increment the TriggerExecution's total_contributions. Likewise, it
 		# excludes fees. When a Pledge uses the Actions of multiple Triggers,
 		# then self.pledge_execution.execution != self.action.execution (both
 		# a TriggerExecution). In that case, we (double-)count the totals in
 		# each.
-		triggerexecutions = [self.pledge_execution.trigger_execution]
-		if triggerexecutions[0] != self.action.execution:
-			triggerexecutions.append(self.action.execution)
+		triggerexecutions = [self.pledge_execution.trigger_execution_id]
+		if triggerexecutions[0] != self.action.execution_id:
+			triggerexecutions.append(self.action.execution_id)
 		for te in triggerexecutions:
-			te.total_contributions = models.F('total_contributions') + self.amount*factor
-			te.num_contributions = models.F('num_contributions') + 1*factor
-			te.save(update_fields=['total_contributions', 'num_contributions'])
+			updater.add(TriggerExecution, te, 'total_contributions', self.amount*factor)
+			updater.add(TriggerExecution, te, 'num_contributions', 1*factor)
+
+		if flush:
+			updater.flush()
 
 	@staticmethod
 	def aggregate(*across, **kwargs):
+		# Answer from the ContributionFact table when it has all of the
+		# fields being aggregated across and filtered on, which avoids the
+		# joins through the PledgeExecution, Pledge and Action tables.
+		ret = ContributionFact.aggregate(*across, **kwargs)
+		if ret is None:
+			ret = Contribution.aggregate_contributions(*across, **kwargs)
+		return ret
+
+	@staticmethod
+	def aggregate_contributions(*across, **kwargs):
 		# Expand field aliases. Each alias is a tuple of:
 		#  ((field, lookup), to-database-value, from-database-value)
 		aliases = {
@@ -1432,4 +1791,158 @@ class Contribution(models.Model):
 			# sort by amount, descending
 			ret.sort(key = lambda item : item[1][1], reverse=True)
 
-			return ret
\ No newline at end of file
+			return ret
+
+class ContributionFact(models.Model):
+	"""An append-only, denormalized copy of a Contribution for reporting."""
+
+	# Aggregates over the facts don't need joins. A fact is added when a
+	# Contribution is created, and a reversing fact is added when one is
+	# deleted, so the rows are never updated.
+
+	contribution_id = models.IntegerField(db_index=True, help_text="The id of the Contribution. (Not a foreign key so that the fact outlives a deleted Contribution.)")
+	count = models.SmallIntegerField(default=1, help_text="1 for a Contribution, or -1 for the reversal of a deleted Contribution.")
+	trigger = models.ForeignKey(Trigger, related_name="contribution_facts", on_delete=models.PROTECT, help_text="The Trigger of the Pledge. For multi-trigger Pledges, this is the Trigger that the Pledge is mainly tied to, not the sub-trigger of the Action.")
+	desired_outcome = models.IntegerField(help_text="The outcome index that the Pledge desired.")
+	actor = models.ForeignKey(Actor, related_name="contribution_facts", on_delete=models.PROTECT, help_text="The Actor whose Action the contribution was made in reaction to.")
+	recipient = models.ForeignKey(Recipient, related_name="contribution_facts", on_delete=models.PROTECT, help_text="The Recipient the contribution was sent to.")
+	party = EnumField(ActorParty, blank=True, null=True, help_text="The party of the candidate the contribution was sent to.")
+	recipient_type = EnumField(ContributionRecipientType, help_text="Whether the contribution was to the incumbent or the challenger.")
+	amount_cents = models.IntegerField(help_text="The amount of the contribution in cents, negated for a reversal.")
+	campaign = models.ForeignKey('itfsite.Campaign', blank=True, null=True, related_name="contribution_facts", on_delete=models.PROTECT, help_text="The Campaign that the Pledge was made via.")
+	brand = models.IntegerField(blank=True, null=True, help_text="The brand of the Campaign that the Pledge was made via.")
+	date = models.DateField(db_index=True, help_text="The date the Pledge was executed.")
+
+	def __str__(self):
+		return "%d x $%0.2f to %s" % (self.count, self.amount_cents/100, self.recipient_id)
+
+	@staticmethod
+	def record(contributions, count=1):
+		# Add facts for Contributions, or with count=-1 reverse them.
+		facts = []
+		for c in contributions:
+			pledge = c.pledge_execution.pledge
+			facts.append(ContributionFact(
+				contribution_id=c.id,
+				count=count,
+				trigger_id=pledge.trigger_id,
+				desired_outcome=pledge.desired_outcome,
+				actor_id=c.action.actor_id,
+				recipient_id=c.recipient_id,
+				party=c.action.party if c.recipient_type == ContributionRecipientType.Incumbent else c.recipient.party,
+				recipient_type=c.recipient_type,
+				amount_cents=int(c.amount*100) * count,
+				campaign_id=pledge.via_campaign_id,
+				brand=pledge.via_campaign.brand if pledge.via_campaign_id else None,
+				date=c.pledge_execution.created.date(),
+			))
+		ContributionFact.objects.bulk_create(facts)
+
+	# The Contribution.aggregate fields that the facts can be grouped
+	# across, mapped to the model (or enum) of its values.
+	aggregate_across = {
+		"trigger": Trigger,
+		"desired_outcome": None,
+		"actor": Actor,
+		"recipient": Recipient,
+		"recipient_type": ContributionRecipientType,
+	}
+
+	# The Contribution.aggregate filters that the facts can answer, mapped
+	# to a fact field and a function to convert the filter value.
+	aggregate_filters = {
+		"trigger":                                ("trigger", lambda v : v),
+		"pledge_execution__trigger_execution":    ("trigger", lambda v : v.trigger_id),
+		"desired_outcome":                        ("desired_outcome", lambda v : v),
+		"pledge_execution__pledge__desired_outcome": ("desired_outcome", lambda v : v),
+		"actor":                                  ("actor", lambda v : v),
+		"action__actor":                          ("actor", lambda v : v),
+		"recipient":                              ("recipient", lambda v : v),
+		"recipient_type":                         ("recipient_type", lambda v : v),
+		"pledge_execution__pledge__via_campaign": ("campaign", lambda v : v),
+	}
+
+	@staticmethod
+	def aggregate(*across, **kwargs):
+		# Answer Contribution.aggregate from the facts, or return None if
+		# the facts don't have a field that is grouped across or filtered on.
+		if any(a not in ContributionFact.aggregate_across for a in across) \
+			or any(k not in ContributionFact.aggregate_filters for k in kwargs):
+			return None
+
+		facts = ContributionFact.objects.filter(**{
+			ContributionFact.aggregate_filters[k][0]: ContributionFact.aggregate_filters[k][1](v)
+			for (k, v) in kwargs.items() })
+
+		from contrib.reporting import get_columns, as_dollars, INT64
+
+		if len(across) == 0:
+			# Return a tuple (count, amount).
+			ret = facts.aggregate(count=models.Sum('count'), amount=models.Sum('amount_cents'))
+			return (ret["count"] or 0, as_dollars(ret["amount"] or 0))
+
+		# Return a list of (value, (count, amount)) like Contribution.aggregate,
+		# with the groups formed by numpy over the fetched columns.
+		import numpy
+		columns = get_columns(facts, [(a, INT64) for a in across] + [("count", INT64), ("amount_cents", INT64)])
+		counts = columns[-2]
+		if len(counts) == 0:
+			return []
+		amounts = columns[-1]
+		keys = numpy.stack(columns[:-2], axis=1)
+		keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+		inverse = inverse.reshape(-1)
+		counts = numpy.rint(numpy.bincount(inverse, weights=counts, minlength=len(keys))).astype(numpy.int64)
+		amounts = numpy.rint(numpy.bincount(inverse, weights=amounts, minlength=len(keys))).astype(numpy.int64)
+
+		# Map IDs back to object instances by getting the instances
+		# in bulk, and integers back to enum members.
+		values = { }
+		for i, a in enumerate(across):
+			cls = ContributionFact.aggregate_across[a]
+			if cls is None:
+				values[a] = lambda v : v
+			elif issubclass(cls, enum.Enum):
+				values[a] = cls
+			else:
+				values[a] = cls.objects.in_bulk(set(keys[:, i].tolist())).get
+
+		# Build up the list to return, skipping groups that were entirely
+		# reversed, and sort by amount, descending.
+		ret = []
+		for key, count, amount in zip(keys.tolist(), counts.tolist(), amounts.tolist()):
+			if count == 0:
+				continue
+			ret.append( (tuple(values[a](v) for (a, v) in zip(across, key)), (count, as_dollars(amount))) )
+		ret.sort(key = lambda item : item[1][1], reverse=True)
+		return ret
+
+#####################################################################
+#
+# Reconciliation
+#
+# Bookkeeping for checking our records against Democracy Engine's.
+#
+#####################################################################
+
+class ReconciliationCursor(models.Model):
+	"""Where the last run of de_reconcile left off, so that the next run can skip donations that have already been reconciled."""
+
+	name = models.CharField(max_length=32, unique=True, help_text="Identifies the reconciliation process that this cursor is for.")
+	updated = models.DateTimeField(auto_now=True)
+
+	last_donation_created_at = models.DateTimeField(blank=True, null=True, help_text="The creation time of the newest donation that has been reconciled.")
+	last_donation_id = models.CharField(max_length=64, blank=True, null=True, help_text="The Democracy Engine ID of the newest donation that has been reconciled.")
+
+	def __str__(self):
+		return "%s (%s)" % (self.name, self.last_donation_created_at)
+
+class ReconciliationVerdict(models.Model):
+	"""A fingerprint of a Pledge and its donation records at the last time they were found to reconcile, so that de_reconcile can skip the Pledge until something changes."""
+
+	pledge = models.OneToOneField(Pledge, related_name="reconciliation_verdict", on_delete=models.CASCADE, help_text="The Pledge that reconciled.")
+	fingerprint = models.CharField(max_length=40, help_text="A hash of the Pledge's state and its donation records.")
+	updated = models.DateTimeField(auto_now=True)
+
+	def __str__(self):
+		return "%s: %s" % (self.pledge_id, self.fingerprint)
@@ -0,0 +1,372 @@
+# Contribution totals reports
+# ---------------------------
+#
+# The totals reports (the /totals page and the trigger totals on campaign
+# pages) break down a slice of the pledges and contributions --- all of
+# them, those for a trigger, and/or those made via a campaign --- in many
+# different ways. fetch_report_data fetches the rows for the slice once as
+# compact columnar numpy arrays and computes all of the rollups from them in
+# memory. fetch_report_data_by_queries is the original implementation, which
+# asks the database for each rollup separately. It is kept as the reference
+# for the tests and the benchmark_reports command.
+#
+# The site-wide report (the /totals page) covers every pledge and
+# contribution, so rather than compute it on page views it is computed by
+# the refresh_totals_report command and the latest snapshot is kept in the
+# cache. See get_report_snapshot.
+
+import array
+import decimal
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy
+
+from django.core.cache import cache
+from django.db.models import Count, Sum, Min, Max
+from django.http import Http404
+from django.utils import timezone
+
+from contrib.models import TriggerExecution, Pledge, PledgeExecution, PledgeExecutionProblem, \
+	Contribution, ContributionFact, ContributionRecipientType, ActorParty, Action, Actor
+
+# Bump the version when the shape of the report changes so that old
+# snapshots are not used. After REPORT_SNAPSHOT_TTL, a snapshot is still
+# served but is refreshed in the background.
+REPORT_SNAPSHOT_VERSION = 1
+REPORT_SNAPSHOT_TTL = timedelta(hours=6)
+report_snapshot_lock = threading.Lock()
+report_snapshot_refreshing = False
+
+def get_report_snapshot_cache_key():
+	return "contrib_report_snapshot:%d" % REPORT_SNAPSHOT_VERSION
+
+def get_report_snapshot():
+	# Return the latest snapshot of the site-wide report, a dict with the
+	# report and the time it was computed as of. Only when there is no
+	# snapshot at all is it computed now.
+	snapshot = cache.get(get_report_snapshot_cache_key())
+	if snapshot is None:
+		snapshot = refresh_report_snapshot()
+	elif timezone.now() - snapshot["as_of"] > REPORT_SNAPSHOT_TTL:
+		refresh_report_snapshot_in_background()
+	return snapshot
+
+def refresh_report_snapshot():
+	# Compute the site-wide report and store it in the cache. The cache
+	# entry doesn't expire so that a stale copy is always available.
+	snapshot = {
+		"as_of": timezone.now(),
+		"report": fetch_report_data(None, None),
+	}
+	cache.set(get_report_snapshot_cache_key(), snapshot, None)
+	return snapshot
+
+def refresh_report_snapshot_in_background():
+	# Start a thread to refresh the snapshot, unless one is already running
+	# in this process. The lock in the cache (which expires on its own) keeps
+	# other processes from refreshing it at the same time.
+	# Returns the thread, or None if one is already running.
+	global report_snapshot_refreshing
+	with report_snapshot_lock:
+		if report_snapshot_refreshing:
+			return None
+		report_snapshot_refreshing = True
+
+	def refresh():
+		global report_snapshot_refreshing
+		from django.db import connection
+		lock_key = get_report_snapshot_cache_key() + ":refreshing"
+		try:
+			if cache.add(lock_key, True, 60*10):
+				try:
+					refresh_report_snapshot()
+				finally:
+					cache.delete(lock_key)
+		except Exception:
+			# Keep serving the stale snapshot, and try again on the next view.
+			logging.getLogger(__name__).exception("Refreshing the totals report snapshot failed.")
+		finally:
+			connection.close() # this thread's database connection
+			report_snapshot_refreshing = False
+
+	thread = threading.Thread(target=refresh)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+def get_report_slice(trigger, via_campaign):
+	# Returns the filters for the Pledges, PledgeExecutions and Contributions
+	# in the report.
+	pledge_slice_fields = { }
+	pledgeexec_slice_fields = { }
+	ca_slice_fields = { }
+
+	if trigger:
+		pledge_slice_fields["trigger"] = trigger
+		try:
+			te = trigger.execution
+		except TriggerExecution.DoesNotExist:
+			raise Http404("This trigger is not executed.")
+		if te.pledge_count_with_contribs == 0:
+			raise Http404("This trigger did not have any contributions.")
+		if te.pledge_count < .75 * trigger.pledge_count:
+			raise Http404("This trigger is still being executed.")
+		pledgeexec_slice_fields["trigger_execution"] = te
+		ca_slice_fields["pledge_execution__trigger_execution"] = te
+
+	if via_campaign:
+		pledge_slice_fields["via_campaign"] = via_campaign
+		pledgeexec_slice_fields["pledge__via_campaign"] = via_campaign
+		ca_slice_fields["pledge_execution__pledge__via_campaign"] = via_campaign
+
+	return pledge_slice_fields, pledgeexec_slice_fields, ca_slice_fields
+
+def fetch_report_data(trigger, via_campaign):
+	pledge_slice_fields, pledgeexec_slice_fields, ca_slice_fields = get_report_slice(trigger, via_campaign)
+
+	# form response
+	ret = { }
+
+	# number of pledges & users making pledges
+	users, amounts = get_columns(Pledge.objects.filter(**pledge_slice_fields), (("user", INT32), ("amount", CENTS)))
+	confirmed_users = users[users != 0]
+	pledges_per_user = numpy.unique(confirmed_users, return_counts=True)[1]
+	ret["users_pledging"] = len(pledges_per_user)
+	ret["users_pledging_twice"] = int((pledges_per_user > 1).sum())
+	ret["pledges"] = len(users)
+	ret["pledges_confirmed"] = len(confirmed_users)
+	ret["pledge_aggregate"] = as_dollars(amounts.sum()) if len(amounts) > 0 else None
+
+	# number of executed pledges and users with executed pledges
+	# (Pledges by anonymous users all count as one user, like a
+	# SELECT DISTINCT would count NULLs.)
+	executions = PledgeExecution.objects.filter(problem=PledgeExecutionProblem.NoProblem, **pledgeexec_slice_fields)
+	users, trigger_executions = get_columns(executions, (("pledge__user", INT32), ("trigger_execution", INT32)))
+	ret["users"] = len(numpy.unique(users))
+	ret["num_triggers"] = len(numpy.unique(trigger_executions))
+	if ret["num_triggers"] > 0:
+		dates = executions.aggregate(first=Min('created'), last=Max('created'))
+		ret["first_contrib_date"] = dates["first"]
+		ret["last_contrib_date"] = dates["last"]
+
+	# Fetch the contributions. When reporting on a trigger, actors are
+	# reported with their Action, and we need the desired outcome of the
+	# pledge that made the contribution. Otherwise the ContributionFact
+	# table has everything we need without joins, but it has a reversing
+	# fact (with a count of -1) for each deleted contribution, so rows are
+	# weighted by their count.
+	if trigger:
+		columns = get_columns(Contribution.objects.filter(**ca_slice_fields), (
+			("amount", CENTS), ("recipient_type", INT8), ("recipient__party", INT8), ("action", INT32),
+			("pledge_execution__pledge__desired_outcome", INT16)))
+		counts = None
+	else:
+		facts = ContributionFact.objects.all()
+		if via_campaign:
+			facts = facts.filter(campaign=via_campaign)
+		columns = get_columns(facts, (
+			("amount_cents", INT64), ("recipient_type", INT8), ("party", INT8), ("actor", INT32),
+			("count", INT8)))
+		counts = columns[4]
+		# Facts record the party of incumbents too, but the report groups
+		# by the Recipient's party, which incumbents don't have.
+		columns[2][columns[1] == ContributionRecipientType.Incumbent.value] = 0
+	amounts = columns[0]
+	recipient_types = columns[1]
+	parties = columns[2] # 0 for incumbents, which have no Recipient.party
+	actions_or_actors = columns[3]
+
+	# aggregate count and amount of campaign contributions
+	ret["total"] = { "count": len(amounts) if counts is None else int(counts.sum()), "total": as_dollars(amounts.sum()) }
+	if ret["total"]["count"] > 0:
+		ret["total"]["average"] = ret["total"]["total"] / ret["total"]["count"]
+
+	if trigger:
+		# Aggregates by outcome. Return in the same order as Trigger.outcomes
+		# (don't change that!).
+		ret['outcomes'] = []
+		outcome_totals = {
+			key: (count, total)
+			for (key, count, total)
+			in group_totals(columns[4], amounts) }
+		for outcome_index, outcome_info in enumerate(trigger.outcomes):
+			outcome_total = outcome_totals.get(outcome_index, (0, decimal.Decimal(0)))
+			ret['outcomes'].append({
+				"outcome": outcome_index,
+				"label": outcome_info['label'],
+				"total": outcome_total[1],
+				"count": outcome_total[0],
+			})
+
+	# Aggregates by actor. Group on the action or actor and the recipient
+	# type at once by combining them into a single key.
+	num_recipient_types = len(ContributionRecipientType)
+	actor_totals = group_totals(actions_or_actors.astype(numpy.int64) * num_recipient_types + recipient_types, amounts, counts)
+	if trigger:
+		objects = Action.objects.select_related('actor', 'execution', 'execution__trigger')
+	else:
+		objects = Actor.objects
+	objects = objects.in_bulk(set(key // num_recipient_types for (key, count, total) in actor_totals))
+	# (Plain dicts, not defaultdicts, so that the report can be pickled
+	# into the cache.)
+	ret['actors'] = { }
+	for (key, count, total) in actor_totals:
+		action_or_actor = objects[key // num_recipient_types]
+		recipient_type = ContributionRecipientType(key % num_recipient_types)
+		actor = action_or_actor.actor if trigger else action_or_actor
+		if actor.id not in ret['actors']:
+			ret['actors'][actor.id] = { "actor": actor, "Incumbent": decimal.Decimal(0), "GeneralChallenger": decimal.Decimal(0) }
+		actor_total = ret['actors'][actor.id]
+		actor_total[recipient_type.name] = actor_total.get(recipient_type.name, decimal.Decimal(0)) + total
+		if trigger: actor_total['action'] = action_or_actor
+	ret['actors'] = sorted(ret['actors'].values(), key = lambda x : (-(x['Incumbent'] - x['GeneralChallenger']), -x['Incumbent'], x['actor'].name_sort))
+
+	# Aggregates by incumbent/chalenger.
+	ret['by_recipient_type'] = [
+		{
+			"recipient_type": ContributionRecipientType(recipient_type).name,
+			"count": count,
+			"total": total,
+		}
+		for (recipient_type, count, total)
+		in group_totals(recipient_types, amounts, counts) ]
+
+	# Aggregates by party.
+	ret['by_party'] = [
+		{
+			"party": ActorParty(party) if party else None,
+			"count": count,
+			"total": total,
+		}
+		for (party, count, total)
+		in group_totals(parties, amounts, counts) ]
+
+	# report
+	return ret
+
+def as_int(value):
+	# IDs, integers, and enum members as integers, with nulls as zero.
+	return 0 if value is None else getattr(value, "value", value)
+
+def as_cents(value):
+	# Decimal dollar amounts as integer cents, so that sums are exact.
+	return int(value * 100)
+
+# Column types for get_columns: a function that converts the values from
+# the database and the typecode of the array (see the array module) that
+# holds them, which numpy reads as the same type.
+INT8 = (as_int, "b")
+INT16 = (as_int, "h")
+INT32 = (as_int, "i")
+INT64 = (as_int, "q")
+CENTS = (as_cents, "q")
+
+def get_columns(queryset, columns):
+	# Fetch the values of fields for the rows in the queryset in one query
+	# and return them as numpy arrays, one per (field, column type) in
+	# columns. The rows are streamed from the database and each value goes
+	# into a typed array as it arrives, so the result set is never held in
+	# memory as Python objects.
+	buffers = [array.array(typecode) for (field, (convert, typecode)) in columns]
+	appenders = [(buffer.append, convert) for buffer, (field, (convert, typecode)) in zip(buffers, columns)]
+	for row in queryset.values_list(*[field for (field, column_type) in columns]).iterator():
+		for (append, convert), value in zip(appenders, row):
+			append(convert(value))
+	return [numpy.array(buffer, dtype=buffer.typecode) for buffer in buffers]
+
+def as_dollars(cents):
+	return decimal.Decimal(int(cents)).scaleb(-2)
+
+def group_totals(keys, amounts, counts=None):
+	# Group the amounts (in cents) by the parallel array of keys and
+	# return a list of (key, count, total in dollars) tuples sorted by
+	# total, descending, like Contribution.aggregate. If counts is given,
+	# each row counts that many times (-1 for a reversing ContributionFact)
+	# and groups that net out to zero are left out. bincount sums the
+	# weights as floats, which is exact for totals of up to 2**53 cents.
+	keys, inverse = numpy.unique(keys, return_inverse=True)
+	inverse = inverse.reshape(-1)
+	if counts is None:
+		counts = numpy.bincount(inverse, minlength=len(keys))
+	else:
+		counts = numpy.rint(numpy.bincount(inverse, weights=counts, minlength=len(keys))).astype(numpy.int64)
+	totals = numpy.rint(numpy.bincount(inverse, weights=amounts, minlength=len(keys))).astype(numpy.int64)
+	order = numpy.argsort(-totals, kind="mergesort")
+	return [
+		(int(keys[i]), int(counts[i]), as_dollars(totals[i]))
+		for i in order
+		if counts[i] != 0 ]
+
+def fetch_report_data_by_queries(trigger, via_campaign):
+	pledge_slice_fields, pledgeexec_slice_fields, ca_slice_fields = get_report_slice(trigger, via_campaign)
+
+	# form response
+	ret = { }
+
+	# number of pledges & users making pledges
+	pledges = Pledge.objects.filter(**pledge_slice_fields)
+	ret["users_pledging"] = pledges.exclude(user=None).values("user").distinct().count()
+	ret["users_pledging_twice"] = pledges.exclude(user=None).values("user").annotate(count=Count('id')).filter(count__gt=1).count()
+	ret["pledges"] = pledges.count()
+	ret["pledges_confirmed"] = pledges.exclude(user=None).count()
+	ret["pledge_aggregate"] = pledges.aggregate(amount=Sum('amount'))["amount"]
+
+	# number of executed pledges and users with executed pledges
+	pledge_executions = PledgeExecution.objects.filter(problem=PledgeExecutionProblem.NoProblem, **pledgeexec_slice_fields)
+	ret["users"] = pledge_executions.values("pledge__user").distinct().count()
+	ret["num_triggers"] = pledge_executions.values("trigger_execution").distinct().count()
+	if ret["num_triggers"] > 0:
+		ret["first_contrib_date"] = pledge_executions.order_by('created').first().created
+		ret["last_contrib_date"] = pledge_executions.order_by('created').last().created
+
+	# aggregate count and amount of campaign contributions
+	ret["total"] = dict(zip(["count", "total"], Contribution.aggregate(**ca_slice_fields)))
+	if ret["total"]["count"] > 0:
+		ret["total"]["average"] = ret["total"]["total"] / ret["total"]["count"]
+
+	if trigger:
+		# Aggregates by outcome. Return in the same order as Trigger.outcomes
+		# (don't change that!).
+		ret['outcomes'] = []
+		outcome_totals = dict(Contribution.aggregate('desired_outcome', **ca_slice_fields))
+		for outcome_index, outcome_info in enumerate(trigger.outcomes):
+			outcome_total = outcome_totals.get((outcome_index,), (0, decimal.Decimal(0)))
+			ret['outcomes'].append({
+				"outcome": outcome_index,
+				"label": outcome_info['label'],
+				"total": outcome_total[1],
+				"count": outcome_total[0],
+			})
+
+	# Aggregates by actor.
+	ret['actors'] = defaultdict(lambda : defaultdict( lambda : decimal.Decimal(0) ))
+	for ((action_or_actor, recipient_type), (count, total)) in Contribution.aggregate('action' if trigger else "actor", 'recipient_type', **ca_slice_fields):
+		actor = action_or_actor.actor if trigger else action_or_actor
+		ret['actors'][actor.id]['actor'] = actor
+		ret['actors'][actor.id][recipient_type.name] += total
+		if trigger: ret['actors'][actor.id]['action'] = action_or_actor
+	ret['actors'] = sorted(ret['actors'].values(), key = lambda x : (-(x['Incumbent'] - x['GeneralChallenger']), -x['Incumbent'], x['actor'].name_sort))
+
+	# Aggregates by incumbent/chalenger.
+	ret['by_recipient_type'] = [
+		{
+			"recipient_type": recipient_type.name,
+			"count": count,
+			"total": total,
+		}
+		for ((recipient_type,), (count, total))
+		in Contribution.aggregate('recipient_type', **ca_slice_fields) ]
+
+	# Aggregates by party.
+	ret['by_party'] = defaultdict( lambda : [0, decimal.Decimal(0)] )
+	for ((recipient,), (count, total)) in Contribution.aggregate('recipient', **ca_slice_fields):
+		ret['by_party'][recipient.party][0] += count
+		ret['by_party'][recipient.party][1] += total
+	ret['by_party'] = [ { "party": party, "count": count, "total": total } for (party, (count, total)) in ret['by_party'].items() ]
+	ret['by_party'].sort(key = lambda item : item["total"], reverse=True)
+
+	# report
+	return ret
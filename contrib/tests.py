@@ -1,10 +1,19 @@
+import random
+from datetime import datetime, timedelta
 from decimal import Decimal
 from itertools import product
+from unittest import mock
 
+from django.core import mail
 from django.db.models import Sum
-from django.test import TestCase
+from django.template import Context
+from django.test import TestCase, override_settings
 
-from itfsite.models import User, Campaign
+from htmlemailer import send_mail
+
+from itfsite.models import User, Campaign, Notification, rank_campaigns
+from itfsite.middleware import get_branding
+from itfsite.utils import BatchMailer
 from contrib.models import *
 from contrib.de import DemocracyEngineAPIClient
 
@@ -20,6 +29,223 @@ class DEAPITestCase(TestCase):
 		self.assertEqual(f(Decimal('123')), '$123.00')
 		self.assertEqual(f(Decimal('1234')), '$1234.00')
 
+	def test_dummy_http(self):
+		from contrib.de import DummyDemocracyEngineAPIClient, HumanReadableValidationError
+		api = DummyDemocracyEngineAPIClient(http=True, pool_size=2)
+		try:
+			token = api.create_donation({ "token_request": True })["token"]
+			self.assertEqual(api.create_donation({ "token": token }), { "dummy_response": True })
+			with self.assertRaises(HumanReadableValidationError):
+				api.create_donation({ "token": "invalid" })
+		finally:
+			api.close()
+
+	def test_connection_pool(self):
+		import threading
+		from contrib.de import DummyDemocracyEngineAPIClient, DemocracyEngineAPIClient, DummyDemocracyEngineServer
+		api = DummyDemocracyEngineAPIClient(http=True, pool_size=4)
+		try:
+			# Sequential calls, including the meta info request, reuse one
+			# kept-alive connection.
+			for i in range(5):
+				api.create_donation({ "token_request": True })
+			poolmanager = api.client.http_adapter.poolmanager
+			self.assertEqual(len(poolmanager.pools), 1)
+			pool = poolmanager.pools[list(poolmanager.pools.keys())[0]]
+			self.assertEqual(pool.num_requests, 6)
+			self.assertEqual(pool.num_connections, 1)
+
+			# Each thread gets its own Session, mounted on the shared adapter.
+			sessions = []
+			def call():
+				api.create_donation({ "token_request": True })
+				sessions.append(api.client.get_session())
+			threads = [threading.Thread(target=call) for i in range(3)]
+			for t in threads: t.start()
+			for t in threads: t.join()
+			self.assertEqual(len(set(id(s) for s in sessions)), 3)
+			for s in sessions:
+				self.assertIs(s.get_adapter(api.server.url), api.client.http_adapter)
+			self.assertIsNot(api.client.get_session(), sessions[0])
+
+			# The meta info is shared with other clients through the cache.
+			cache = { }
+			class DictCache:
+				def get(self, key): return cache.get(key)
+				def set(self, key, value, timeout): cache[key] = value
+			api.client.meta_info_cache = DictCache()
+			api.client.refresh_meta_info()
+			client2 = DemocracyEngineAPIClient(api.server.url, DummyDemocracyEngineServer.ACCOUNT_NUMBER,
+				"dummy", "dummy", api.fees_recipient_id, meta_info_cache=DictCache())
+			client2.load_cached_meta_info()
+			self.assertEqual(client2.de_meta_info, api.client.de_meta_info)
+		finally:
+			api.close()
+
+	def test_warm_up(self):
+		# The meta info is loaded in a background thread.
+		import contrib.bizlogic
+		from contrib.de import DummyDemocracyEngineAPIClient
+		api = DummyDemocracyEngineAPIClient(http=True)
+		original = contrib.bizlogic.DemocracyEngineAPI
+		contrib.bizlogic.DemocracyEngineAPI = api
+		try:
+			self.assertIsNone(api.client.de_meta_info)
+			contrib.bizlogic.warm_up_democracy_engine().join()
+			self.assertIsNotNone(api.client.de_meta_info)
+		finally:
+			contrib.bizlogic.DemocracyEngineAPI = original
+			api.close()
+
+	def test_concurrent_client(self):
+		from contrib.de import DummyDemocracyEngineAPIClient, ConcurrentDemocracyEngineAPIClient, HumanReadableValidationError
+		api = DummyDemocracyEngineAPIClient(http=True)
+		concurrent_api = ConcurrentDemocracyEngineAPIClient(api.client, max_concurrency=3, max_per_second=100)
+		try:
+			results = concurrent_api.run_all(
+				[("create_donation", ({ "token_request": True },))] * 10
+				+ [("create_donation", ({ "token": "invalid" },))])
+			self.assertEqual(len(set(r["token"] for r in results[:10])), 10)
+			self.assertIsInstance(results[10], HumanReadableValidationError)
+			self.assertIn("token", concurrent_api.create_donation({ "token_request": True }).result())
+		finally:
+			concurrent_api.close()
+			api.close()
+
+	def test_concurrent_client_limits(self):
+		# No more than max_concurrency calls are in flight, and calls start
+		# no more often than max_per_second.
+		import threading, time
+		from contrib.de import ConcurrentDemocracyEngineAPIClient
+		class SlowClient:
+			in_flight = 0
+			max_in_flight = 0
+			lock = threading.Lock()
+			def get_transaction(self, id, live_request=False):
+				with self.lock:
+					self.in_flight += 1
+					self.max_in_flight = max(self.max_in_flight, self.in_flight)
+				time.sleep(.02)
+				with self.lock:
+					self.in_flight -= 1
+				return id
+		client = SlowClient()
+		concurrent_api = ConcurrentDemocracyEngineAPIClient(client, max_concurrency=3, max_per_second=50)
+		try:
+			start = time.monotonic()
+			self.assertEqual([f.result() for f in [concurrent_api.get_transaction(i) for i in range(10)]], list(range(10)))
+			self.assertGreaterEqual(time.monotonic() - start, 9/50)
+		finally:
+			concurrent_api.close()
+		self.assertLessEqual(client.max_in_flight, 3)
+
+	def test_benchmark_de(self):
+		from django.core.management import call_command
+		call_command('benchmark_de', requests=10, threads=2, pool_size=2)
+
+	def test_iter_donation_pages(self):
+		from contrib.de import DummyDemocracyEngineAPIClient
+		for http in (False, True):
+			api = DummyDemocracyEngineAPIClient(http=http)
+			try:
+				api.donation_records = [{ "donation_id": i } for i in range(25)]
+				pages = list(api.iter_donation_pages(page_size=10))
+				self.assertEqual([len(page) for page in pages], [10, 10, 5])
+				self.assertEqual(sum(pages, []), api.donation_records)
+				self.assertEqual(len(list(api.iter_donation_pages(page_size=10, max_pages=2))), 2)
+
+				# When the last page is full, the next page is empty.
+				api.donation_records = api.donation_records[:20]
+				self.assertEqual(len(list(api.iter_donation_pages(page_size=10))), 2)
+			finally:
+				api.close()
+
+		# If DE ignores the page parameter and returns the same page each
+		# time, stop instead of looping forever.
+		api = DummyDemocracyEngineAPIClient()
+		api.donation_records = [{ "donation_id": i } for i in range(25)]
+		api.get_donations_page = lambda page, page_size, live_request=False : api.donation_records[:page_size]
+		self.assertEqual(len(list(api.iter_donation_pages(page_size=10))), 1)
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class BatchMailerTest(TestCase):
+	def setUp(self):
+		self.context = { }
+		self.context.update(get_branding("if.then.fund"))
+		self.context.update({ "url": "https://example.com/return", "confirmation_url": "https://example.com/confirm" })
+
+	def test_batch_mailer(self):
+		# Messages rendered by the BatchMailer are the same as htmlemailer's,
+		# for text & HTML templates and for Markdown templates.
+		for template in ("contrib/mail/incomplete_pledge", "contrib/mail/confirm_email"):
+			mail.outbox = []
+			send_mail(template, self.context["MAIL_FROM_EMAIL"], ["user@example.com"], self.context)
+			sent = []
+			with mock.patch('django.core.mail.get_connection', wraps=mail.get_connection) as get_connection:
+				with BatchMailer(batch_size=2, on_sent=sent.append) as mailer:
+					for i in range(5):
+						mailer.send(template, self.context["MAIL_FROM_EMAIL"], ["user@example.com"], self.context, key=i)
+
+			# One connection and one on_sent call per batch.
+			self.assertEqual(get_connection.call_count, 3)
+			self.assertEqual(sent, [[0, 1], [2, 3], [4]])
+
+			self.assertEqual(len(mail.outbox), 6)
+			for msg in mail.outbox[1:]:
+				self.assertEqual(msg.subject, mail.outbox[0].subject)
+				self.assertEqual(msg.body, mail.outbox[0].body)
+				self.assertEqual(msg.alternatives, mail.outbox[0].alternatives)
+
+	def test_failure_part_way(self):
+		# The messages sent before a failure are recorded as sent, even
+		# in the middle of a batch.
+		sent = []
+		with self.assertRaises(OSError):
+			with BatchMailer(batch_size=10, on_sent=sent.append) as mailer:
+				for i in range(5):
+					if i == 3:
+						raise OSError()
+					mailer.send("contrib/mail/incomplete_pledge", self.context["MAIL_FROM_EMAIL"], ["user@example.com"], self.context, key=i)
+		self.assertEqual(sent, [[0, 1, 2]])
+		self.assertIsNone(mailer.connection)
+
+	def test_render_email_templates(self):
+		# render_email_templates, which wraps htmlemailer's helper functions,
+		# renders real templates the same way as htmlemailer.send_mail.
+		from itfsite.utils import render_email_templates
+		for template in ("contrib/mail/incomplete_pledge", "contrib/mail/confirm_email"):
+			mail.outbox = []
+			send_mail(template, self.context["MAIL_FROM_EMAIL"], ["user@example.com"], self.context)
+			subject, text_body, html_body = render_email_templates(BatchMailer().get_templates(template), self.context)
+			self.assertEqual(subject, mail.outbox[0].subject)
+			self.assertEqual(text_body, mail.outbox[0].body)
+			self.assertEqual([(html_body, "text/html")], mail.outbox[0].alternatives)
+
+class NotificationTemplateCacheTest(TestCase):
+	def test_template_cache(self):
+		source = "Hello {{name}}. (%s)" % random.random()
+		info = Notification.get_template.cache_info()
+		t = Notification.get_template(source)
+		self.assertIs(Notification.get_template(source), t)
+		self.assertEqual(t.render(Context({ "name": "world" })), "Hello world. (%s)" % source.split("(")[1][:-1])
+		self.assertEqual(Notification.get_template.cache_info().misses, info.misses + 1)
+		self.assertEqual(Notification.get_template.cache_info().hits, info.hits + 1)
+
+class RankCampaignsTest(TestCase):
+	def test_rank_campaigns(self):
+		t0 = datetime(2016, 1, 1)
+		campaigns = [
+			(1, t0, Decimal(100)), # oldest and most popular
+			(2, t0 + timedelta(days=10), Decimal(1)), # newest, a little activity
+			(3, t0 + timedelta(days=5), Decimal(25)),
+			(4, t0 + timedelta(days=9), Decimal(0)), # no activity
+			(5, t0 + timedelta(days=8), None), # no executed trigger
+		]
+		self.assertEqual(rank_campaigns(campaigns, 12), [2, 3, 1])
+		self.assertEqual(rank_campaigns(campaigns, 2), [2, 3])
+		self.assertEqual(rank_campaigns(campaigns, 1), [2])
+		self.assertEqual(rank_campaigns(campaigns[3:], 12), [])
+
 def create_trigger(trigger_type, key, title):
 	trigger = Trigger.objects.create(
 		key=key,
@@ -83,6 +309,46 @@ class PledgeTestCase(TestCase):
 		self.assertEqual(p.made_after_trigger_execution, False)
 		self.assertEqual(p.targets_summary, expected_value)
 
+	def test_minimum_pledge(self):
+		# One cent to each of 100 recipients plus fees is $1.29.
+		self.assertEqual(self.trigger.get_minimum_pledge(), Decimal('1.29'))
+		self.assertEqual(self.trigger.get_suggested_pledge(), Decimal('2.50'))
+		alg = Pledge.current_algorithm()
+		self.assertEqual(alg['fees_multiplier'], 1 + alg['fees_percent'])
+		with self.assertRaises(TypeError):
+			alg['fees_fixed'] = 0 # algorithms are read-only
+
+	def test_iter_batches(self):
+		# Keyset batches visit every object once even when the loop
+		# changes the objects so they no longer match the filter.
+		from taskutils import iter_batches, iter_in_batches
+		ids = [ContributorInfo.objects.create(extra={ }).id for i in range(7)]
+		qs = ContributorInfo.objects.filter(id__in=ids, is_geocoded=False)
+		batches = []
+		for batch in iter_batches(qs, batch_size=3):
+			batches.append([ci.id for ci in batch])
+			ContributorInfo.objects.filter(id__in=batches[-1]).update(is_geocoded=True)
+		self.assertEqual(batches, [ids[0:3], ids[3:6], ids[6:7]])
+		self.assertEqual([ci.id for ci in iter_in_batches(ContributorInfo.objects.filter(id__in=ids), batch_size=2, atomic=True)], ids)
+
+	def test_compute_charges(self):
+		# The batch integer-cents computation must match the exact decimal
+		# computation for every pledge, including the ones that can't be
+		# split (None).
+		import random
+		from contrib.bizlogic import compute_charge_amounts, compute_charges, HumanReadableValidationError
+		rnd = random.Random(0)
+		pledges, recipient_counts = [], []
+		for i in range(5000):
+			pledges.append(Pledge(amount=Decimal(rnd.randint(1, rnd.choice([300, 5000, 100000]))).scaleb(-2)))
+			recipient_counts.append(rnd.randint(0, rnd.choice([3, 20, 600])))
+		for pledge, num_recipients, charge in zip(pledges, recipient_counts, compute_charges(pledges, recipient_counts)):
+			try:
+				expected = compute_charge_amounts(pledge, num_recipients) if num_recipients > 0 else None
+			except HumanReadableValidationError:
+				expected = None
+			self.assertEqual(charge, expected, msg="%s across %d" % (pledge.amount, num_recipients))
+
 	def test_pledge_simple(self):
 		self._test_pledge(0, 0, None, "up to 100 ACTORS, each getting a part of your contribution if they ACT Yes, but if they ACT No their part of your contribution will go to their next general election opponent")
 
@@ -268,6 +534,187 @@ class ExecutionTestCase(TestCase):
 			self.assertEqual(action.total_contributions_for, 0)
 			self.assertEqual(action.total_contributions_against, 0)
 
+	def test_pledge_recipient_index(self):
+		"""Tests that a shared PledgeRecipientIndex gives the same recipients without re-querying."""
+		from contrib.bizlogic import PledgeRecipientIndex, get_pledge_recipients
+		self.test_trigger_execution()
+		t = Trigger.objects.get(key="test")
+		index = PledgeRecipientIndex()
+		index.load([t.id])
+		for desired_outcome in (0, 1):
+			for incumb_challgr in (-1, 0, 1):
+				for filter_party in (None, ActorParty.Democratic, ActorParty.Republican):
+					p = Pledge(trigger=t, desired_outcome=desired_outcome, incumb_challgr=incumb_challgr, filter_party=filter_party)
+					with self.assertNumQueries(0):
+						recipients = index.get_recipients(p)
+					self.assertEqual(recipients, get_pledge_recipients(p))
+
+	def test_recipient_matrix(self):
+		"""Tests that the stored recipient matrix matches computed recipients and is invalidated."""
+		from contrib.bizlogic import PledgeRecipientIndex, get_pledge_recipient_ids, count_pledge_recipients
+		self.test_trigger_execution()
+		t = Trigger.objects.get(key="test")
+		self.assertIsNotNone(t.execution.recipient_matrix)
+		for desired_outcome in (0, 1):
+			for incumb_challgr in (-1, 0, 1):
+				for filter_party in (None, ActorParty.Democratic, ActorParty.Republican):
+					p = Pledge(trigger=t, desired_outcome=desired_outcome, incumb_challgr=incumb_challgr, filter_party=filter_party)
+					self.assertEqual(
+						get_pledge_recipient_ids(p),
+						[(a.id, rt, r.id) for a, rt, r in PledgeRecipientIndex().get_recipients(p)])
+
+		# A shared PledgeRecipientIndex loads the matrix once.
+		index = PledgeRecipientIndex()
+		p = Pledge(trigger=t, desired_outcome=0, incumb_challgr=0, filter_party=None)
+		expected = get_pledge_recipient_ids(p)
+		with self.assertNumQueries(1):
+			for i in range(3):
+				self.assertEqual(get_pledge_recipient_ids(p, recipient_index=index), expected)
+				self.assertEqual(count_pledge_recipients(p, recipient_index=index), len(expected))
+
+		# Making an Actor inactive clears the matrix, and it is rebuilt without the Actor.
+		p = Pledge(trigger=t, desired_outcome=0, incumb_challgr=0, filter_party=None)
+		count = count_pledge_recipients(p)
+		action = t.execution.actions.exclude(outcome=None).first()
+		action.actor.inactive_reason = "Retiring."
+		action.actor.save()
+		self.assertIsNone(TriggerExecution.objects.get(id=t.execution.id).recipient_matrix)
+		self.assertEqual(count_pledge_recipients(p), count - 1)
+		self.assertIsNotNone(TriggerExecution.objects.get(id=t.execution.id).recipient_matrix)
+
+	def test_pledge_recipient_breakdown(self):
+		"""Tests that the cached recipient breakdown is invalidated when an Actor changes."""
+		from contrib.bizlogic import get_pledge_recipient_breakdown, compute_pledge_recipient_breakdown
+		self.test_trigger_execution()
+		t = Trigger.objects.get(key="test")
+		total = lambda breakdown : sum(rec["count"] for rec in breakdown[0])
+		breakdown = get_pledge_recipient_breakdown(t)
+		self.assertEqual(breakdown, compute_pledge_recipient_breakdown(t))
+		self.assertEqual(get_pledge_recipient_breakdown(t), breakdown)
+
+		action = t.execution.actions.exclude(outcome=None).first()
+		action.actor.inactive_reason = "Retiring."
+		action.actor.save()
+		t = Trigger.objects.get(key="test")
+		self.assertEqual(total(get_pledge_recipient_breakdown(t)), total(breakdown) - 1)
+
+		# So is deleting an Action.
+		t.execution.actions.exclude(outcome=None).exclude(actor=action.actor).first().delete()
+		t = Trigger.objects.get(key="test")
+		self.assertEqual(total(get_pledge_recipient_breakdown(t)), total(breakdown) - 2)
+
+	def test_trigger_cache_key(self):
+		"""Tests that the cache key of a nested super-trigger changes when an Action of an inner trigger changes."""
+		from contrib.bizlogic import get_trigger_cache_key
+		self.test_trigger_execution()
+		t = Trigger.objects.get(key="test")
+		st = t
+		for i in range(2):
+			st = Trigger.objects.create(
+				trigger_type=t.trigger_type,
+				title="Super %d" % i,
+				description="",
+				outcomes=t.outcomes,
+				status=TriggerStatus.Executed,
+				extra={ "subtriggers": [{ "trigger": st.id, "outcome-map": [0, 1] }] },
+			)
+		key = get_trigger_cache_key("test", st)
+		self.assertEqual(get_trigger_cache_key("test", st), key)
+
+		# Saving an Action without changes doesn't change the key.
+		action = t.execution.actions.exclude(outcome=None).first()
+		action.save()
+		self.assertEqual(get_trigger_cache_key("test", st), key)
+
+		action.outcome = 1 - action.outcome
+		action.save()
+		key2 = get_trigger_cache_key("test", st)
+		self.assertNotEqual(key2, key)
+
+		action.delete()
+		self.assertNotEqual(get_trigger_cache_key("test", st), key2)
+
+	def test_max_split(self):
+		"""Tests max_split for regular and super-triggers and that it is invalidated when an Action changes."""
+		self.test_trigger_execution()
+		t = Trigger.objects.get(key="test")
+		count = t.execution.actions.exclude(outcome=None).count()
+		self.assertEqual(t.max_split(), count)
+
+		# A super-trigger that includes the trigger twice.
+		st = Trigger.objects.create(
+			trigger_type=t.trigger_type,
+			title="Super",
+			description="",
+			outcomes=t.outcomes,
+			status=TriggerStatus.Executed,
+			extra={ "subtriggers": [{ "trigger": t.id, "outcome-map": [0, 1] }] * 2 },
+		)
+		self.assertEqual(st.max_split(), 2*count)
+
+		# Clearing an Action's outcome invalidates the cached value.
+		action = t.execution.actions.exclude(outcome=None).first()
+		action.outcome = None
+		action.save()
+		self.assertEqual(Trigger.objects.get(key="test").max_split(), count - 1)
+		self.assertEqual(Trigger.objects.get(id=st.id).max_split(), 2*(count - 1))
+
+		# A super-trigger of the super-trigger, whose cached value is
+		# invalidated when an Action of the innermost trigger is deleted.
+		sst = Trigger.objects.create(
+			trigger_type=t.trigger_type,
+			title="Super Super",
+			description="",
+			outcomes=t.outcomes,
+			status=TriggerStatus.Executed,
+			extra={ "subtriggers": [{ "trigger": st.id, "outcome-map": [0, 1] }] },
+		)
+		self.assertEqual(sst.max_split(), 2*(count - 1))
+		t.execution.actions.exclude(outcome=None).first().delete()
+		self.assertEqual(Trigger.objects.get(id=sst.id).max_split(), 2*(count - 2))
+
+	def test_executable_pledges(self):
+		"""Tests that Pledge.get_executable_pledges applies the same rules as Pledge.can_execute."""
+		from datetime import timedelta
+		from django.utils.timezone import now
+		self.test_trigger_execution()
+		t = Trigger.objects.get(key="test")
+		ci = ContributorInfo.objects.create(extra={ })
+		recently, long_ago = now() - timedelta(minutes=5), now() - timedelta(days=5)
+		# (A user can make only one Pledge per Trigger, so each combination
+		# gets its own user.)
+		for i, (algorithm, made_after_trigger_execution, email_confirmed_at, pre_execution_email_sent_at) \
+			in enumerate(product((0, Pledge.current_algorithm()['id']), (False, True), (None, long_ago, now()), (None, recently, long_ago))):
+			Pledge.objects.create(
+				user=User.objects.create(email="executable-%d@example.com" % i),
+				trigger=t,
+				via_campaign=self.campaign,
+				profile=ci,
+				algorithm=algorithm,
+				made_after_trigger_execution=made_after_trigger_execution,
+				email_confirmed_at=email_confirmed_at,
+				pre_execution_email_sent_at=pre_execution_email_sent_at,
+				desired_outcome=0,
+				amount=10,
+				incumb_challgr=0,
+			)
+
+		enforce_delay = Pledge.ENFORCE_EXECUTION_EMAIL_DELAY
+		try:
+			for enforce in (True, False):
+				Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = enforce
+				expected = [p.id for p in Pledge.objects.order_by('id') if p.can_execute()]
+				self.assertTrue(len(expected) > 0)
+				self.assertEqual([p.id for p in Pledge.get_executable_pledges()], expected)
+
+				# execute_pledges --workers splits them into disjoint shards.
+				from contrib.management.commands.execute_pledges import Command
+				shards = [[p.id for p in Command().get_pledges_to_execute(shard, 3)] for shard in range(3)]
+				self.assertEqual(sorted(sum(shards, [])), expected)
+				self.assertTrue(all(p_id % 3 == shard for shard in range(3) for p_id in shards[shard]))
+		finally:
+			Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = enforce_delay
+
 	def test_pledge_execution_a(self):
 		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
 			expected_contrib_amount=Decimal('0.33'))
@@ -300,6 +747,260 @@ class ExecutionTestCase(TestCase):
 		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=-1, filter_party=ActorParty.Democratic,
 			expected_contrib_amount=Decimal('1.28'))
 
+	def test_pledge_execution_deferred_aggregates(self):
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'), defer_aggregates=True)
+
+		# The rebuilt totals match the incrementally updated ones.
+		from contrib.management.commands.rebuild_aggregates import Command
+		cmd = Command()
+		for model, totals in ((Action, cmd.get_action_totals()), (TriggerExecution, cmd.get_triggerexecution_totals())):
+			self.assertEqual(cmd.rebuild(model, totals), 0)
+
+	def test_campaign_totals(self):
+		# The materialized campaign totals are marked stale by pledge execution,
+		# served stale while they are refreshed in the background, and then
+		# match freshly computed totals.
+		from io import StringIO
+		from contextlib import redirect_stdout
+		from django.core.management import call_command
+		from django.core.cache import cache
+		from itfsite.models import CampaignTotals, get_homepage_campaigns_cache_key
+		self.assertEqual(self.campaign.get_contrib_totals()["contrib_total"], 0)
+		stale_totals = CampaignTotals.objects.get(campaign=self.campaign).totals
+
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'))
+		self.assertTrue(CampaignTotals.objects.get(campaign=self.campaign).stale)
+
+		with mock.patch.object(CampaignTotals, 'refresh_in_background') as refresh_in_background:
+			campaign = Campaign.objects.get(id=self.campaign.id)
+			self.assertEqual(campaign.get_contrib_totals()["contrib_total"], 0)
+			self.assertEqual(refresh_in_background.call_count, 1)
+
+		with redirect_stdout(StringIO()):
+			call_command('refresh_campaign_totals')
+		self.assertFalse(CampaignTotals.objects.get(campaign=self.campaign).stale)
+		campaign = Campaign.objects.get(id=self.campaign.id)
+		totals = campaign.get_contrib_totals()
+		self.assertTrue(totals["contrib_total"] > 0)
+		self.assertEqual(len(totals["by_trigger"]), 1)
+		self.assertEqual(totals, CampaignTotals.deserialize(CampaignTotals.serialize(campaign.compute_contrib_totals())))
+
+		# Changing the campaign's triggers, from either side, marks the totals
+		# stale and clears the homepage ranking of the campaign's brand, but
+		# not the rankings of other brands.
+		trigger = Trigger.objects.get(key="test")
+		homepage_key = get_homepage_campaigns_cache_key(self.campaign.brand)
+		other_homepage_key = get_homepage_campaigns_cache_key(self.campaign.brand + 1)
+		for change in (lambda : self.campaign.contrib_triggers.remove(trigger), lambda : self.campaign.contrib_triggers.add(trigger),
+		               lambda : trigger.campaigns.clear(), lambda : trigger.campaigns.add(self.campaign)):
+			CampaignTotals.objects.filter(campaign=self.campaign).update(stale=False)
+			cache.set(homepage_key, [])
+			cache.set(other_homepage_key, [])
+			change()
+			self.assertTrue(CampaignTotals.objects.get(campaign=self.campaign).stale)
+			self.assertIsNone(cache.get(homepage_key))
+			self.assertEqual(cache.get(other_homepage_key), [])
+
+		# A change that didn't mark the totals stale is corrected by --all.
+		CampaignTotals.objects.filter(campaign=self.campaign).update(totals=stale_totals, stale=False)
+		output = StringIO()
+		with redirect_stdout(output):
+			call_command('refresh_campaign_totals', all=True)
+		self.assertIn("1 of which were out of date", output.getvalue())
+		self.assertEqual(Campaign.objects.get(id=self.campaign.id).get_contrib_totals(), totals)
+
+	def test_report_data(self):
+		# The single-pass report matches the query-per-rollup report.
+		from contrib.reporting import fetch_report_data, fetch_report_data_by_queries
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'))
+		trigger = Trigger.objects.get(key="test")
+		for (t, via_campaign) in ((None, None), (trigger, None), (trigger, self.campaign)):
+			expected = fetch_report_data_by_queries(t, via_campaign)
+			report = fetch_report_data(t, via_campaign)
+			self.assertEqual(report["total"]["count"], 27)
+
+			# Groups with equal totals may come back in any order.
+			for (key, group) in (("by_recipient_type", "recipient_type"), ("by_party", "party")):
+				expected[key].sort(key = lambda item : str(item[group]))
+				report[key].sort(key = lambda item : str(item[group]))
+			self.assertEqual(report, expected)
+
+	def test_contribution_facts(self):
+		# Contribution.aggregate answers from the fact table, and the answers
+		# match the ones computed from the Contributions, also after a
+		# Contribution is deleted and its fact is reversed.
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'))
+		trigger = Trigger.objects.get(key="test")
+		self.assertEqual(ContributionFact.objects.count(), 27)
+		for deleted in (False, True):
+			if deleted:
+				Contribution.objects.first().delete()
+			self.assertEqual(Contribution.aggregate(trigger=trigger), Contribution.aggregate_contributions(trigger=trigger))
+			self.assertEqual(Contribution.aggregate(trigger=trigger)[0], 26 if deleted else 27)
+			for across in (("desired_outcome",), ("actor", "recipient_type"), ("recipient",)):
+				self.assertIsNotNone(ContributionFact.aggregate(*across, trigger=trigger))
+				self.assertEqual(
+					dict(Contribution.aggregate(*across, trigger=trigger)),
+					dict(Contribution.aggregate_contributions(*across, trigger=trigger)))
+
+			# The site-wide report reads the facts too.
+			from contrib.reporting import fetch_report_data
+			report = fetch_report_data(None, None)
+			self.assertEqual(
+				(report["total"]["count"], report["total"]["total"]),
+				Contribution.aggregate_contributions())
+			self.assertEqual(
+				{ item["recipient_type"]: (item["count"], item["total"]) for item in report["by_recipient_type"] },
+				{ recipient_type.name: value for ((recipient_type,), value) in Contribution.aggregate_contributions("recipient_type") })
+
+	def test_report_snapshot(self):
+		# The site-wide report is served from the last snapshot until it is refreshed.
+		from django.core.cache import cache
+		from contrib.reporting import get_report_snapshot, refresh_report_snapshot, get_report_snapshot_cache_key
+		cache.delete(get_report_snapshot_cache_key())
+		snapshot = get_report_snapshot()
+		self.assertEqual(snapshot["report"]["total"]["count"], 0)
+
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'))
+		self.assertEqual(get_report_snapshot()["as_of"], snapshot["as_of"])
+		self.assertEqual(get_report_snapshot()["report"]["total"]["count"], 0)
+
+		refresh_report_snapshot()
+		self.assertEqual(get_report_snapshot()["report"]["total"]["count"], 27)
+
+		# The snapshot must survive the cache's pickling.
+		import pickle
+		report = get_report_snapshot()["report"]
+		self.assertTrue(len(report["actors"]) > 0)
+		self.assertEqual(pickle.loads(pickle.dumps(report)), report)
+
+	def test_report_snapshot_refresh_failure(self):
+		# A failed refresh in the background is logged, and the next one isn't
+		# locked out.
+		from django.core.cache import cache
+		from contrib.reporting import refresh_report_snapshot_in_background, get_report_snapshot_cache_key
+		with mock.patch('contrib.reporting.refresh_report_snapshot', side_effect=ValueError("failed")):
+			with self.assertLogs('contrib.reporting', 'ERROR'):
+				refresh_report_snapshot_in_background().join()
+		self.assertIsNone(cache.get(get_report_snapshot_cache_key() + ":refreshing"))
+
+	def make_de_donation(self, donation_id, created_at, pledge=None, status="captured", amount=None):
+		# Make a donation record like the ones the DE API lists. Without a
+		# pledge, it is an authorization test (which isn't reconciled).
+		import rtyaml
+		from contrib.de import DemocracyEngineAPIClient
+		if pledge is None:
+			return { "donation_id": donation_id, "created_at": created_at, "authtest_request": True }
+		return {
+			"donation_id": donation_id,
+			"created_at": created_at,
+			"authtest_request": False,
+			"authcapture_request": True,
+			"aux_data": rtyaml.dump({ "pledge": pledge.id }),
+			"line_items": [{
+				"status": status,
+				"transaction_amount": DemocracyEngineAPIClient.format_decimal(pledge.execution.charged if amount is None else amount),
+				"transaction_error": None,
+				"transaction_guid": "txn-%s" % donation_id,
+			}],
+		}
+
+	def run_de_reconcile(self, donation_records, **options):
+		# Run de_reconcile against the given DE donation records and
+		# return what it printed.
+		from io import StringIO
+		from contextlib import redirect_stdout
+		from unittest import mock
+		from django.core.management import call_command
+		from contrib.de import DummyDemocracyEngineAPIClient
+		api = DummyDemocracyEngineAPIClient()
+		api.donation_records = donation_records
+		output = StringIO()
+		with mock.patch('contrib.management.commands.de_reconcile.DemocracyEngineAPI', api), redirect_stdout(output):
+			call_command('de_reconcile', **options)
+		return output.getvalue()
+
+	def test_de_reconcile_stream(self):
+		# A pledge whose donations are split across pages is checked as a
+		# whole, in --stream mode.
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'))
+		p = Pledge.objects.get()
+		donations = [
+			self.make_de_donation("6", "2016-01-06T00:00:00Z", p),
+			self.make_de_donation("5", "2016-01-05T00:00:00Z"),
+			self.make_de_donation("4", "2016-01-04T00:00:00Z"),
+			self.make_de_donation("3", "2016-01-03T00:00:00Z"),
+			self.make_de_donation("2", "2016-01-02T00:00:00Z"),
+			self.make_de_donation("1", "2016-01-01T00:00:00Z", p, status="voided"),
+		]
+		output = self.run_de_reconcile(donations, stream=True, page_size=2)
+		self.assertIn("1 pledge(s) checked, 0 skipped", output)
+		self.assertNotIn("more than one donation", output)
+		self.assertNotIn("only voided/credited", output)
+		self.assertEqual(ReconciliationVerdict.objects.get(pledge=p).fingerprint, self.get_de_reconcile_fingerprint(p, [donations[0], donations[-1]]))
+
+		# The next run skips the pledge. It fetches past the donations it
+		# already saw until it has all of the pledge's donations.
+		output = self.run_de_reconcile(donations, stream=True, page_size=2)
+		self.assertIn("0 pledge(s) checked, 1 skipped", output)
+
+		# Two active donations on different pages are reported.
+		donations[-1] = self.make_de_donation("1", "2016-01-01T00:00:00Z", p)
+		output = self.run_de_reconcile(donations, stream=True, page_size=2, full=True)
+		self.assertIn("has more than one donation", output)
+
+		# The pages stop at --max-pages.
+		output = self.run_de_reconcile(donations, stream=True, page_size=2, max_pages=2, full=True)
+		self.assertIn("1 pledge(s) checked", output)
+
+	def test_de_reconcile_incremental(self):
+		# Pledges that reconciled are skipped until they change, and an
+		# incremental run stops fetching at the donations it already saw.
+		self._pledge_execution(desired_outcome=0, amount=10, incumb_challgr=0, filter_party=None,
+			expected_contrib_amount=Decimal('0.33'))
+		p = Pledge.objects.get()
+		donations = [
+			self.make_de_donation("3", "2016-01-03T00:00:00Z", p),
+			self.make_de_donation("2", "2016-01-02T00:00:00Z"),
+			self.make_de_donation("1", "2016-01-01T00:00:00Z", Pledge(id=p.id+1000), amount=Decimal("1")),
+		]
+
+		# The first run checks everything and records where it left off.
+		output = self.run_de_reconcile(donations)
+		self.assertIn("1 pledge(s) checked, 0 skipped", output)
+		self.assertIn("does not exist", output)
+		self.assertEqual(ReconciliationCursor.objects.get(name="de_reconcile").last_donation_id, "3")
+		self.assertEqual(ReconciliationVerdict.objects.get(pledge=p).fingerprint, self.get_de_reconcile_fingerprint(p, donations[:1]))
+
+		# The next run skips the pledge and doesn't fetch past the first page.
+		output = self.run_de_reconcile(donations, page_size=1)
+		self.assertIn("0 pledge(s) checked, 1 skipped", output)
+		self.assertNotIn("does not exist", output)
+
+		# Unless --full is given.
+		output = self.run_de_reconcile(donations, page_size=1, full=True)
+		self.assertIn("1 pledge(s) checked, 0 skipped", output)
+		self.assertIn("does not exist", output)
+
+		# A change to the donation is checked, and a problem is reported
+		# again on each run until it is fixed.
+		donations[0] = self.make_de_donation("3", "2016-01-03T00:00:00Z", p, amount=Decimal("1"))
+		for i in range(2):
+			output = self.run_de_reconcile(donations, page_size=1)
+			self.assertIn("1 pledge(s) checked, 0 skipped", output)
+			self.assertIn("disagreement on the transaction amount", output)
+			self.assertFalse(ReconciliationVerdict.objects.filter(pledge=p).exists())
+
+	def get_de_reconcile_fingerprint(self, p, dons):
+		from contrib.management.commands.de_reconcile import Command
+		return Command().get_fingerprint(Pledge.objects.get(id=p.id), dons)
+
 	# contrib is too small
 	def test_pledge_execution_failure_a(self):
 		self._pledge_execution(desired_outcome=0, amount=decimal.Decimal('.1'), incumb_challgr=0, filter_party=None, expected_contrib_amount=None,
@@ -315,7 +1016,8 @@ class ExecutionTestCase(TestCase):
 
 	def _pledge_execution(self, desired_outcome, amount, incumb_challgr, filter_party, expected_contrib_amount,
 		multitrigger_desired_outcomes=None,
-		expected_problem=None, expected_problem_string=None, made_after_trigger_execution=False):
+		expected_problem=None, expected_problem_string=None, made_after_trigger_execution=False,
+		defer_aggregates=False):
 
 		# Create a user.
 		user = User.objects.create(email="test@example.com")
@@ -399,7 +1101,13 @@ class ExecutionTestCase(TestCase):
 
 		# Execute the pledge.
 		Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = False
-		p.execute()
+		if not defer_aggregates:
+			p.execute()
+		else:
+			updater = AggregateUpdater()
+			p.execute(updater=updater)
+			self.assertEqual(TriggerExecution.objects.get(trigger=t).pledge_count, 0)
+			updater.flush()
 
 		# Test general properties.
 		self.assertEqual(p.execution.trigger_execution, t.execution)
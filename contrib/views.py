@@ -2,13 +2,13 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.db import transaction
-from django.db.models import Q, Count
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.conf import settings
 
 from twostream.decorators import anonymous_view, user_view_for
 
-from contrib.models import Trigger, TriggerStatus, TriggerExecution, ContributorInfo, Pledge, PledgeStatus, PledgeExecution, PledgeExecutionProblem, Contribution, ActorParty, IncompletePledge, TriggerCustomization
+from contrib.models import Trigger, TriggerStatus, ContributorInfo, Pledge, PledgeStatus, PledgeExecution, Contribution, ActorParty, IncompletePledge, TriggerCustomization
 from contrib.utils import json_response
 from contrib.bizlogic import HumanReadableValidationError, run_authorization_test
 
@@ -159,8 +159,8 @@ def submit(request):
 		# If the Trigger is executed, validate that there are going
 		# to be any recipients.
 		if p.trigger.status == TriggerStatus.Executed:
-			from contrib.bizlogic import get_pledge_recipients
-			if len(get_pledge_recipients(p)) == 0:
+			from contrib.bizlogic import count_pledge_recipients
+			if count_pledge_recipients(p) == 0:
 				return { "status": "error", "message": "The filters you chose have eliminated all possible recipients!" }
 
 		# Get contributor info, save, and run a credit card
@@ -499,99 +499,15 @@ def render_pledge_template(request, pledge, campaign, show_long_title=False, res
 
 @anonymous_view
 def report(request):
-	context = { }
-	context.update(report_fetch_data(None, None))
+	# The site-wide report is served from the latest precomputed snapshot.
+	from contrib.reporting import get_report_snapshot
+	snapshot = get_report_snapshot()
+	context = { "as_of": snapshot["as_of"] }
+	context.update(snapshot["report"])
 	return render(request, "contrib/totals.html", context)
 
 def report_fetch_data(trigger, via_campaign):
-	pledge_slice_fields = { }
-	pledgeexec_slice_fields = { }
-	ca_slice_fields = { }
-
-	if trigger:
-		pledge_slice_fields["trigger"] = trigger
-		try:
-			te = trigger.execution
-		except TriggerExecution.DoesNotExist:
-			raise Http404("This trigger is not executed.")
-		if te.pledge_count_with_contribs == 0:
-			raise Http404("This trigger did not have any contributions.")
-		if te.pledge_count < .75 * trigger.pledge_count:
-			raise Http404("This trigger is still being executed.")
-		pledgeexec_slice_fields["trigger_execution"] = te
-		ca_slice_fields["pledge_execution__trigger_execution"] = te
-
-	if via_campaign:
-		pledge_slice_fields["via_campaign"] = via_campaign
-		pledgeexec_slice_fields["pledge__via_campaign"] = via_campaign
-		ca_slice_fields["pledge_execution__pledge__via_campaign"] = via_campaign
-
-	# form response
-	ret = { }
-
-	# number of pledges & users making pledges
-	pledges = Pledge.objects.filter(**pledge_slice_fields)
-	ret["users_pledging"] = pledges.exclude(user=None).values("user").distinct().count()
-	ret["users_pledging_twice"] = pledges.exclude(user=None).values("user").annotate(count=Count('id')).filter(count__gt=1).count()
-	ret["pledges"] = pledges.count()
-	ret["pledges_confirmed"] = pledges.exclude(user=None).count()
-	from django.db.models import Sum
-	ret["pledge_aggregate"] = pledges.aggregate(amount=Sum('amount'))["amount"]
-
-	# number of executed pledges and users with executed pledges
-	pledge_executions = PledgeExecution.objects.filter(problem=PledgeExecutionProblem.NoProblem, **pledgeexec_slice_fields)
-	ret["users"] = pledge_executions.values("pledge__user").distinct().count()
-	ret["num_triggers"] = pledge_executions.values("trigger_execution").distinct().count()
-	if ret["num_triggers"] > 0:
-		ret["first_contrib_date"] = pledge_executions.order_by('created').first().created
-		ret["last_contrib_date"] = pledge_executions.order_by('created').last().created
-
-	# aggregate count and amount of campaign contributions
-	ret["total"] = dict(zip(["count", "total"], Contribution.aggregate(**ca_slice_fields)))
-	if ret["total"]["count"] > 0:
-		ret["total"]["average"] = ret["total"]["total"] / ret["total"]["count"]
-
-	if trigger:
-		# Aggregates by outcome. Return in the same order as Trigger.outcomes
-		# (don't change that!).
-		ret['outcomes'] = []
-		outcome_totals = dict(Contribution.aggregate('desired_outcome', **ca_slice_fields))
-		for outcome_index, outcome_info in enumerate(trigger.outcomes):
-			outcome_total = outcome_totals.get((outcome_index,), (0, decimal.Decimal(0)))
-			ret['outcomes'].append({
-				"outcome": outcome_index,
-				"label": outcome_info['label'],
-				"total": outcome_total[1],
-				"count": outcome_total[0],
-			})
-
-	# Aggregates by actor.
-	from collections import defaultdict
-	ret['actors'] = defaultdict(lambda : defaultdict( lambda : decimal.Decimal(0) ))
-	for ((action_or_actor, recipient_type), (count, total)) in Contribution.aggregate('action' if trigger else "actor", 'recipient_type', **ca_slice_fields):
-		actor = action_or_actor.actor if trigger else action_or_actor
-		ret['actors'][actor.id]['actor'] = actor
-		ret['actors'][actor.id][recipient_type.name] += total
-		if trigger: ret['actors'][actor.id]['action'] = action_or_actor
-	ret['actors'] = sorted(ret['actors'].values(), key = lambda x : (-(x['Incumbent'] - x['GeneralChallenger']), -x['Incumbent'], x['actor'].name_sort))
-
-	# Aggregates by incumbent/chalenger.
-	ret['by_recipient_type'] = [
-		{
-			"recipient_type": recipient_type.name,
-			"count": count,
-			"total": total,
-		}
-		for ((recipient_type,), (count, total))
-		in Contribution.aggregate('recipient_type', **ca_slice_fields) ]
-
-	# Aggregates by party.
-	ret['by_party'] = defaultdict( lambda : [0, decimal.Decimal(0)] )
-	for ((recipient,), (count, total)) in Contribution.aggregate('recipient', **ca_slice_fields):
-		ret['by_party'][recipient.party][0] += count
-		ret['by_party'][recipient.party][1] += total
-	ret['by_party'] = [ { "party": party, "count": count, "total": total } for (party, (count, total)) in ret['by_party'].items() ]
-	ret['by_party'].sort(key = lambda item : item["total"], reverse=True)
-
-	# report
-	return ret
+	# The rollups are computed in memory from one fetch of the contributions
+	# in the slice. See contrib.reporting.
+	from contrib.reporting import fetch_report_data
+	return fetch_report_data(trigger, via_campaign)
@@ -0,0 +1,39 @@
+# Recomputes the materialized campaign totals
+# -------------------------------------------
+
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils import timezone
+
+from itfsite.models import Campaign, CampaignTotals
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Computes the materialized contribution totals of campaigns whose totals are missing or out of date.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--all', action='store_true', default=False,
+			help='Recompute the totals of all campaigns, not just the ones known to be out of date, to correct any change that did not invalidate them.')
+
+	def handle(self, *args, **options):
+		# Make sure every campaign has a row.
+		for campaign in Campaign.objects.filter(materialized_totals=None):
+			CampaignTotals.objects.get_or_create(campaign=campaign, defaults={ "updated": timezone.now() })
+
+		totals = CampaignTotals.objects.select_related('campaign')
+		if not options['all']:
+			totals = totals.filter(models.Q(totals=None) | models.Q(stale=True))
+
+		count = 0
+		missed = 0
+		for ct in totals:
+			# Totals that weren't marked stale but come out different were
+			# affected by a change that didn't invalidate them.
+			was_current = (ct.totals is not None and not ct.stale)
+			previous_totals = ct.totals
+			ct.refresh()
+			count += 1
+			if was_current and ct.totals != previous_totals:
+				print("Campaign", ct.campaign_id, "had out of date totals that were not marked stale.")
+				missed += 1
+		print(count, "campaign total(s) refreshed,", missed, "of which were out of date but not marked stale.")
@@ -11,6 +11,7 @@ import sys
 import tqdm
 from datetime import timedelta
 from htmlemailer import send_mail
+from taskutils import iter_in_batches
 
 class Command(BaseCommand):
 	args = ''
@@ -20,12 +21,12 @@ class Command(BaseCommand):
 		# Loop through AnonymousUsers that haven't been confirmed
 		# and whose EmailConfirmation object isn't close to expiring
 		# (make sure they have 30 hours before the record is expunged).
-
-		for au in AnonymousUser.objects.filter(
+		# Stream them in batches so memory use stays flat.
+		for au in iter_in_batches(AnonymousUser.objects.filter(
 			confirmed_user=None,
 			created__gt=timezone.now()-timedelta(seconds=
 				settings.EMAIL_CONFIRM_LA_CONFIRM_EXPIRE_SEC
-					- 60*60*30)):
+					- 60*60*30))):
 
 			if au.should_retry_email_confirmation():
 				try:
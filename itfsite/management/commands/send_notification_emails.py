@@ -7,19 +7,26 @@ from django.utils import timezone
 
 from itfsite.models import User, Notification, NotificationsFrequency
 
-import sys
+import sys, time
 import tqdm
 from datetime import timedelta
-from htmlemailer import send_mail
+from taskutils import iter_in_batches
+from itfsite.utils import BatchMailer
 
 class Command(BaseCommand):
 	args = 'daily|weekly'
 	help = 'Sends users emails with new notifications.'
 
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=1,
+			help='Render the emails in this many processes. They are still sent from a single process.')
+
 	def handle(self, *args, **options):
 		if len(args) == 0:
 			print("Specify daily or weekly.")
 			return
+		if options['workers'] < 1:
+			raise CommandError("--workers must be at least 1.")
 
 		freq = {
 			"daily": NotificationsFrequency.DailyNotifications,
@@ -27,87 +34,150 @@ class Command(BaseCommand):
 		}[args[0]]
 
 		# What users do we plausibly have notifications to send to?
-		users = self.get_notifications_qs()\
-			.filter(user__notifs_freq=freq)\
-			.values_list('user', flat=True)\
-			.distinct()
-
+		users = User.objects.filter(id__in=get_notifications_qs()
+			.filter(user__notifs_freq=freq)
+			.values('user'))
+
+		# Stream the users in batches so memory use stays flat.
+		user_ids = (user.id for user in iter_in_batches(users.only('id')))
+
+		# Rendering an email (loading the user's notifications and rendering
+		# their templates) is the slow part and is done in a pool of worker
+		# processes. The finished messages come back here to be sent over
+		# a shared mail connection.
+		if options['workers'] == 1:
+			self.send_emails(map(render_notifications_email, user_ids), users)
+		else:
+			# The worker processes must not share our database connection,
+			# so close it before they are forked. Each opens its own.
+			import multiprocessing
+			from django.db import connections
+			connections.close_all()
+			with multiprocessing.Pool(options['workers']) as pool:
+				self.send_emails(pool.imap_unordered(render_notifications_email, user_ids, chunksize=10), users)
+
+	def send_emails(self, rendered_emails, users):
 		# Nice progress meter when debugging.
 		if sys.stdout.isatty():
-			users = tqdm.tqdm(users)
-
-		# Loop through users.
-		for user in users:
-			try:
-				self.send_notifications_email(user)
-			except OSError as e:
-				print(user, e)
-
-	def get_notifications_qs(self):
-		return Notification.objects.filter(
-			created__gt=timezone.now() - timedelta(days=7), # don't send really old stuff
-			dismissed_at=None, # don't send stuff the user has already seen
-			mailed_at=None, # don't send stuff we have already mailed
-			)
-
-	def send_notifications_email(self, user_id):
-		# Get the user.
-		user = User.objects.get(id=user_id)
-
-		# Get the notifications to email.
-		notifs = self.get_notifications_qs().filter(user=user)
-
-		# Don't send any notifications that were generated prior to the
-		# most recently emailed notification.
-		most_recent_emailed = Notification.objects.filter(user=user)\
-			.exclude(mailed_at=None).order_by('-mailed_at').first()
-		if most_recent_emailed:
-			notifs = notifs.filter(created__gte=most_recent_emailed.mailed_at)
-
-		# Nothing to send after all?
-		if notifs.count() == 0:
-			return
-
-		# Only send up to the 50 most recent.
-		notifs = notifs.order_by('-created')[0:50]
-
-		# Prune any Notification objects whose generic object 'source'
-		# is dangling (source object has since been deleted).
-		def filter_and_delete(n):
-			if n.source is None:
-				n.delete()
-				return False
-			return True
-		notifs = list(filter(filter_and_delete, notifs))
-
-		# Render.
-		alerts = Notification.render(notifs, for_client=False)
-		if len(alerts) == 0: # Nothing to send after all?
-			return
-
-		# Get the user's most recent pledge ContributorInfo object
-		# to generate the salutation from. (May be null.)
-		profile = user.get_contributorinfo()
-
-		# Activate the user's preferred timezone? Not needed since 
-		# we aren't displaying notification times in the email, but
-		# maybe we will?
-		#user.active_timezone()
-
-		# Send email.
-		send_mail(
-			"itfsite/mail/notifications",
-			settings.DEFAULT_FROM_EMAIL,
-			[user.email],
-			{
-				"user": user,
-				"profile": profile,
-				"notifs": alerts,
-				"subject": alerts[0]['title'],
-				"count": len(alerts),
-			})
-
-		# Record that these notifications were sent.
-		# Weird because of 'Cannot update a query once a slice has been taken.'.
-		notifs = Notification.objects.filter(id__in=[n.id for n in notifs])
-		notifs.update(mailed_at=timezone.now())
+			rendered_emails = tqdm.tqdm(rendered_emails, total=users.count())
+
+		# Record that the notifications were sent with one UPDATE per batch
+		# of emails. Each email's key is the list of its notification IDs.
+		def record_sent(keys):
+			Notification.objects.filter(id__in=[notif_id for notif_ids in keys for notif_id in notif_ids])\
+				.update(mailed_at=timezone.now())
+
+		start = time.time()
+		render_time = 0
+		send_time = 0
+		sent = 0
+		with BatchMailer(on_sent=record_sent) as mailer:
+			for email in rendered_emails:
+				render_time += email["render_time"]
+				if "error" in email:
+					print(email["user"], email["error"])
+					continue
+				if "subject" not in email:
+					continue # nothing to send
+
+				t = time.time()
+				try:
+					mailer.send_rendered(
+						email["subject"], email["text_body"], email["html_body"],
+						settings.DEFAULT_FROM_EMAIL,
+						[email["email"]],
+						key=email["notifications"])
+					sent += 1
+				except OSError as e:
+					print(email["user"], e)
+				send_time += time.time() - t
+
+		# Per-stage timing, to tune --workers. The rendering time is the sum
+		# across the workers.
+		print("%d emails sent in %0.1f seconds; rendering took %0.1f seconds, sending took %0.1f seconds." % (
+			sent, time.time() - start, render_time, send_time))
+
+def get_notifications_qs():
+	return Notification.objects.filter(
+		created__gt=timezone.now() - timedelta(days=7), # don't send really old stuff
+		dismissed_at=None, # don't send stuff the user has already seen
+		mailed_at=None, # don't send stuff we have already mailed
+		)
+
+def render_notifications_email(user_id):
+	# Render a user's notifications email. This runs in the worker processes,
+	# so it takes and returns plain data: a dict with the rendered message (if
+	# there is anything to send) or an error, and the time it took to render.
+	start = time.time()
+	try:
+		email = render_notifications_email_for(User.objects.get(id=user_id)) \
+			or { "user": user_id }
+	except OSError as e:
+		email = { "user": user_id, "error": str(e) }
+	email["render_time"] = time.time() - start
+	return email
+
+# Keep the compiled templates for all of the emails rendered by this process.
+notifications_mailer = BatchMailer()
+
+def render_notifications_email_for(user):
+	# Get the notifications to email.
+	notifs = get_notifications_qs().filter(user=user)
+
+	# Don't send any notifications that were generated prior to the
+	# most recently emailed notification.
+	most_recent_emailed = Notification.objects.filter(user=user)\
+		.exclude(mailed_at=None).order_by('-mailed_at').first()
+	if most_recent_emailed:
+		notifs = notifs.filter(created__gte=most_recent_emailed.mailed_at)
+
+	# Nothing to send after all?
+	if notifs.count() == 0:
+		return None
+
+	# Only send up to the 50 most recent.
+	notifs = notifs.order_by('-created')[0:50]
+
+	# Prune any Notification objects whose generic object 'source'
+	# is dangling (source object has since been deleted).
+	def filter_and_delete(n):
+		if n.source is None:
+			n.delete()
+			return False
+		return True
+	notifs = list(filter(filter_and_delete, notifs))
+
+	# Render.
+	alerts = Notification.render(notifs, for_client=False)
+	if len(alerts) == 0: # Nothing to send after all?
+		return None
+
+	# Get the user's most recent pledge ContributorInfo object
+	# to generate the salutation from. (May be null.)
+	profile = user.get_contributorinfo()
+
+	# Activate the user's preferred timezone? Not needed since 
+	# we aren't displaying notification times in the email, but
+	# maybe we will?
+	#user.active_timezone()
+
+	# Render the email.
+	subject, text_body, html_body = notifications_mailer.render(
+		"itfsite/mail/notifications",
+		{
+			"user": user,
+			"profile": profile,
+			"notifs": alerts,
+			"subject": alerts[0]['title'],
+			"count": len(alerts),
+		})
+
+	# Return it along with the notifications to record as sent once it is sent.
+	return {
+		"user": user.id,
+		"email": user.email,
+		"subject": subject,
+		"text_body": text_body,
+		"html_body": html_body,
+		"notifications": [n.id for n in notifs],
+	}
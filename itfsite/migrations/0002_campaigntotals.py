@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import itfsite.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itfsite', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampaignTotals',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated', models.DateTimeField(db_index=True, help_text='When the totals were last invalidated.')),
+                ('totals', itfsite.utils.JSONField(blank=True, help_text='The totals, or null if they must be recomputed.', null=True)),
+                ('campaign', models.OneToOneField(help_text='The Campaign these totals are for.', on_delete=django.db.models.deletion.CASCADE, related_name='materialized_totals', to='itfsite.Campaign')),
+            ],
+        ),
+    ]
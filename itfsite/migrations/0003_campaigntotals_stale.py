@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import itfsite.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('itfsite', '0002_campaigntotals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaigntotals',
+            name='stale',
+            field=models.BooleanField(db_index=True, default=False, help_text='Whether the totals may be out of date because they were invalidated after they were computed.'),
+        ),
+        migrations.AlterField(
+            model_name='campaigntotals',
+            name='totals',
+            field=itfsite.utils.JSONField(blank=True, help_text="The totals, or null if they haven't been computed yet.", null=True),
+        ),
+    ]
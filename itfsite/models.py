@@ -1,4 +1,4 @@
-import enum
+import enum, functools
 
 from django.db import models, transaction
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -7,6 +7,8 @@ from django.utils import timezone
 from django.template import Template, Context
 from django.conf import settings
 from django.http import Http404
+from django.db.models.signals import post_save, m2m_changed
+from django.dispatch import receiver
 from enumfields import EnumIntegerField as EnumField
 
 from itfsite.accounts import User, NotificationsFrequency, AnonymousUser
@@ -167,7 +169,17 @@ class Campaign(models.Model):
 		return self.contrib_triggers.count() == 1 and self.contrib_triggers.filter(id=trigger.id).exists()
 
 	def get_contrib_totals(self):
-		# Get all of the displayable totals for this campaign.
+		# Get all of the displayable totals for this campaign. Computing them
+		# is expensive, so they are materialized in CampaignTotals, which is
+		# recomputed off the request path when the totals may have changed.
+		# The campaign templates ask for the totals more than once, so also
+		# remember them here.
+		if not hasattr(self, '_contrib_totals'):
+			self._contrib_totals = CampaignTotals.get(self)
+		return self._contrib_totals
+
+	def compute_contrib_totals(self):
+		# Compute all of the displayable totals for this campaign.
 
 		ret = { }
 
@@ -250,6 +262,271 @@ class Campaign(models.Model):
 		return ret
 
 
+class CampaignTotals(models.Model):
+	"""The displayable contribution totals of a Campaign, materialized from Campaign.compute_contrib_totals."""
+
+	campaign = models.OneToOneField(Campaign, related_name="materialized_totals", on_delete=models.CASCADE, help_text="The Campaign these totals are for.")
+	updated = models.DateTimeField(db_index=True, help_text="When the totals were last invalidated.")
+	totals = JSONField(blank=True, null=True, help_text="The totals, or null if they haven't been computed yet.")
+	stale = models.BooleanField(default=False, db_index=True, help_text="Whether the totals may be out of date because they were invalidated after they were computed.")
+
+	def __str__(self):
+		return str(self.campaign)
+
+	@staticmethod
+	def get(campaign):
+		# Return the totals for a Campaign. They are computed here only the
+		# first time. After that, when they are stale the last totals are
+		# returned while they are recomputed in the background, so that
+		# concurrent requests don't all recompute them.
+		ct, _ = CampaignTotals.objects.get_or_create(campaign=campaign, defaults={ "updated": timezone.now() })
+		if ct.totals is None:
+			ct.refresh()
+		elif ct.stale:
+			ct.refresh_in_background()
+		return CampaignTotals.deserialize(ct.totals)
+
+	def refresh(self):
+		# Compute and store the totals, but don't overwrite an invalidation
+		# that happened while we were computing. Invalidation bumps the
+		# updated field.
+		self.totals = CampaignTotals.serialize(self.campaign.compute_contrib_totals())
+		CampaignTotals.objects.filter(id=self.id, updated=self.updated)\
+			.update(totals=self.totals, stale=False)
+
+	def refresh_in_background(self):
+		# Recompute the totals in a thread, unless another thread or process
+		# is already doing so. The lock in the cache expires on its own in
+		# case the process dies.
+		import threading, logging
+		from django.core.cache import cache
+		lock_key = "campaign_totals_refreshing:%d" % self.id
+		if not cache.add(lock_key, True, 60*10):
+			return
+		def refresh():
+			from django.db import connection
+			try:
+				self.refresh()
+			except Exception:
+				# Keep serving the stale totals. The next view or the nightly
+				# refresh_campaign_totals will try again.
+				logging.getLogger(__name__).exception("Refreshing the totals of campaign %d failed.", self.campaign_id)
+			finally:
+				cache.delete(lock_key)
+				connection.close() # this thread's database connection
+		thread = threading.Thread(target=refresh)
+		thread.daemon = True
+		thread.start()
+
+	@staticmethod
+	def invalidate(trigger_ids=(), campaign_ids=()):
+		# Mark the totals of the given Campaigns and of every Campaign that
+		# includes any of the given Triggers as stale. Called when pledges are
+		# made or cancelled, when triggers and pledges are executed, and when
+		# a Campaign's triggers or their TriggerCustomizations change.
+		q = models.Q(campaign_id__in=list(campaign_ids)) | models.Q(campaign__contrib_triggers__in=list(trigger_ids))
+		CampaignTotals.objects\
+			.filter(id__in=list(CampaignTotals.objects.filter(q).values_list('id', flat=True).distinct()))\
+			.update(stale=True, updated=timezone.now())
+
+		# The totals also rank the campaigns on the homepage, so clear the
+		# rankings of the brands of those Campaigns. (A Campaign may not have
+		# a CampaignTotals yet, so look at the Campaigns themselves.)
+		brands = Campaign.objects\
+			.filter(models.Q(id__in=list(campaign_ids)) | models.Q(contrib_triggers__in=list(trigger_ids)))\
+			.values_list('brand', flat=True).distinct()
+		clear_homepage_campaign_ids(brands=list(brands))
+
+	# The totals are stored as JSON. Only the parts of the trigger aggregates
+	# that the campaign templates display are kept, with model instances
+	# stored by ID and amounts as strings so that they stay exact.
+
+	@staticmethod
+	def serialize(totals):
+		ret = { }
+		for key in ("pledged_total", "pledged_site_wide", "contrib_total", "contrib_fixed_outcome_total"):
+			if key in totals:
+				ret[key] = str(totals[key])
+		for key in ("pledged_user_count", "contrib_user_count"):
+			if key in totals:
+				ret[key] = totals[key]
+		ret["by_trigger"] = [
+			{
+				"trigger": by_trigger["trigger"].id,
+				"aggregates": {
+					"users": by_trigger["aggregates"]["users"],
+					"total": {
+						"count": by_trigger["aggregates"]["total"]["count"],
+						"total": str(by_trigger["aggregates"]["total"]["total"]),
+					},
+					"outcomes": [
+						{ "outcome": outcome["outcome"], "label": outcome["label"], "count": outcome["count"], "total": str(outcome["total"]) }
+						for outcome in by_trigger["aggregates"]["outcomes"]
+					],
+					"by_party": [
+						{ "party": party["party"].name if party["party"] else None, "count": party["count"], "total": str(party["total"]) }
+						for party in by_trigger["aggregates"]["by_party"]
+					],
+					"actors": [
+						{ "actor": actor["actor"].id, "action": actor["action"].id,
+						  "Incumbent": str(actor["Incumbent"]), "GeneralChallenger": str(actor["GeneralChallenger"]) }
+						for actor in by_trigger["aggregates"]["actors"]
+					],
+				}
+			}
+			for by_trigger in totals["by_trigger"]
+		]
+		return ret
+
+	@staticmethod
+	def deserialize(totals):
+		import decimal
+		from contrib.models import Trigger, Actor, Action, ActorParty
+
+		# Load all of the model instances at once.
+		triggers = Trigger.objects.select_related('execution', 'trigger_type')\
+			.in_bulk(bt["trigger"] for bt in totals["by_trigger"])
+		actors = Actor.objects.in_bulk(actor["actor"] for bt in totals["by_trigger"] for actor in bt["aggregates"]["actors"])
+		actions = Action.objects.in_bulk(actor["action"] for bt in totals["by_trigger"] for actor in bt["aggregates"]["actors"])
+
+		ret = { }
+		for key in ("pledged_total", "pledged_site_wide", "contrib_total", "contrib_fixed_outcome_total"):
+			if key in totals:
+				ret[key] = decimal.Decimal(totals[key])
+		for key in ("pledged_user_count", "contrib_user_count"):
+			if key in totals:
+				ret[key] = totals[key]
+		ret["by_trigger"] = [
+			{
+				"trigger": triggers[bt["trigger"]],
+				"aggregates": {
+					"users": bt["aggregates"]["users"],
+					"total": {
+						"count": bt["aggregates"]["total"]["count"],
+						"total": decimal.Decimal(bt["aggregates"]["total"]["total"]),
+					},
+					"outcomes": [
+						dict(outcome, total=decimal.Decimal(outcome["total"]))
+						for outcome in bt["aggregates"]["outcomes"]
+					],
+					"by_party": [
+						{ "party": ActorParty[party["party"]] if party["party"] else None, "count": party["count"], "total": decimal.Decimal(party["total"]) }
+						for party in bt["aggregates"]["by_party"]
+					],
+					"actors": [
+						{ "actor": actors[actor["actor"]], "action": actions[actor["action"]],
+						  "Incumbent": decimal.Decimal(actor["Incumbent"]), "GeneralChallenger": decimal.Decimal(actor["GeneralChallenger"]) }
+						for actor in bt["aggregates"]["actors"]
+					],
+				}
+			}
+			for bt in totals["by_trigger"]
+			if bt["trigger"] in triggers
+		]
+		return ret
+
+# The homepage lists the open campaigns of a brand ranked by a mix of
+# recency and popularity. The ranked campaign IDs are kept in the cache so
+# that the homepage doesn't compute them. They are recomputed when missing
+# and are cleared when campaign totals change (see CampaignTotals.invalidate)
+# or a Campaign is saved. The homepage still checks that each campaign is
+# open, in case one was closed in a way that didn't clear the ranking.
+
+HOMEPAGE_CAMPAIGNS_CACHE_TIMEOUT = 60*60
+
+def get_homepage_campaigns_cache_key(brand):
+	return "homepage_campaigns:%d" % brand
+
+def get_homepage_campaign_ids(brand):
+	from django.core.cache import cache
+	ids = cache.get(get_homepage_campaigns_cache_key(brand))
+	if ids is None:
+		ids = compute_homepage_campaign_ids(brand)
+		cache.set(get_homepage_campaigns_cache_key(brand), ids, HOMEPAGE_CAMPAIGNS_CACHE_TIMEOUT)
+	return ids
+
+def clear_homepage_campaign_ids(brands=None):
+	# Clear the rankings of the given brands, or of all brands.
+	from django.core.cache import cache
+	if brands is None:
+		brands = [brand for (brand, name) in settings.BRAND_CHOICES]
+	if len(brands) > 0:
+		cache.delete_many([get_homepage_campaigns_cache_key(brand) for brand in brands])
+
+def compute_homepage_campaign_ids(brand):
+	# How many to show?
+	count = 12 if not settings.DEBUG else 100
+
+	# The popularity of a campaign is the sum of its triggers' total_pledged
+	# (which only contains Pledges made prior to trigger execution) and
+	# total_contributions (which only exists after the trigger has been
+	# executed). Like the SQL SUMs this replaced, a campaign has no total
+	# if none of its triggers has been executed. One row per trigger.
+	totals = { }
+	for (campaign_id, created, pledged, contributed) in Campaign.objects\
+		.filter(status=CampaignStatus.Open, brand=brand)\
+		.values_list('id', 'created', 'contrib_triggers__total_pledged', 'contrib_triggers__execution__total_contributions'):
+		t = totals.setdefault(campaign_id, [created, None, None])
+		if pledged is not None: t[1] = (t[1] or 0) + pledged
+		if contributed is not None: t[2] = (t[2] or 0) + contributed
+
+	return rank_campaigns([
+		(campaign_id, created, (pledged + contributed) if (pledged is not None and contributed is not None) else None)
+		for (campaign_id, (created, pledged, contributed)) in totals.items()
+		], count)
+
+def rank_campaigns(campaigns, count):
+	# Given (id, created, total) tuples, where total may be None, return
+	# the IDs of up to count campaigns to show, best first.
+
+	# Take recent campaigns (with some activity) + top performing campaigns.
+	campaigns = [c for c in campaigns if c[2] is not None]
+	campaigns = set( # uniqify
+		c for c in
+		  sorted(campaigns, key = lambda c : c[1], reverse=True)[0:count]
+		+ sorted(campaigns, key = lambda c : c[2], reverse=True)[0:count]
+		if c[2] > 0
+		)
+	if len(campaigns) == 0:
+		return []
+
+	# Order by a mix of recency and popularity. Prefer recency a bit.
+	from math import sqrt
+	newest = max(c[1] for c in campaigns)
+	oldest = min(c[1] for c in campaigns)
+	max_t = max(float(c[2]) for c in campaigns) or 1.0 # Decimal => float
+	campaigns = sorted(campaigns, key = lambda c :
+		    1.1 - 1.1*(newest-c[1]).total_seconds()/((newest-oldest).total_seconds() or 1)
+		  + sqrt(float(c[2]) / max_t)
+		, reverse=True)[0:count]
+	return [c[0] for c in campaigns]
+
+@receiver(post_save, sender=Campaign)
+def campaign_saved(sender, instance, **kwargs):
+	# A new campaign, or a change in status or brand, changes the homepage.
+	# (The brand it had before isn't known here, so clear every brand.)
+	clear_homepage_campaign_ids()
+
+@receiver(m2m_changed)
+def campaign_triggers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	# Adding or removing a Trigger changes a Campaign's totals. (The sender
+	# is checked here rather than in the decorator because the through model
+	# may not exist yet when this module is loaded.)
+	if sender is not Campaign.contrib_triggers.through:
+		return
+	if not reverse:
+		# campaign.contrib_triggers.add(...) etc.
+		if action in ("post_add", "post_remove", "post_clear"):
+			CampaignTotals.invalidate(campaign_ids=[instance.id])
+	else:
+		# trigger.campaigns.add(...) etc. On a clear, the Campaigns are only
+		# known beforehand.
+		if action in ("post_add", "post_remove"):
+			CampaignTotals.invalidate(campaign_ids=pk_set)
+		elif action == "pre_clear":
+			CampaignTotals.invalidate(campaign_ids=instance.campaigns.values_list('id', flat=True))
+
+
 #####################################################################
 #
 # Notifications
@@ -290,6 +567,15 @@ class Notification(models.Model):
 		self.dismissed_at = timezone.now()
 		self.save()
 
+	@staticmethod
+	@functools.lru_cache(maxsize=256)
+	def get_template(source):
+		# Compile an alert body template. The template strings come from a
+		# small set of render_notifications implementations, so the compiled
+		# templates are cached by their source. Notification.get_template.cache_info()
+		# reports the cache hits and misses.
+		return Template(source)
+
 	@staticmethod
 	def render(qs, for_client=True):
 		# Get JSON-able data so the client can render the user's notifications.
@@ -305,8 +591,8 @@ class Notification(models.Model):
 
 		for alert in alerts:
 			# Render the alert content.
-			alert["body_html"] = Template(alert["body_html"]).render(Context(alert["body_context"]))
-			alert["body_text"] = Template(alert["body_text"]).render(Context(alert["body_context"]))
+			alert["body_html"] = Notification.get_template(alert["body_html"]).render(Context(alert["body_context"]))
+			alert["body_text"] = Notification.get_template(alert["body_text"]).render(Context(alert["body_context"]))
 
 			# Add common properties derived from the notifications that underlie the alerts.
 			alert["date"] = max(n.created for n in alert['notifications']) # most recent notification
@@ -48,3 +48,136 @@ def mergedicts(*args):
 	ret = { }
 	for d in args: ret.update(d)
 	return ret
+
+class BatchMailer(object):
+	# Sends many emails made from htmlemailer templates (a template prefix
+	# plus "_subject.txt" and either ".md" or ".txt" and ".html"), finding
+	# and rendering them the same way htmlemailer.send_mail does. But rather
+	# than opening a new mail connection and loading and compiling the
+	# templates for each message, the templates are kept and one connection
+	# is used for each batch of up to batch_size messages. At the end of each
+	# batch, on_sent is called with the list of the keys passed to send for
+	# the messages that were sent, e.g. to record that they were sent with a
+	# single UPDATE. A batch also ends when the mailer exits, even on an
+	# error, so a failure part way through a batch doesn't cause the messages
+	# already sent to be sent again.
+	#
+	# Use it as a context manager so that the last connection is closed even
+	# if there is an error:
+	#
+	#   with BatchMailer(on_sent=...) as mailer:
+	#     mailer.send(template_prefix, from_email, recipient_list, context, key=...)
+
+	def __init__(self, batch_size=100, on_sent=None, connection=None):
+		self.batch_size = batch_size
+		self.on_sent = on_sent
+		self.connection = connection
+		self.owns_connection = (connection is None)
+		self.templates = { }
+		self.batch_count = 0
+		self.sent_keys = [ ]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.flush()
+
+	def get_templates(self, template_prefix):
+		# Returns the compiled subject template and either the Markdown body
+		# template's source (which htmlemailer renders from source) or the
+		# compiled text and HTML templates. As in htmlemailer, a Markdown
+		# template takes precedence.
+		if template_prefix not in self.templates:
+			from django.template import TemplateDoesNotExist
+			from django.template.engine import Engine
+			from django.template.loader import get_template
+			subject_template = get_template(template_prefix + "_subject.txt")
+			try:
+				md_template = Engine.get_default().get_template(template_prefix + ".md").source
+			except TemplateDoesNotExist:
+				md_template = None
+			if md_template:
+				self.templates[template_prefix] = (subject_template, md_template, None, None)
+			else:
+				self.templates[template_prefix] = (subject_template, None,
+					get_template(template_prefix + ".txt"),
+					get_template(template_prefix + ".html"))
+		return self.templates[template_prefix]
+
+	def render(self, template_prefix, template_context):
+		# Returns the subject, text body, and HTML body of a message.
+		return render_email_templates(self.get_templates(template_prefix), template_context)
+
+	def send(self, template_prefix, from_email, recipient_list, template_context, key=None, **kwargs):
+		# Send a message. Other keyword arguments are passed on to Django's
+		# EmailMultiAlternatives, as with htmlemailer.send_mail.
+		subject, text_body, html_body = self.render(template_prefix, template_context)
+		self.send_rendered(subject, text_body, html_body, from_email, recipient_list, key=key, **kwargs)
+
+	def send_rendered(self, subject, text_body, html_body, from_email, recipient_list, key=None, **kwargs):
+		# Send a message that was already rendered (e.g. by render in
+		# another process).
+		from django.core.mail import EmailMultiAlternatives
+		msg = EmailMultiAlternatives(
+			subject=subject,
+			body=text_body,
+			from_email=from_email,
+			to=recipient_list,
+			connection=self.get_connection(),
+			**kwargs)
+		msg.attach_alternative(html_body, "text/html")
+		msg.send()
+
+		# Remember that it was sent, and start a new connection after every
+		# batch_size messages.
+		if key is not None:
+			self.sent_keys.append(key)
+		self.batch_count += 1
+		if self.batch_count >= self.batch_size:
+			self.flush()
+
+	def get_connection(self):
+		# Open a connection for the current batch if there isn't one yet.
+		from django.core.mail import get_connection
+		if self.connection is None:
+			self.connection = get_connection()
+			self.connection.open()
+		return self.connection
+
+	def flush(self):
+		# Finish the current batch: report the messages that were sent, and
+		# if we opened the connection, close it so the next batch gets a new
+		# one.
+		sent_keys, self.sent_keys = self.sent_keys, [ ]
+		self.batch_count = 0
+		try:
+			if self.on_sent and sent_keys:
+				self.on_sent(sent_keys)
+		finally:
+			if self.owns_connection and self.connection is not None:
+				self.connection.close()
+				self.connection = None
+
+def render_email_templates(templates, template_context):
+	# Returns the subject, text body, and HTML body of a message rendered
+	# from the (subject, Markdown source, text, HTML) templates returned by
+	# BatchMailer.get_templates, exactly as htmlemailer.send_mail renders
+	# them. htmlemailer doesn't offer rendering without sending, so this
+	# uses its helper functions, which aren't a documented API. Keep all
+	# uses of them here; BatchMailerTest.test_render_email_templates checks
+	# the output against send_mail.
+	import re
+	from htmlemailer import build_template_context, render_from_markdown, inline_css
+	subject_template, md_template, text_template, html_template = templates
+	template_context = build_template_context(template_context)
+	subject = subject_template.render(template_context)
+	subject = re.sub(r"\s*[\n\r]+\s*", " ", subject).strip()
+	template_context['subject'] = subject
+	if md_template:
+		text_body, html_body = render_from_markdown(md_template, template_context)
+	else:
+		text_body = text_template.render(template_context)
+		html_body = html_template.render(template_context)
+	html_body = inline_css(html_body)
+	return subject, text_body, html_body
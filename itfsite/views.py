@@ -2,7 +2,6 @@ from django.db.models import Sum
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import Http404, HttpResponse
 from django.contrib.auth.decorators import login_required
-from django.conf import settings
 from django.utils import timezone
 
 from itfsite.models import Organization, Notification, NotificationsFrequency, Campaign, CampaignStatus
@@ -28,36 +27,14 @@ def render2(request, template, *args, **kwargs):
 def homepage(request):
 	# The site homepage.
 
-	# What campaigns *can* we show (logically)? Open campaigns for the brand we're looking at.
-	open_campaigns = Campaign.objects.filter(status=CampaignStatus.Open, brand=get_branding(request)['BRAND_INDEX'])
-
-	# How many to show?
-	count = 12 if not settings.DEBUG else 100
-
-	# Actually show recent campaigns (with some activity) + top performing campaigns.
-	#
-	# To efficiently query top performing campaigns we order by the sum of total_pledged (which only contains
-	# Pledges made prior to trigger execution) and total_contributions (which only exists after the trigger
-	# has been executed), since we don't have a field that just counts a simple total (ugh).
-	open_campaigns = open_campaigns\
-		.annotate(total=Sum('contrib_triggers__total_pledged')+Sum('contrib_triggers__execution__total_contributions'))\
-		.exclude(total=None) # no Trigger associated with the Campaign
-	open_campaigns = set( # uniqify
-		c for c in 
-		  list(open_campaigns.order_by('-created')[0:count])
-		+ list(open_campaigns.order_by("-total")[0:count])
-		if c.total > 0
-		)
-	if len(open_campaigns) > 0:
-		# Order by a mix of recency and popularity. Prefer recency a bit.
-		from math import sqrt
-		newest = max(c.created for c in open_campaigns)
-		oldest = min(c.created for c in open_campaigns)
-		max_t = max(float(getattr(c, 'total', 0)) for c in open_campaigns) or 1.0 # Decimal => float
-		open_campaigns = sorted(open_campaigns, key = lambda campaign:
-			    1.1 - 1.1*(newest-campaign.created).total_seconds()/((newest-oldest).total_seconds() or 1)
-			  + sqrt(float(getattr(campaign, 'total', 0)) / max_t)
-			, reverse=True)[0:count]
+	# Show the open campaigns for the brand we're looking at, ranked ahead
+	# of time (see itfsite.models.rank_campaigns). The ranking is cached,
+	# so check again that the campaigns are still open and on this brand.
+	from itfsite.models import get_homepage_campaign_ids
+	brand = get_branding(request)['BRAND_INDEX']
+	ids = get_homepage_campaign_ids(brand)
+	campaigns = Campaign.objects.filter(status=CampaignStatus.Open, brand=brand).in_bulk(ids)
+	open_campaigns = [campaigns[campaign_id] for campaign_id in ids if campaign_id in campaigns]
 
 	return render2(request, "itfsite/homepage.html", {
 		"open_campaigns": open_campaigns,
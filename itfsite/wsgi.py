@@ -12,3 +12,17 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "itfsite.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Load the Democracy Engine API's subscriber meta info when a worker starts
+# rather than on the first request that calls the API. uWSGI loads this file
+# in its master process and then forks the workers, so this must happen after
+# the fork: otherwise every worker would inherit the master's connection to
+# Democracy Engine. Outside of uWSGI (e.g. the development server), this
+# process is the worker.
+from contrib.bizlogic import warm_up_democracy_engine
+try:
+	from uwsgidecorators import postfork
+except ImportError:
+	warm_up_democracy_engine()
+else:
+	postfork(warm_up_democracy_engine)
@@ -85,3 +85,45 @@ def is_pid_valid(pid):
     else:
         return True
 
+
+def iter_batches(queryset, batch_size=500, select_related=(), prefetch_related=()):
+    # Iterate over the objects in a Django QuerySet without loading them all
+    # into memory at once, yielding lists of up to batch_size objects. The
+    # objects are fetched in primary key order, with each batch picking up
+    # after the last primary key of the previous batch (keyset pagination).
+    # Unlike OFFSET, this is stable when the loop changes the objects so that
+    # they no longer match the queryset's filters (e.g. by setting a sent_at
+    # field). Each batch is its own short query, so no cursor or transaction
+    # is held open across the whole loop. The select_related and
+    # prefetch_related lookups are applied to each batch.
+    queryset = queryset.order_by('pk')
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+
+    last_pk = None
+    while True:
+        batch = queryset
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if len(batch) == 0:
+            return
+        last_pk = batch[-1].pk
+        yield batch
+        if len(batch) < batch_size:
+            return
+
+def iter_in_batches(queryset, batch_size=500, select_related=(), prefetch_related=(), atomic=False):
+    # Like iter_batches but yields the objects one by one. If atomic is True,
+    # the processing of each batch runs in its own transaction: the changes
+    # are committed when the loop moves on to the next batch and rolled back
+    # if the loop is exited by an exception (or by break).
+    from django.db import transaction
+    for batch in iter_batches(queryset, batch_size, select_related, prefetch_related):
+        if atomic:
+            with transaction.atomic():
+                yield from batch
+        else:
+            yield from batch